@@ -23,6 +23,7 @@ from flask_caching import Cache
 
 # Misc Library
 import sys
+import time
 import shutil
 import os
 import io
@@ -34,11 +35,10 @@ import uuid
 import numpy as np
 import datashader as ds
 import json
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import uuid
 import base64
 import redis
-from time import sleep
 import requests
 from datetime import datetime
 
@@ -49,17 +49,22 @@ from pyteomics import mass
 from utils import _calculate_file_stats
 from utils import _get_scan_polarity
 from utils import _resolve_map_plot_selection, _get_param_from_url, _spectrum_generator
+from utils import _resolve_parameters, _get_resolved_param
 from utils import MS_precisions
 import utils
 
 import download
 import ms2
 import lcms_map
+import map_pyramid
 import tasks
 import tasks_conversion
+import task_wait
+import single_flight
+import priority_lanes
 from formula_utils import get_adduct_mass
 import xic
-from sync import _sychronize_save_state, _sychronize_load_state
+from sync import _sychronize_save_state, _sychronize_load_state, _sychronize_load_version, _sychronize_load_changed, _sychronize_claim_token
 import shorturl
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_limiter import Limiter
@@ -107,12 +112,16 @@ if __name__ == "__main__":
     redis_client = None
 else:
     WORKER_UP = True
+    # Byte budgeted LRU shared by all the gunicorn workers through redis, cache_backend.MemoryLRUCache keeps it per process
     cache = Cache(app.server, config={
         #'CACHE_TYPE': "null",
-        'CACHE_TYPE': 'filesystem',
-        'CACHE_DIR': 'temp/flask-cache',
+        'CACHE_TYPE': os.environ.get("LCMS_CACHE_TYPE", "cache_backend.RedisLRUCache"),
+        'CACHE_REDIS_HOST': 'gnpslcms-redis',
+        'CACHE_REDIS_PORT': 6379,
+        'CACHE_REDIS_DB': 0,
+        'CACHE_KEY_PREFIX': 'lcmsflaskcache:',
         'CACHE_DEFAULT_TIMEOUT': 0,
-        'CACHE_THRESHOLD': 1000000
+        'CACHE_LRU_MAX_BYTES': int(os.environ.get("LCMS_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
     })
 
     redis_client = redis.Redis(host='gnpslcms-redis', port=6379, db=0)
@@ -152,6 +161,7 @@ placeholder_ms2_plot = px.line(df, x="rt", y="mz", title='MS Spectrum Plot - Ple
 
 MAX_XIC_PLOT_LCMS_FILES = 30
 MAX_LCMS_FILES = 500
+PREFETCH_PARALLELISM = 4 # Files prepared at once when there is no conversion worker
 
 NAVBAR = dbc.Navbar(
     children=[
@@ -423,6 +433,13 @@ DATASELECTION_CARD = [
                                             type="dot"
                                         )
                                     )]),
+                            html.Tr([html.Td("Files Ready"), 
+                                    html.Td(html.Details(
+                                            id="file_readiness",
+                                            children=[html.Summary(html.H6([dbc.Badge("Ready", color="success", className="ml-1")], style={"display": "inline"}))]
+                                        ),
+                                        colSpan=3
+                                    )]),
                             html.Tr([html.Td("Heatmap Drawing Left"), 
                                     html.Td(dcc.Loading(
                                             id="loading_map_plot",
@@ -1218,11 +1235,18 @@ BODY = dbc.Container(
                 "display" : "none"
             }
         ),
+        dcc.Interval(
+            id='file_readiness_interval',
+            interval=5000, # in milliseconds
+            n_intervals=0
+        ),
         dcc.Interval(
             id='sychronization_interval',
             interval=1000000000*1000, # in milliseconds
             n_intervals=0
         ),
+        html.Div("", id="sychronization_version", style={"display":"none"}), # Version of the synced session, the synced fields only reload when it changes
+        dcc.Store(id="resolved_parameters"), # Parameters from the url, session and imports, worked out once for all the callbacks setting them
         html.Div("", id="synchronization_type_dependency", style={"display":"none"}), # This is a hack to pass on a retrigger without causing infinite loops in the dependency chain
         html.Div("", id="page_parameters", style={"display":"none"}), # This is an intermediate dependency to hold the parameters so we make it easier to update them
         html.Div("", id="auto_import_parameters", style={"display":"none"}), # This is a hidden area to set parameters to be loaded into the interface
@@ -1405,22 +1429,82 @@ def _resolve_usi(usi, temp_folder="temp"):
         # We can do it in line because we know that it won't actually do the call
         return download._resolve_usi(usi)
     else:
-        if _is_worker_up():
-            # If we have the celery instance up, we'll push it
-            result = tasks_conversion._download_convert_file.delay(usi, temp_folder=temp_folder)
-
-            # Waiting
-            while(1):
-                if result.ready():
-                    break
-                sleep(1)
-            result = result.get()
-            return result
+        # Everyone asking for this file while it is being fetched waits on the same task
+        flight_key = "resolve:" + os.path.join(temp_folder, download._usi_to_local_filename(usi))
+        return single_flight.run(flight_key, _resolve_usi_once, usi, temp_folder=temp_folder)
+
+def _resolve_usi_once(usi, temp_folder="temp"):
+    # The task we waited on may have made it already
+    if download._resolve_exists_local(usi, temp_folder=temp_folder):
+        return download._resolve_usi(usi, temp_folder=temp_folder)
+
+    if _is_worker_up():
+        # If we have the celery instance up, we'll push it
+        result = tasks_conversion._download_convert_file.delay(usi, temp_folder=temp_folder)
+
+        # Waiting
+        return task_wait.wait_for_result(result, timeout=task_wait.CONVERSION_TIMEOUT)
+    else:
+        # If we have the celery instance is not up, we'll do it local
+        print("Downloading Local")
+        return tasks_conversion._download_convert_file(usi, temp_folder=temp_folder)
+
+
+_prefetch_executor = None
+
+def _prefetch_usis(usi_list, temp_folder="temp"):
+    """
+    Schedules download, conversion and building of everything the plots read, for every file that isn't ready yet
+
+    Parallelism is bounded by the background conversion worker pool, or PREFETCH_PARALLELISM threads when running without workers
+    """
+    global _prefetch_executor
+
+    # Entering the files again retries the ones that failed
+    pending_usi_list = [usi for usi in usi_list if _file_readiness(usi, temp_folder=temp_folder) != "Ready"]
+    if len(pending_usi_list) == 0:
+        return
+
+    worker_up = _is_worker_up()
+    if not worker_up and _prefetch_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_PARALLELISM)
+
+    # Shares the background conversion lane with the other sessions
+    session = priority_lanes.session_key(usi_list)
+
+    for usi in pending_usi_list:
+        # Files already in flight keep their progress
+        if download.get_resolve_progress(usi, temp_folder=temp_folder) in [None, "Failed"]:
+            download.report_resolve_progress(usi, "Queued", temp_folder=temp_folder)
+
+        if worker_up:
+            tasks_conversion.schedule_prefetch(usi, session, temp_folder=temp_folder)
         else:
-            # If we have the celery instance is not up, we'll do it local
-            print("Downloading Local")
-            return tasks_conversion._download_convert_file(usi, temp_folder=temp_folder)
+            _prefetch_executor.submit(tasks_conversion._prefetch_file, usi, temp_folder=temp_folder)
+
+def _file_readiness(usi, temp_folder="temp"):
+    """
+    Where the file is on its way to being ready, from what is on disk and what the worker preparing it reported
+
+    Returns:
+        [type]: Ready, Converted, Failed, Queued, a download or conversion stage, or Not Started
+    """
+    local_filename = os.path.join(temp_folder, download._usi_to_local_filename(usi))
+
+    if os.path.exists(local_filename):
+        if tasks_conversion.is_file_ready(local_filename):
+            return "Ready"
+
+    progress = download.get_resolve_progress(usi, temp_folder=temp_folder)
+
+    if os.path.exists(local_filename) and progress in [None, "Done", "Ready"]:
+        return "Converted"
 
+    if progress is None:
+        return "Not Started"
+
+    return progress
 
 def _save_redis(key, value, expiration_in_seconds):
 
@@ -1431,30 +1515,122 @@ def _synchronize_collab_action(session_id, triggered_fields, full_params, synchr
     if _is_worker_up():
         result = tasks.task_collabsync.delay(session_id, triggered_fields, full_params, synchronization_token=synchronization_token)
 
+def _synchronize_parse_version(sychronization_version):
+    try:
+        return json.loads(sychronization_version)
+    except:
+        return {}
+
+SYNCHRONIZATION_STATES_SIZE = 256
+_synchronization_states = OrderedDict() # session id -> (version, state), so a new version only loads the fields that changed since the last one
+
+def _synchronize_load_session_version(sychronization_session_id):
+    cached_version, session_dict = _synchronization_states.get(sychronization_session_id, (0, {}))
+
+    version, changed_dict = _sychronize_load_changed(sychronization_session_id, cached_version, redis_client)
+
+    # The session was started over, so what we have is from before
+    if version < cached_version:
+        cached_version, session_dict = 0, {}
+        version, changed_dict = _sychronize_load_changed(sychronization_session_id, 0, redis_client)
+
+    session_dict = dict(session_dict)
+    session_dict.update(changed_dict)
+    session_dict.pop("synchronization_token", None) # The state goes to the browser, the leader token must not
+
+    _synchronization_states[sychronization_session_id] = (version, session_dict)
+    _synchronization_states.move_to_end(sychronization_session_id)
+    while len(_synchronization_states) > SYNCHRONIZATION_STATES_SIZE:
+        _synchronization_states.popitem(last=False)
+
+    return dict(session_dict)
+
+def _synchronize_load_session(sychronization_session_id, sychronization_version, triggered_id):
+    # Following, only the fields changed since the last version this server saw come from redis
+    if "sychronization_version" in triggered_id:
+        return _synchronize_load_session_version(sychronization_session_id)
+
+    return _sychronize_load_state(sychronization_session_id, redis_client)
+
+def _get_triggered_parameters(resolved_parameters, triggered_id):
+    # The session part is only used by the callbacks it triggered, after that the url is in charge again until the next load
+    resolved_parameters = dict(resolved_parameters or {})
+    if "resolved_parameters" not in triggered_id:
+        resolved_parameters["session"] = {}
+    resolved_parameters.setdefault("session", {})
+    resolved_parameters.setdefault("from_session", False)
+
+    return resolved_parameters
+
+# Works out the parameters from the url, the synced session and the imports once, the callbacks setting them read them from here
+@app.callback([
+                  Output('resolved_parameters', 'data'),
+              ],
+              [
+                  Input('url', 'search'),
+                  Input('url', 'hash'),
+                  Input('sychronization_load_session_button', 'n_clicks'),
+                  Input('sychronization_version', 'children'),
+                  Input('advanced_import_update_button', "n_clicks"),
+                  Input('auto_import_parameters', 'children'),
+              ],
+              [
+                  State('sychronization_session_id', 'value'),
+                  State('setting_json_area', 'value'),
+              ])
+def resolve_parameters(search, url_hash, sychronization_load_session_button_clicks, sychronization_version, advanced_import_update_button, auto_import_parameters,
+                        sychronization_session_id, setting_json_area):
+    triggered_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
+
+    session_dict = {}
+    from_session = False
+
+    # We are going to load it from internal redis session server
+    if "sychronization_load_session_button" in triggered_id or "sychronization_version" in triggered_id:
+        from_session = True
+        if sychronization_session_id is not None and len(sychronization_session_id) > 0:
+            try:
+                session_dict = _synchronize_load_session(sychronization_session_id, sychronization_version, triggered_id)
+            except:
+                pass
+
+    # We clicked the button so we are going to load from the text area
+    if "advanced_import_update_button" in triggered_id:
+        from_session = True
+        try:
+            session_dict = json.loads(setting_json_area)
+        except:
+            pass
+
+    if "auto_import_parameters" in triggered_id:
+        from_session = True
+        try:
+            session_dict = json.loads(auto_import_parameters)
+        except:
+            pass
+
+    resolved_parameters = _resolve_parameters(search, url_hash, session_dict=session_dict)
+    resolved_parameters["from_session"] = from_session
+
+    return [resolved_parameters]
+
 # This helps to update the ms2/ms1 plot
 @app.callback([
                   Output("ms2_identifier", "value")
               ],
               [
-                  Input('url', 'search'),
+                  Input('resolved_parameters', 'data'),
                   Input('usi', 'value'),
                   Input('usi_select', 'value'),
                   Input('map-plot', 'clickData'), 
                   Input('xic-plot', 'clickData'), 
                   Input('tic-plot', 'clickData'),
-                  Input('sychronization_load_session_button', 'n_clicks'),
-                  Input('sychronization_interval', 'n_intervals'),
-                  Input('advanced_import_update_button', "n_clicks"),
               ],
               [
-                  State('sychronization_session_id', 'value'),
-                  State('setting_json_area', 'value'),
                   State('ms2_identifier', 'value'),
               ])
-def click_plot(url_search, usi, usi_select, 
-                mapclickData, xicclickData, ticclickData, sychronization_load_session_button_clicks, sychronization_interval, advanced_import_update_button, 
-                sychronization_session_id,
-                setting_json_area, 
+def click_plot(resolved_parameters, usi, usi_select, 
+                mapclickData, xicclickData, ticclickData, 
                 existing_ms2_identifier):
 
     triggered_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
@@ -1469,21 +1645,9 @@ def click_plot(url_search, usi, usi_select,
 
     # nothing was clicked, so read from URL or session
     if clicked_target is None:
-        session_dict = {}
-        if "sychronization_load_session_button" in triggered_id or "sychronization_interval" in triggered_id:
-            try:
-                session_dict = _sychronize_load_state(sychronization_session_id, redis_client)
-            except:
-                pass
-        
-        # We clicked the button so we are going to load from the text area
-        if "advanced_import_update_button" in triggered_id:
-            try:
-                session_dict = json.loads(setting_json_area)
-            except:
-                pass
+        resolved_parameters = _get_triggered_parameters(resolved_parameters, triggered_id)
 
-        return [_get_param_from_url(url_search, "", "ms2_identifier", dash.no_update, session_dict=session_dict, old_value=existing_ms2_identifier, no_change_default=dash.no_update)]
+        return [_get_resolved_param(resolved_parameters, "ms2_identifier", dash.no_update, old_value=existing_ms2_identifier, no_change_default=dash.no_update)]
     
     # This is an MS2
     if clicked_target["curveNumber"] == 1:
@@ -1505,13 +1669,29 @@ def click_plot(url_search, usi, usi_select,
         return ["MS1:{}".format(closest_scan)]
 
 
+def _determine_spectrum_usi(usi, usi_select, ms2_identifier):
+    usi_first = utils.determine_usi_to_use(usi, usi_select)
+
+    usi_splits = usi_first.split(":")
+    dataset = usi_splits[1]
+    filename = usi_splits[2]
+    scan_number = str(ms2_identifier.split(":")[-1])
+
+    if "=" in scan_number:
+        # we have a nativeID, so we should change the USI appropriately, need to split on space, then split on =, and get the last element
+        native_id_compressed = utils.nativeid_to_usi_nativeid(scan_number)
+        updated_usi = "mzspec:{}:{}:nativeId:{}".format(dataset, filename, native_id_compressed)
+    else:
+        updated_usi = "mzspec:{}:{}:scan:{}".format(dataset, filename, scan_number)
+
+    return usi_first, filename, scan_number, updated_usi
+
 # This helps to update the ms2/ms1 plot
 @app.callback([
                 Output('debug-output', 'children'), 
                 Output('ms2-plot', 'figure'), 
                 Output('ms2-plot', 'config'), 
                 Output('ms2-plot-buttons', 'children'),
-                Output('spectrum_details_area', 'children'),
                 Output('usi_frame', 'src'),
               ],
               [
@@ -1528,21 +1708,9 @@ def draw_spectrum(usi, usi_select, ms2_identifier, export_format, plot_theme, xi
     # Checking Values
     if ms2_identifier is None or len(ms2_identifier) < 2:
         # TODO: We should actually blank everything out, instead of leaving it as is
-        return [dash.no_update] * 6
-
-    usi_first = utils.determine_usi_to_use(usi, usi_select)
-
-    usi_splits = usi_first.split(":")
-    dataset = usi_splits[1]
-    filename = usi_splits[2]
-    scan_number = str(ms2_identifier.split(":")[-1])
+        return [dash.no_update] * 5
 
-    if "=" in scan_number:
-        # we have a nativeID, so we should change the USI appropriately, need to split on space, then split on =, and get the last element
-        native_id_compressed = utils.nativeid_to_usi_nativeid(scan_number)
-        updated_usi = "mzspec:{}:{}:nativeId:{}".format(dataset, filename, native_id_compressed)
-    else:
-        updated_usi = "mzspec:{}:{}:scan:{}".format(dataset, filename, scan_number)
+    usi_first, filename, scan_number, updated_usi = _determine_spectrum_usi(usi, usi_select, ms2_identifier)
 
     # For Drawing and Exporting
     graph_config = {
@@ -1556,7 +1724,7 @@ def draw_spectrum(usi, usi_select, ms2_identifier, export_format, plot_theme, xi
 
     # Getting Spectrum Peaks
     remote_link, local_filename = _resolve_usi(usi_first)
-    peaks, precursor_mz, spectrum_details_string, spectrum_metadata = ms2._get_ms2_peaks(updated_usi, local_filename, scan_number)
+    peaks, precursor_mz, spectrum_details_string, spectrum_metadata = ms2._get_ms2_peaks(updated_usi, local_filename, scan_number, include_details=False)
     usi_url = "https://metabolomics-usi.gnps2.org/dashinterface/?usi={}".format(updated_usi)
 
     spectrum_type = "MS"
@@ -1569,7 +1737,6 @@ def draw_spectrum(usi, usi_select, ms2_identifier, export_format, plot_theme, xi
 
     # Figuring out which labels to show
     mzs_text = ms2._get_ms_peak_labels(mzs, ints)
-    hover_text = ms2._get_ms_hover(mzs, ints)
 
     interactive_fig = go.Figure(
         data=go.Scatter(x=mzs, y=ints, 
@@ -1581,7 +1748,7 @@ def draw_spectrum(usi, usi_select, ms2_identifier, export_format, plot_theme, xi
                 array=neg_ints,
                 width=0
             ),
-            hoverinfo="x+y",
+            hovertemplate=ms2.MS_HOVER_TEMPLATE,
             textposition="top right",
             text=mzs_text
         )
@@ -1654,9 +1821,31 @@ def draw_spectrum(usi, usi_select, ms2_identifier, export_format, plot_theme, xi
             interactive_fig, 
             graph_config, 
             button_elements, 
-            html.Pre(spectrum_details_string), 
             usi_url]
 
+# The full spectrum xml is only pretty printed once someone opens the details
+@app.callback([
+                Output('spectrum_details_area', 'children'),
+              ],
+              [
+                  Input('spectrum_details_modal', 'is_open'),
+              ],
+              [
+                  State('usi', 'value'), 
+                  State('usi_select', 'value'),
+                  State('ms2_identifier', 'value'), 
+              ])
+def render_spectrum_details(spectrum_details_modal_is_open, usi, usi_select, ms2_identifier):
+    if not spectrum_details_modal_is_open or ms2_identifier is None or len(ms2_identifier) < 2:
+        return [dash.no_update]
+
+    usi_first, filename, scan_number, updated_usi = _determine_spectrum_usi(usi, usi_select, ms2_identifier)
+
+    remote_link, local_filename = _resolve_usi(usi_first)
+    spectrum_details_string = ms2._get_spectrum_details(updated_usi, local_filename, scan_number)
+
+    return [html.Pre(spectrum_details_string)]
+
 @app.callback([
                 Output('advanced_librarysearchmassivekb_modal_button', 'children'),
                 Output('librarysearchmassivekb_frame', 'src'), 
@@ -1785,18 +1974,11 @@ def draw_fastsearch_massivekb(usi, usi_select, ms2_identifier):
                 Output("plot_theme", "value"),
               ],
               [
-                  Input('url', 'search'), 
-                  Input('sychronization_load_session_button', 'n_clicks'),
-                  Input('sychronization_interval', 'n_intervals'),
-                  Input('advanced_import_update_button', "n_clicks"),
-                  Input('auto_import_parameters', 'children'),
+                  Input('resolved_parameters', 'data'),
 
                   Input('darkmode_button', 'n_clicks'),
               ],
               [
-                  State('sychronization_session_id', 'value'),
-                  State('setting_json_area', 'value'),
-
                   State('xic_formula', 'value'),
                   State('xic_peptide', 'value'),
                   State('xic_tolerance', 'value'),
@@ -1846,18 +2028,10 @@ def draw_fastsearch_massivekb(usi, usi_select, ms2_identifier):
                   
               ]
               )
-def determine_url_only_parameters(  search, 
-                                    sychronization_load_session_button_click, 
-                                    sychronization_interval, 
-                                    advanced_import_update_button, 
-                                    auto_import_parameters,
+def determine_url_only_parameters(  resolved_parameters, 
 
                                     darkmode_button_click,
 
-                                    sychronization_session_id,
-
-                                    setting_json_area,
-
                                     existing_xic_formula,
                                     existing_xic_peptide,
                                     existing_xic_tolerance,
@@ -1917,87 +2091,65 @@ def determine_url_only_parameters(  search,
 
     #print("TRIGGERED URL PARSING", triggered_id, file=sys.stderr)
 
-    session_dict = {}
-    # We are going to load it from internal redis session server
-    if "sychronization_load_session_button" in triggered_id or "sychronization_interval" in triggered_id:
-        if len(sychronization_session_id) > 0:
-            #print("LOADING", sychronization_session_id, file=sys.stderr)
-            try:
-                session_dict = _sychronize_load_state(sychronization_session_id, redis_client)
-                print(session_dict, file=sys.stderr)
-            except:
-                pass
-    
-    # We clicked the button so we are going to load from the text area
-    if "advanced_import_update_button" in triggered_id:
-        try:
-            session_dict = json.loads(setting_json_area)
-        except:
-            pass
+    resolved_parameters = _get_triggered_parameters(resolved_parameters, triggered_id)
 
-    if "auto_import_parameters" in triggered_id:
-        try:
-            session_dict = json.loads(auto_import_parameters)
-        except:
-            pass
-
-    xic_formula = _get_param_from_url(search, "", "xic_formula", dash.no_update, session_dict=session_dict, old_value=existing_xic_formula, no_change_default=dash.no_update)
-    xic_peptide = _get_param_from_url(search, "", "xic_peptide", dash.no_update, session_dict=session_dict, old_value=existing_xic_peptide, no_change_default=dash.no_update)
-    xic_tolerance = _get_param_from_url(search, "", "xic_tolerance", dash.no_update, session_dict=session_dict, old_value=existing_xic_tolerance, no_change_default=dash.no_update)
-    xic_ppm_tolerance = _get_param_from_url(search, "", "xic_ppm_tolerance", dash.no_update, session_dict=session_dict, old_value=existing_xic_ppm_tolerance, no_change_default=dash.no_update)
-    xic_tolerance_unit = _get_param_from_url(search, "", "xic_tolerance_unit", dash.no_update, session_dict=session_dict, old_value=existing_xic_tolerance_unit, no_change_default=dash.no_update)
-    xic_norm = _get_param_from_url(search, "", "xic_norm", dash.no_update, session_dict=session_dict, old_value=existing_xic_norm, no_change_default=dash.no_update)
-    xic_integration_type = _get_param_from_url(search, "", "xic_integration_type", dash.no_update, session_dict=session_dict, old_value=existing_xic_integration_type, no_change_default=dash.no_update)
-    xic_file_grouping = _get_param_from_url(search, "", "xic_file_grouping", dash.no_update, session_dict=session_dict, old_value=existing_xic_file_grouping, no_change_default=dash.no_update)
+    xic_formula = _get_resolved_param(resolved_parameters, "xic_formula", dash.no_update, old_value=existing_xic_formula, no_change_default=dash.no_update)
+    xic_peptide = _get_resolved_param(resolved_parameters, "xic_peptide", dash.no_update, old_value=existing_xic_peptide, no_change_default=dash.no_update)
+    xic_tolerance = _get_resolved_param(resolved_parameters, "xic_tolerance", dash.no_update, old_value=existing_xic_tolerance, no_change_default=dash.no_update)
+    xic_ppm_tolerance = _get_resolved_param(resolved_parameters, "xic_ppm_tolerance", dash.no_update, old_value=existing_xic_ppm_tolerance, no_change_default=dash.no_update)
+    xic_tolerance_unit = _get_resolved_param(resolved_parameters, "xic_tolerance_unit", dash.no_update, old_value=existing_xic_tolerance_unit, no_change_default=dash.no_update)
+    xic_norm = _get_resolved_param(resolved_parameters, "xic_norm", dash.no_update, old_value=existing_xic_norm, no_change_default=dash.no_update)
+    xic_integration_type = _get_resolved_param(resolved_parameters, "xic_integration_type", dash.no_update, old_value=existing_xic_integration_type, no_change_default=dash.no_update)
+    xic_file_grouping = _get_resolved_param(resolved_parameters, "xic_file_grouping", dash.no_update, old_value=existing_xic_file_grouping, no_change_default=dash.no_update)
 
-    show_ms2_markers = _get_param_from_url(search, "", "show_ms2_markers", dash.no_update, session_dict=session_dict, old_value=existing_show_ms2_markers, no_change_default=dash.no_update)
-    ms2marker_color = _get_param_from_url(search, "", "ms2marker_color", dash.no_update, session_dict=session_dict, old_value=existing_ms2marker_color, no_change_default=dash.no_update)
-    ms2marker_size = _get_param_from_url(search, "", "ms2marker_size", dash.no_update, session_dict=session_dict, old_value=existing_ms2marker_size, no_change_default=dash.no_update)
+    show_ms2_markers = _get_resolved_param(resolved_parameters, "show_ms2_markers", dash.no_update, old_value=existing_show_ms2_markers, no_change_default=dash.no_update)
+    ms2marker_color = _get_resolved_param(resolved_parameters, "ms2marker_color", dash.no_update, old_value=existing_ms2marker_color, no_change_default=dash.no_update)
+    ms2marker_size = _get_resolved_param(resolved_parameters, "ms2marker_size", dash.no_update, old_value=existing_ms2marker_size, no_change_default=dash.no_update)
 
-    show_lcms_2nd_map = _get_param_from_url(search, "", "show_lcms_2nd_map", dash.no_update, session_dict=session_dict, old_value=existing_show_lcms_2nd_map, no_change_default=dash.no_update)
+    show_lcms_2nd_map = _get_resolved_param(resolved_parameters, "show_lcms_2nd_map", dash.no_update, old_value=existing_show_lcms_2nd_map, no_change_default=dash.no_update)
 
-    tic_option = _get_param_from_url(search, "", "tic_option", dash.no_update, session_dict=session_dict, old_value=existing_tic_option, no_change_default=dash.no_update)
+    tic_option = _get_resolved_param(resolved_parameters, "tic_option", dash.no_update, old_value=existing_tic_option, no_change_default=dash.no_update)
 
-    polarity_filtering = _get_param_from_url(search, "", "polarity_filtering", dash.no_update, session_dict=session_dict, old_value=existing_polarity_filtering, no_change_default=dash.no_update)
-    polarity_filtering2 = _get_param_from_url(search, "", "polarity_filtering2", dash.no_update, session_dict=session_dict, old_value=existing_polarity_filtering2, no_change_default=dash.no_update)
+    polarity_filtering = _get_resolved_param(resolved_parameters, "polarity_filtering", dash.no_update, old_value=existing_polarity_filtering, no_change_default=dash.no_update)
+    polarity_filtering2 = _get_resolved_param(resolved_parameters, "polarity_filtering2", dash.no_update, old_value=existing_polarity_filtering2, no_change_default=dash.no_update)
 
-    overlay_usi = _get_param_from_url(search, "", "overlay_usi", dash.no_update, session_dict=session_dict, old_value=existing_overlay_usi, no_change_default=dash.no_update)
-    overlay_mz = _get_param_from_url(search, "", "overlay_mz", dash.no_update, session_dict=session_dict, old_value=existing_overlay_mz, no_change_default=dash.no_update)
-    overlay_rt = _get_param_from_url(search, "", "overlay_rt", dash.no_update, session_dict=session_dict, old_value=existing_overlay_rt, no_change_default=dash.no_update)
-    overlay_color = _get_param_from_url(search, "", "overlay_color", dash.no_update, session_dict=session_dict, old_value=existing_overlay_color, no_change_default=dash.no_update)
-    overlay_size = _get_param_from_url(search, "", "overlay_size", dash.no_update, session_dict=session_dict, old_value=existing_overlay_size, no_change_default=dash.no_update)
-    overlay_hover = _get_param_from_url(search, "", "overlay_hover", dash.no_update, session_dict=session_dict, old_value=existing_overlay_hover, no_change_default=dash.no_update)
-    overlay_filter_column = _get_param_from_url(search, "", "overlay_filter_column", dash.no_update, session_dict=session_dict, old_value=existing_overlay_filter_column, no_change_default=dash.no_update)
-    overlay_filter_value = _get_param_from_url(search, "", "overlay_filter_value", dash.no_update, session_dict=session_dict, old_value=existing_overlay_filter_value, no_change_default=dash.no_update)
+    overlay_usi = _get_resolved_param(resolved_parameters, "overlay_usi", dash.no_update, old_value=existing_overlay_usi, no_change_default=dash.no_update)
+    overlay_mz = _get_resolved_param(resolved_parameters, "overlay_mz", dash.no_update, old_value=existing_overlay_mz, no_change_default=dash.no_update)
+    overlay_rt = _get_resolved_param(resolved_parameters, "overlay_rt", dash.no_update, old_value=existing_overlay_rt, no_change_default=dash.no_update)
+    overlay_color = _get_resolved_param(resolved_parameters, "overlay_color", dash.no_update, old_value=existing_overlay_color, no_change_default=dash.no_update)
+    overlay_size = _get_resolved_param(resolved_parameters, "overlay_size", dash.no_update, old_value=existing_overlay_size, no_change_default=dash.no_update)
+    overlay_hover = _get_resolved_param(resolved_parameters, "overlay_hover", dash.no_update, old_value=existing_overlay_hover, no_change_default=dash.no_update)
+    overlay_filter_column = _get_resolved_param(resolved_parameters, "overlay_filter_column", dash.no_update, old_value=existing_overlay_filter_column, no_change_default=dash.no_update)
+    overlay_filter_value = _get_resolved_param(resolved_parameters, "overlay_filter_value", dash.no_update, old_value=existing_overlay_filter_value, no_change_default=dash.no_update)
 
     # Feature Finding
-    feature_finding_type = _get_param_from_url(search, "", "feature_finding_type", dash.no_update, session_dict=session_dict, old_value=existing_feature_finding_type, no_change_default=dash.no_update)
-    feature_finding_ppm = _get_param_from_url(search, "", "feature_finding_ppm", dash.no_update, session_dict=session_dict, old_value=existing_feature_finding_ppm, no_change_default=dash.no_update)
-    feature_finding_noise = _get_param_from_url(search, "", "feature_finding_noise", dash.no_update, session_dict=session_dict, old_value=existing_feature_finding_noise, no_change_default=dash.no_update)
-    feature_finding_min_peak_rt = _get_param_from_url(search, "", "feature_finding_min_peak_rt", dash.no_update, session_dict=session_dict, old_value=existing_feature_finding_min_peak_rt, no_change_default=dash.no_update)
-    feature_finding_max_peak_rt = _get_param_from_url(search, "", "feature_finding_max_peak_rt", dash.no_update, session_dict=session_dict, old_value=existing_feature_finding_max_peak_rt, no_change_default=dash.no_update)
-    feature_finding_rt_tolerance = _get_param_from_url(search, "", "feature_finding_rt_tolerance", dash.no_update, session_dict=session_dict, old_value=existing_feature_finding_rt_tolerance, no_change_default=dash.no_update)
+    feature_finding_type = _get_resolved_param(resolved_parameters, "feature_finding_type", dash.no_update, old_value=existing_feature_finding_type, no_change_default=dash.no_update)
+    feature_finding_ppm = _get_resolved_param(resolved_parameters, "feature_finding_ppm", dash.no_update, old_value=existing_feature_finding_ppm, no_change_default=dash.no_update)
+    feature_finding_noise = _get_resolved_param(resolved_parameters, "feature_finding_noise", dash.no_update, old_value=existing_feature_finding_noise, no_change_default=dash.no_update)
+    feature_finding_min_peak_rt = _get_resolved_param(resolved_parameters, "feature_finding_min_peak_rt", dash.no_update, old_value=existing_feature_finding_min_peak_rt, no_change_default=dash.no_update)
+    feature_finding_max_peak_rt = _get_resolved_param(resolved_parameters, "feature_finding_max_peak_rt", dash.no_update, old_value=existing_feature_finding_max_peak_rt, no_change_default=dash.no_update)
+    feature_finding_rt_tolerance = _get_resolved_param(resolved_parameters, "feature_finding_rt_tolerance", dash.no_update, old_value=existing_feature_finding_rt_tolerance, no_change_default=dash.no_update)
 
     # MassQL
-    massql_statement = _get_param_from_url(search, "", "massql_statement", dash.no_update, session_dict=session_dict, old_value=existing_massql_statement, no_change_default=dash.no_update)
+    massql_statement = _get_resolved_param(resolved_parameters, "massql_statement", dash.no_update, old_value=existing_massql_statement, no_change_default=dash.no_update)
 
     # Sychronization
     default_session_id = str(uuid.uuid4()).replace("-", "")
     if len(existing_sychronization_session_id) > 0:
         default_session_id = existing_sychronization_session_id
-    sychronization_session_id = _get_param_from_url(search, "", "sychronization_session_id", default_session_id, session_dict=session_dict, old_value=existing_sychronization_session_id, no_change_default=dash.no_update)
+    sychronization_session_id = _get_resolved_param(resolved_parameters, "sychronization_session_id", default_session_id, old_value=existing_sychronization_session_id, no_change_default=dash.no_update)
 
     # Chromatogram Options
-    chromatogram_options = _get_param_from_url(search, "", "chromatogram_options", dash.no_update, session_dict=session_dict, old_value=json.dumps(existing_chromatogram_options), no_change_default=dash.no_update)
+    chromatogram_options = _get_resolved_param(resolved_parameters, "chromatogram_options", dash.no_update, old_value=json.dumps(existing_chromatogram_options), no_change_default=dash.no_update)
 
     # Comment
-    comment = _get_param_from_url(search, "", "comment", dash.no_update, session_dict=session_dict, old_value=existing_comment, no_change_default=dash.no_update)
+    comment = _get_resolved_param(resolved_parameters, "comment", dash.no_update, old_value=existing_comment, no_change_default=dash.no_update)
 
     # Advanced Visualization Options
-    map_plot_color_scale = _get_param_from_url(search, "", "map_plot_color_scale", dash.no_update, session_dict=session_dict, old_value=existing_map_plot_color_scale, no_change_default=dash.no_update)
-    map_plot_quantization_level = _get_param_from_url(search, "", "map_plot_quantization_level", dash.no_update, session_dict=session_dict, old_value=existing_map_plot_quantization_level, no_change_default=dash.no_update)
+    map_plot_color_scale = _get_resolved_param(resolved_parameters, "map_plot_color_scale", dash.no_update, old_value=existing_map_plot_color_scale, no_change_default=dash.no_update)
+    map_plot_quantization_level = _get_resolved_param(resolved_parameters, "map_plot_quantization_level", dash.no_update, old_value=existing_map_plot_quantization_level, no_change_default=dash.no_update)
 
-    plot_theme = _get_param_from_url(search, "", "plot_theme", dash.no_update, session_dict=session_dict, old_value=existing_plot_theme, no_change_default=dash.no_update)
+    plot_theme = _get_resolved_param(resolved_parameters, "plot_theme", dash.no_update, old_value=existing_plot_theme, no_change_default=dash.no_update)
 
     # Formatting the types
     try:
@@ -2166,34 +2318,23 @@ def _parse_usis(usi_string):
                 Output('upload_status', 'children'),
               ],
               [
-                Input('url', 'search'), 
-                Input('url', 'hash'), 
+                Input('resolved_parameters', 'data'),
                 Input('upload-data1', 'contents'),
                 Input('upload-data2', 'isCompleted'),
-                Input('sychronization_load_session_button', 'n_clicks'),
-                Input('sychronization_interval', 'n_intervals'),
-                Input('advanced_import_update_button', "n_clicks"),
-                Input('auto_import_parameters', 'children')
               ],
               [
                   State('upload-data1', 'filename'),
                   State('upload-data2', 'fileNames'),
                   State('upload-data2', 'upload_id'),
-                  State('sychronization_session_id', 'value'),
-
-                  State('setting_json_area', 'value'),
 
                   State('usi', 'value'),
                   State('usi_select', 'value'), 
                   State('usi2', 'value'),
               ])
-def update_usi(search, url_hash, 
+def update_usi(resolved_parameters, 
                 uploadfile1_filecontent_list,
                 uploadfile2_iscompleted, 
-                sychronization_load_session_button_clicks, sychronization_interval, advanced_import_update_button, auto_import_parameters, 
                 uploadfile1_filename_list, uploadfile2_filenames, uploadfile2_uploadid, 
-                sychronization_session_id,
-                setting_json_area, 
                 existing_usi,
                 existing_usi_select,
                 existing_usi2):
@@ -2232,30 +2373,11 @@ def update_usi(search, url_hash,
         usi_options, usi_select = _parse_usis(usi.lstrip())
         return [usi.lstrip(), usi2.lstrip(), dash.no_update, upload_message]
 
-    session_dict = {}
-
-    if "sychronization_load_session_button" in triggered_id or "sychronization_interval" in triggered_id:
-        try:
-            session_dict = _sychronize_load_state(sychronization_session_id, redis_client)
-        except:
-            pass
-
-    # We clicked the button so we are going to load from the text area
-    if "advanced_import_update_button" in triggered_id:
-        try:
-            session_dict = json.loads(setting_json_area)
-        except:
-            pass
-
-    if "auto_import_parameters" in triggered_id:
-        try:
-            session_dict = json.loads(auto_import_parameters)
-        except:
-            pass
+    resolved_parameters = _get_triggered_parameters(resolved_parameters, triggered_id)
 
     # Resolving USI
-    usi = _get_param_from_url(search, url_hash, "usi", usi, session_dict=session_dict, old_value=existing_usi, no_change_default=dash.no_update)
-    usi2 = _get_param_from_url(search, url_hash, "usi2", usi2, session_dict=session_dict, old_value=existing_usi2, no_change_default=dash.no_update)
+    usi = _get_resolved_param(resolved_parameters, "usi", usi, old_value=existing_usi, no_change_default=dash.no_update, use_hash=True)
+    usi2 = _get_resolved_param(resolved_parameters, "usi2", usi2, old_value=existing_usi2, no_change_default=dash.no_update, use_hash=True)
 
     return [usi, usi2, "Using URL USI", dash.no_update]
     
@@ -2264,47 +2386,20 @@ def update_usi(search, url_hash,
                 Output('usi_select', 'value'),
              ],
               [
-                Input('url', 'search'),
-                Input('url', 'hash'), 
+                Input('resolved_parameters', 'data'),
                 Input('usi', 'value'),
-                Input('sychronization_load_session_button', 'n_clicks'),
-                Input('sychronization_interval', 'n_intervals'),
-                Input('advanced_import_update_button', "n_clicks"),
-                Input('auto_import_parameters', 'children'),
               ], 
               [
                   State('usi_select', 'value'),
-                  State('sychronization_session_id', 'value'),
-
-                  State('setting_json_area', 'value'),
               ])
-def update_usi_options(search, url_hash, usi, sychronization_load_session_button_clicks, sychronization_interval, advanced_import_update_button, auto_import_parameters, 
-                        existing_usi_select, sychronization_session_id, setting_json_area):
+def update_usi_options(resolved_parameters, usi, existing_usi_select):
     usi_options, usi_select = _parse_usis(usi)
 
     triggered_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
 
-    session_dict = {}
-    if "sychronization_load_session_button" in triggered_id or "sychronization_interval" in triggered_id:
-        try:
-            session_dict = _sychronize_load_state(sychronization_session_id, redis_client)
-        except:
-            pass
-
-    # We clicked the button so we are going to load from the text area
-    if "advanced_import_update_button" in triggered_id:
-        try:
-            session_dict = json.loads(setting_json_area)
-        except:
-            pass
-
-    if "auto_import_parameters" in triggered_id:
-        try:
-            session_dict = json.loads(auto_import_parameters)
-        except:
-            pass
+    resolved_parameters = _get_triggered_parameters(resolved_parameters, triggered_id)
 
-    usi_select = _get_param_from_url(search, url_hash, "usi_select", usi_select, session_dict=session_dict, old_value=existing_usi_select, no_change_default=dash.no_update)
+    usi_select = _get_resolved_param(resolved_parameters, "usi_select", usi_select, old_value=existing_usi_select, no_change_default=dash.no_update, use_hash=True)
 
     return [usi_options, usi_select]
 
@@ -2315,26 +2410,17 @@ def update_usi_options(search, url_hash, usi, sychronization_load_session_button
                 Output('xic_rt_window', 'value'),
               ],
               [
-                Input('url', 'search'),
+                Input('resolved_parameters', 'data'),
                 Input('map-plot', 'clickData'),
-                Input('sychronization_load_session_button', 'n_clicks'),
-                Input('sychronization_interval', 'n_intervals'),
-                Input('advanced_import_update_button', "n_clicks"),
-                Input('auto_import_parameters', 'children'),
                 Input('xicmz_clear_button', "n_clicks"),
                 Input('xic_presets', 'value')
               ], 
               [
                   State('xic_mz', 'value'),
                   State('xic_rt_window', 'value'),
-                  State('sychronization_session_id', 'value'),
-
-                  State('setting_json_area', 'value'),
               ])
-def determine_xic_target(search, clickData, sychronization_load_session_button_clicks, sychronization_interval, 
-                        advanced_import_update_button, auto_import_parameters, xicmz_clear_button, xic_presets,
-                        existing_xic, existing_xic_rt_window, 
-                        sychronization_session_id, setting_json_area):
+def determine_xic_target(resolved_parameters, clickData, xicmz_clear_button, xic_presets,
+                        existing_xic, existing_xic_rt_window):
     triggered_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
 
     print("TRIGGERED XIC MZ", triggered_id, file=sys.stderr)
@@ -2392,30 +2478,12 @@ def determine_xic_target(search, clickData, sychronization_load_session_button_c
     except:
         pass
 
-    session_dict = {}
-    if "sychronization_load_session_button" in triggered_id or "sychronization_interval" in triggered_id:
-        try:
-            session_dict = _sychronize_load_state(sychronization_session_id, redis_client)
-        except:
-            pass
+    resolved_parameters = _get_triggered_parameters(resolved_parameters, triggered_id)
 
-    # We clicked the button so we are going to load from the text area
-    if "advanced_import_update_button" in triggered_id:
-        try:
-            session_dict = json.loads(setting_json_area)
-        except:
-            pass
-
-    if "auto_import_parameters" in triggered_id:
-        try:
-            session_dict = json.loads(auto_import_parameters)
-        except:
-            pass
-
-    xic_mz = _get_param_from_url(search, "", "xic_mz", dash.no_update, session_dict=session_dict, old_value=existing_xic, no_change_default=dash.no_update)
-    xic_mz = _get_param_from_url(search, "", "xicmz", xic_mz, session_dict=session_dict, old_value=existing_xic, no_change_default=dash.no_update)
+    xic_mz = _get_resolved_param(resolved_parameters, "xic_mz", dash.no_update, old_value=existing_xic, no_change_default=dash.no_update)
+    xic_mz = _get_resolved_param(resolved_parameters, "xicmz", xic_mz, old_value=existing_xic, no_change_default=dash.no_update)
 
-    xic_rt_window = _get_param_from_url(search, "", "xic_rt_window", dash.no_update, session_dict=session_dict, old_value=existing_xic_rt_window, no_change_default=dash.no_update)
+    xic_rt_window = _get_resolved_param(resolved_parameters, "xic_rt_window", dash.no_update, old_value=existing_xic_rt_window, no_change_default=dash.no_update)
 
     return [xic_mz, xic_rt_window]
 
@@ -2441,15 +2509,11 @@ def _create_map_fig(filename,
         result = tasks.task_lcms_aggregate.delay(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level)
 
         # Waiting
-        while(1):
-            if result.ready():
-                break
-            sleep(0.1)
-        agg_dict, msn_results = result.get()
-        msn_results = pd.DataFrame(msn_results) # This comes as a list, due to serialization
+        agg_dict, msn_results = task_wait.wait_for_result(result)
+        msn_results = lcms_map._decode_columns(msn_results) # This comes packed by column, due to serialization
     else:
         agg_dict, msn_results = tasks.task_lcms_aggregate(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level, cache=False)
-        msn_results = pd.DataFrame(msn_results) # This comes as a list, due to serialization
+        msn_results = lcms_map._decode_columns(msn_results) # This comes packed by column, due to serialization
 
     print("GETTING LCMS AGG", time.time() - start, file=sys.stderr, flush=True)
 
@@ -2492,11 +2556,7 @@ def _perform_feature_finding(filename, feature_finding=None):
         result = tasks.task_featurefinding.delay(filename, json.dumps(feature_finding))
 
         # Waiting
-        while(1):
-            if result.ready():
-                break
-            sleep(1)
-        features_list = result.get()
+        features_list = task_wait.wait_for_result(result)
     else:
         features_list = tasks.task_featurefinding(filename, json.dumps(feature_finding))
 
@@ -2791,11 +2851,7 @@ def _perform_tic(usi, tic_option="TIC", polarity_filter="None"):
         result = tasks.task_tic.delay(local_filename, tic_option=tic_option, polarity_filter=polarity_filter)
 
         # Waiting
-        while(1):
-            if result.ready():
-                break
-            sleep(1)
-        result = result.get()
+        result = task_wait.wait_for_result(result)
         return pd.DataFrame(result)
     else:
         return pd.DataFrame(tasks.task_tic(local_filename, tic_option=tic_option, polarity_filter=polarity_filter))
@@ -2816,89 +2872,35 @@ def _perform_batch_xic(usi_list, usi1_list, usi2_list, xic_norm, all_xic_values,
     GET_MS2 = False
     ms2_data = {}
 
-    xic_df_list = []
-    
-    if _is_worker_up():
-        result_list = []
+    if len(usi_list) == 1 and len(all_xic_values) == 1:
+        GET_MS2 = True
 
+    if _is_worker_up():
+        # One task for the whole batch, it fans out one subtask per file with all the targets
+        usi_filename_list = []
         for usi_element in usi_list:
-            if len(usi_list) == 1 and len(all_xic_values) == 1:
-                GET_MS2 = True
-
-            # Doing it async with tasks
             remote_link, local_filename = _resolve_usi(usi_element)
+            usi_filename_list.append([usi_element, local_filename])
 
-            for xic_value in all_xic_values:
-                result = tasks.task_xic.delay(local_filename, json.dumps([xic_value]), xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=GET_MS2)
-                result_dict = {}
-                result_dict["result"] = result
-                result_dict["usi_element"] = usi_element
-                result_list.append(result_dict)
+        result = tasks.task_batch_xic.delay(usi_filename_list, usi1_list, xic_norm, json.dumps(all_xic_values), xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
 
-        # Waiting
-        for result_dict in result_list:
-            result = result_dict["result"]
-            usi_element = result_dict["usi_element"]
-            while(1):
-                if result.ready():
-                    break
-                sleep(0.5)
-
-            # Waiting on results
-            xic_list, ms2_data = result.get()
-            xic_df = pd.DataFrame(xic_list)
-
-            xic_dict = {}
-            xic_dict["df"] = xic_df
-            xic_dict["usi"] = usi_element
-            xic_df_list.append(xic_dict)
+        # Big batches share the background lane, by their deadline they come back with whatever files are done
+        batch_timeout = task_wait.CONVERSION_TIMEOUT if len(usi_filename_list) > tasks.BATCH_BACKGROUND_FILES else task_wait.DEFAULT_TIMEOUT
+        long_records, ms2_data = task_wait.wait_for_result(result, timeout=batch_timeout)
+        merged_df_long = pd.DataFrame(long_records)
 
     else:
+        df_long_list = []
         for usi_element in usi_list:
-            if len(usi_list) == 1 and len(all_xic_values) == 1:
-                GET_MS2 = True
-            
             # Doing it all local
             xic_df, ms2_data = _perform_xic(usi_element, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=GET_MS2)
 
-            xic_dict = {}
-            xic_dict["df"] = xic_df
-            xic_dict["usi"] = usi_element
-            xic_df_list.append(xic_dict)
-    
-    # Performing Normalization and formatting
-    df_long_list = []
-    for xic_dict in xic_df_list:
-        try:
-            xic_df = xic_dict["df"]
-            usi_element = xic_dict["usi"]
-
-            # Performing Normalization only if we have multiple XICs available
-            if xic_norm is True:
-                try:
-                    for key in xic_df.columns:
-                        if key == "rt":
-                            continue
-                        xic_df[key] = xic_df[key] / max(xic_df[key])
-                except:
-                    pass
-
-            # Formatting for Plotting
-            target_names = list(xic_df.columns)
-            target_names.remove("rt")
-            df_long = pd.melt(xic_df, id_vars="rt", value_vars=target_names)
-            df_long["USI"] = usi_element
-
-            if usi_element in usi1_list:
-                df_long["GROUP"] = "TOP"
-            else:
-                df_long["GROUP"] = "BOTTOM"
-
-            df_long_list.append(df_long)
-        except:
-            pass
+            try:
+                df_long_list.append(xic.xic_long_format(xic_df, usi_element, usi1_list, xic_norm=xic_norm))
+            except:
+                pass
 
-    merged_df_long = pd.concat(df_long_list)
+        merged_df_long = pd.concat(df_long_list)
 
     # Parsing the metadata if possible
     try:
@@ -3294,15 +3296,11 @@ def draw_xic(   usi,
                 Output("map_plot_mz_max", 'value'),
                 ],
               [
-                Input('url', 'search'), 
+                Input('resolved_parameters', 'data'),
                 Input('usi', 'value'), 
                 Input('usi_select', 'value'), 
                 Input('map-plot', 'relayoutData'),
                 Input('map_plot_update_range_button', 'n_clicks'),
-                Input('sychronization_load_session_button', 'n_clicks'),
-                Input('sychronization_interval', 'n_intervals'),
-                Input('advanced_import_update_button', "n_clicks"),
-                Input('auto_import_parameters', 'children'),
               ],
               [ 
                 State("map_plot_rt_min", 'value'),
@@ -3311,15 +3309,10 @@ def draw_xic(   usi,
                 State("map_plot_mz_max", 'value'),
 
                 State("map_plot_zoom", 'children'),
-
-                State('sychronization_session_id', 'value'),
-
-                State('setting_json_area', 'value'),
               ])
-def determine_plot_zoom_bounds(url_search, usi, usi_select,
-                                map_selection, map_plot_update_range_button, sychronization_load_session_button, sychronization_interval, advanced_import_update_button, auto_import_parameters,
-                                map_plot_rt_min, map_plot_rt_max, map_plot_mz_min, map_plot_mz_max, existing_map_plot_zoom, 
-                                sychronization_session_id, setting_json_area):
+def determine_plot_zoom_bounds(resolved_parameters, usi, usi_select,
+                                map_selection, map_plot_update_range_button,
+                                map_plot_rt_min, map_plot_rt_max, map_plot_mz_min, map_plot_mz_max, existing_map_plot_zoom):
 
     
     print("ALL TRIGGERS", [p['prop_id'] for p in dash.callback_context.triggered], file=sys.stderr, flush=True)
@@ -3329,26 +3322,7 @@ def determine_plot_zoom_bounds(url_search, usi, usi_select,
     plot_usi = utils.determine_usi_to_use(usi, usi_select)
     remote_link, local_filename = _resolve_usi(plot_usi)
 
-    session_dict = {}
-
-    if "sychronization_load_session_button" in triggered_id or "sychronization_interval" in triggered_id:
-        try:
-            session_dict = _sychronize_load_state(sychronization_session_id, redis_client)
-        except:
-            pass
-    
-    # We clicked the button so we are going to load from the text area
-    if "advanced_import_update_button" in triggered_id:
-        try:
-            session_dict = json.loads(setting_json_area)
-        except:
-            pass
-
-    if "auto_import_parameters" in triggered_id:
-        try:
-            session_dict = json.loads(auto_import_parameters)
-        except:
-            pass
+    resolved_parameters = _get_triggered_parameters(resolved_parameters, triggered_id)
 
     priority = "url"
 
@@ -3358,10 +3332,10 @@ def determine_plot_zoom_bounds(url_search, usi, usi_select,
     if "map_plot_update_range_button" in triggered_id:
         priority = "ui_update_range"
     
-    if "sychronization_load_session_button" in triggered_id or "sychronization_interval" in triggered_id or "advanced_import_update_button" in triggered_id or "auto_import_parameters" in triggered_id:
+    if "resolved_parameters" in triggered_id and resolved_parameters["from_session"]:
         priority = "session"
 
-    current_map_selection, highlight_box, min_rt, max_rt, min_mz, max_mz = _resolve_map_plot_selection(url_search, 
+    current_map_selection, highlight_box, min_rt, max_rt, min_mz, max_mz = _resolve_map_plot_selection(resolved_parameters.get("url_search", ""), 
                                                                                                         usi, 
                                                                                                         local_filename, 
                                                                                                         ui_map_selection=map_selection,
@@ -3369,7 +3343,7 @@ def determine_plot_zoom_bounds(url_search, usi, usi_select,
                                                                                                         map_plot_rt_max=map_plot_rt_max,
                                                                                                         map_plot_mz_min=map_plot_mz_min,
                                                                                                         map_plot_mz_max=map_plot_mz_max, 
-                                                                                                        session_dict=session_dict,
+                                                                                                        session_dict=resolved_parameters["session"],
                                                                                                         priority=priority)
 
     current_map_plot_zoom_string = json.dumps(current_map_selection)
@@ -3406,6 +3380,12 @@ def render_initial_file_load(usi, usi_select, usi2):
     usi_list = usi1_list + usi2_list
     usi_list = usi_list[:MAX_LCMS_FILES]
 
+    # Getting all the files going, so later plots only touch prepared data
+    try:
+        _prefetch_usis(usi_list)
+    except:
+        print("PREFETCH SCHEDULING FAILED", file=sys.stderr, flush=True)
+
     status = html.H6([dbc.Badge("Ready", color="success", className="ml-1")])
     if len(usi1_list) > 0:
         try:
@@ -3432,6 +3412,51 @@ def render_initial_file_load(usi, usi_select, usi2):
     return [status]
 
 
+@app.callback([Output('file_readiness', 'children'), Output('file_readiness_interval', 'disabled')],
+              [
+                  Input('file_readiness_interval', 'n_intervals'),
+                  Input('usi', 'value'), 
+                  Input('usi2', 'value')
+              ])
+def render_file_readiness(n_intervals, usi, usi2):
+    triggered_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
+
+    usi1_list = usi.split("\n")
+    usi2_list = usi2.split("\n")
+
+    usi1_list = [usi for usi in usi1_list if len(usi) > 8] # Filtering out empty USIs
+    usi2_list = [usi for usi in usi2_list if len(usi) > 8] # Filtering out empty USIs
+    
+    usi_list = usi1_list + usi2_list
+    usi_list = usi_list[:MAX_LCMS_FILES]
+
+    if len(usi_list) == 0:
+        return [[html.Summary(html.H6([dbc.Badge("Ready", color="success", className="ml-1")], style={"display": "inline"}))], True]
+
+    all_readiness = [_file_readiness(usi) for usi in usi_list]
+    ready_count = len([readiness for readiness in all_readiness if readiness == "Ready"])
+    failed_count = len([readiness for readiness in all_readiness if readiness == "Failed"])
+
+    if ready_count == len(usi_list):
+        badge_color = "success"
+    elif failed_count > 0:
+        badge_color = "danger"
+    else:
+        badge_color = "warning"
+
+    file_rows = [html.Tr([html.Td(download._get_usi_display_filename(usi)), html.Td(readiness)]) for usi, readiness in zip(usi_list, all_readiness)]
+
+    # Nothing left to change once every file is done, entering files again polls again.
+    # Failed files are only retried after this runs for the new entry, so that one keeps polling
+    all_done = ready_count + failed_count == len(usi_list)
+    stop_polling = all_done and triggered_id == "file_readiness_interval.n_intervals"
+
+    # Only the children are replaced, so the details stay open or closed across ticks
+    return [[
+        html.Summary(html.H6([dbc.Badge("{}/{} Ready".format(ready_count, len(usi_list)), color=badge_color, className="ml-1")], style={"display": "inline"})),
+        dbc.Table(html.Tbody(file_rows), size="sm")
+    ], stop_polling]
+
 # Inspiration for structure from
 # https://github.com/plotly/dash-datashader
 # https://community.plotly.com/t/heatmap-is-slow-for-large-data-arrays/21007/2
@@ -4334,7 +4359,10 @@ def get_file_summary(usi, usi2):
     usi_list = usi1_list + usi2_list
     usi_list = usi_list[:MAX_LCMS_FILES]
 
-    all_file_stats = [_calculate_file_stats(usi, _resolve_usi(usi)[1]) for usi in usi_list]
+    # Resolving in parallel, files the prefetch already prepared return right away
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=PREFETCH_PARALLELISM) as executor:
+        all_file_stats = list(executor.map(lambda usi: _calculate_file_stats(usi, _resolve_usi(usi)[1]), usi_list))
     stats_df = pd.DataFrame(all_file_stats)     
     stats_df["Download"] = "DOWNLOAD"
     stats_df["Image"] = "Image"
@@ -4491,17 +4519,9 @@ def get_new_token(search, synchronization_leader_newtoken_button, sychronization
         if len(synchronization_leader_token) > 0:
             return [dash.no_update, "Please delete your token to get a new one"]
         else:
-            try:
-                session_dict = _sychronize_load_state(sychronization_session_id, redis_client)
-            except:
-                session_dict = {}
-
-            if session_dict.get("synchronization_token", None) is None:
-                # There exists no token, let's create one and save it
-                new_token = str(uuid.uuid4()).replace("-", "")
-                session_dict["synchronization_token"] = new_token
-                _sychronize_save_state(sychronization_session_id, session_dict, redis_client)
-
+            # There exists no token, let's create one and save it, unless someone else got there first
+            new_token = str(uuid.uuid4()).replace("-", "")
+            if _sychronize_claim_token(sychronization_session_id, new_token, redis_client):
                 return [new_token, "New Session Token Updated"]
             else:
                 # There exists a token
@@ -4570,13 +4590,40 @@ def set_update_interval(synchronization_begin_button, synchronization_stop_butto
         status_text = "Sync Stopped"
         return [new_interval, status_text]
 
-    # We know we're the follower, so lets act like it
+    # We know we're the follower, so lets act like it, the ticks only read the state version
     if synchronization_type == "FOLLOWER" or synchronization_type == "COLLAB":
-        new_interval = 5 * 1000
+        new_interval = 1 * 1000
         status_text = "Sync Started"
 
     return [new_interval, status_text]
 
+@app.callback([
+                Output('sychronization_version', 'children'),
+              ],
+              [
+                  Input('sychronization_interval', 'n_intervals'),
+              ],
+              [
+                  State('sychronization_session_id', 'value'),
+                  State('sychronization_version', 'children'),
+              ])
+def check_synchronization_version(sychronization_interval, sychronization_session_id, existing_sychronization_version):
+    # Only a changed version lets the synced fields reload, the fields themselves are loaded server side by resolve_parameters
+    if sychronization_interval == 0 or not sychronization_session_id:
+        return [dash.no_update]
+
+    existing_version = _synchronize_parse_version(existing_sychronization_version)
+
+    version = _sychronize_load_version(sychronization_session_id, redis_client)
+    if existing_version.get("session_id", None) == sychronization_session_id and existing_version.get("version", 0) == version:
+        return [dash.no_update]
+
+    sychronization_version = {}
+    sychronization_version["session_id"] = sychronization_session_id
+    sychronization_version["version"] = version
+
+    return [json.dumps(sychronization_version)]
+
 ###########################################
 # Hiding Panels
 ###########################################
@@ -4760,18 +4807,29 @@ def preview():
     if os.path.exists(target_preview_image):
         return send_from_directory(os.path.join(TEMPFOLDER, "image_previews"), os.path.basename(target_preview_image))
 
-    cmd = 'export LC_ALL=C && ./bin/msaccess {} -o {} -x "image" '.format(local_filename, temp_result_folder)
-    os.system(cmd)
+    # Drawing it from the map pyramid, msaccess is only a fallback
+    start_time = time.time()
+    try:
+        map_pyramid.render_preview_png(local_filename, target_preview_image)
+        print("PREVIEW PYRAMID", time.time() - start_time, file=sys.stderr, flush=True)
+    except Exception as e:
+        print("PREVIEW PYRAMID NOT USED", e, file=sys.stderr, flush=True)
+
+        if not utils.MSACCESS_ENABLED:
+            raise
 
-    result_filename = glob.glob(os.path.join(temp_result_folder, "*.png"))[0]
+        cmd = 'export LC_ALL=C && ./bin/msaccess {} -o {} -x "image" '.format(local_filename, temp_result_folder)
+        os.system(cmd)
 
-    # Copying image
-    shutil.copyfile(result_filename, target_preview_image)
+        result_filename = glob.glob(os.path.join(temp_result_folder, "*.png"))[0]
 
-    # Remove temp folder
-    shutil.rmtree(temp_result_folder)
+        # Copying image
+        shutil.copyfile(result_filename, target_preview_image)
+
+        # Remove temp folder
+        shutil.rmtree(temp_result_folder)
+        print("PREVIEW MSACCESS", time.time() - start_time, file=sys.stderr, flush=True)
 
-    # Lets create a preview with msaccess
     return send_from_directory(os.path.join(TEMPFOLDER, "image_previews"), os.path.basename(target_preview_image))
 
 @server.route("/settingsdownload")
@@ -4822,6 +4880,20 @@ def shorturlresolve():
 
 # TODO: Make APIs for XIC etc. 
 
+@server.route("/cachestats")
+def cachestats():
+    try:
+        return json.dumps(cache.cache.get_stats())
+    except:
+        return json.dumps({})
+
+@server.route("/lanestats")
+def lanestats():
+    try:
+        return json.dumps(priority_lanes.get_lane_stats())
+    except:
+        return json.dumps({})
+
 # Logo
 @server.route("/logo.png")
 def logo():
@@ -0,0 +1,300 @@
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+from flask_caching.backends.base import BaseCache
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024 # 2GB
+
+class MemoryLRUCache(BaseCache):
+    """
+    Keeps pickled values in process memory, evicting the least recently used once the byte budget is exceeded
+
+    Use with CACHE_TYPE "cache_backend.MemoryLRUCache" and CACHE_LRU_MAX_BYTES
+    """
+
+    def __init__(self, default_timeout=300, max_bytes=DEFAULT_MAX_BYTES):
+        super(MemoryLRUCache, self).__init__(default_timeout)
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict() # key -> (expires, pickled value)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(dict(max_bytes=config.get("CACHE_LRU_MAX_BYTES", DEFAULT_MAX_BYTES)))
+        return cls(*args, **kwargs)
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        if timeout > 0:
+            return time.time() + timeout
+        return 0
+
+    def _remove(self, key):
+        expires, data = self._entries.pop(key)
+        self.current_bytes -= len(data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires, data = entry
+            if expires != 0 and expires < time.time():
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        # Never going to fit
+        if len(data) > self.max_bytes:
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (self._expires(timeout), data)
+            self.current_bytes += len(data)
+
+            while self.current_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout=timeout)
+
+    def delete(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+        return True
+
+    def has(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            expires, data = entry
+            return expires == 0 or expires >= time.time()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+        return True
+
+    def get_stats(self):
+        stats = {}
+        stats["hits"] = self.hits
+        stats["misses"] = self.misses
+        stats["evictions"] = self.evictions
+        stats["entries"] = len(self._entries)
+        stats["bytes"] = self.current_bytes
+        stats["max_bytes"] = self.max_bytes
+
+        return stats
+
+# The bookkeeping runs as scripts, so two workers missing or evicting the same key can't both take its size off the total
+_FORGET_SCRIPT = """
+local size = redis.call('HGET', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[1])
+if size then
+    redis.call('DECRBY', KEYS[3], size)
+end
+return size
+"""
+
+_SET_SCRIPT = """
+local old_size = redis.call('HGET', KEYS[1], ARGV[1]) or 0
+local timeout = tonumber(ARGV[3])
+if timeout > 0 then
+    redis.call('SET', KEYS[5], ARGV[2], 'EX', timeout)
+    redis.call('ZADD', KEYS[4], tonumber(ARGV[4]) + timeout, ARGV[1])
+else
+    redis.call('SET', KEYS[5], ARGV[2])
+    redis.call('ZREM', KEYS[4], ARGV[1])
+end
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1])
+redis.call('HSET', KEYS[1], ARGV[1], string.len(ARGV[2]))
+redis.call('INCRBY', KEYS[3], string.len(ARGV[2]) - old_size)
+"""
+
+# Entries redis expired are swept first, they only count against the budget until then.
+# Then the least recently used go until we are under the budget
+_EVICT_SCRIPT = """
+local function forget(key)
+    local size = redis.call('HGET', KEYS[1], key)
+    redis.call('HDEL', KEYS[1], key)
+    redis.call('ZREM', KEYS[2], key)
+    redis.call('ZREM', KEYS[4], key)
+    if size then
+        redis.call('DECRBY', KEYS[3], size)
+    end
+end
+
+local expired = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', ARGV[2])
+for i, key in ipairs(expired) do
+    redis.call('DEL', ARGV[3] .. key)
+    forget(key)
+end
+
+local evictions = 0
+while tonumber(redis.call('GET', KEYS[3]) or '0') > tonumber(ARGV[1]) do
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, 0)
+    if #oldest == 0 then
+        -- Nothing left to account for
+        redis.call('SET', KEYS[3], 0)
+        break
+    end
+    redis.call('DEL', ARGV[3] .. oldest[1])
+    forget(oldest[1])
+    evictions = evictions + 1
+end
+
+if evictions > 0 then
+    redis.call('HINCRBY', KEYS[5], 'evictions', evictions)
+end
+return evictions
+"""
+
+class RedisLRUCache(BaseCache):
+    """
+    Same byte budgeted LRU, but in redis so all the gunicorn workers share the hits
+
+    Recency is a sorted set scored by last access time, sizes are kept in a hash so evictions can update the byte total,
+    and expiry times in another sorted set so values redis expired stop counting.
+    The redis instance is shared with celery, so we evict ourselves instead of relying on maxmemory-policy
+
+    Use with CACHE_TYPE "cache_backend.RedisLRUCache", CACHE_REDIS_HOST, CACHE_REDIS_PORT, CACHE_REDIS_DB and CACHE_LRU_MAX_BYTES
+    """
+
+    def __init__(self, host="localhost", port=6379, db=0, default_timeout=300, max_bytes=DEFAULT_MAX_BYTES, key_prefix="lrucache:"):
+        super(RedisLRUCache, self).__init__(default_timeout)
+        import redis
+
+        self.max_bytes = max_bytes
+        self.key_prefix = key_prefix
+
+        self._recency_key = key_prefix + "__recency"
+        self._sizes_key = key_prefix + "__sizes"
+        self._bytes_key = key_prefix + "__bytes"
+        self._stats_key = key_prefix + "__stats"
+        self._expiry_key = key_prefix + "__expiry"
+
+        self._set_client(redis.Redis(host=host, port=port, db=db))
+
+    def _set_client(self, client):
+        self._client = client
+        self._forget_script = client.register_script(_FORGET_SCRIPT)
+        self._set_script = client.register_script(_SET_SCRIPT)
+        self._evict_script = client.register_script(_EVICT_SCRIPT)
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(dict(
+            host=config.get("CACHE_REDIS_HOST", "localhost"),
+            port=config.get("CACHE_REDIS_PORT", 6379),
+            db=config.get("CACHE_REDIS_DB", 0),
+            max_bytes=config.get("CACHE_LRU_MAX_BYTES", DEFAULT_MAX_BYTES),
+            key_prefix=config.get("CACHE_KEY_PREFIX") or "lrucache:",
+        ))
+        return cls(*args, **kwargs)
+
+    def _data_key(self, key):
+        return self.key_prefix + key
+
+    def _forget(self, key):
+        # Dropping the bookkeeping for a key whose value is gone
+        self._forget_script(keys=[self._sizes_key, self._recency_key, self._bytes_key, self._expiry_key], args=[key])
+
+    def get(self, key):
+        data = self._client.get(self._data_key(key))
+
+        if data is None:
+            self._client.hincrby(self._stats_key, "misses", 1)
+            # The value may have expired under us
+            self._forget(key)
+            return None
+
+        pipe = self._client.pipeline()
+        # Only if it is still there, an eviction in between shouldn't bring it back
+        pipe.zadd(self._recency_key, {key: time.time()}, xx=True)
+        pipe.hincrby(self._stats_key, "hits", 1)
+        pipe.execute()
+
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        # Never going to fit
+        if len(data) > self.max_bytes:
+            return False
+
+        timeout = self._normalize_timeout(timeout)
+        self._set_script(keys=[self._sizes_key, self._recency_key, self._bytes_key, self._expiry_key, self._data_key(key)], args=[key, data, timeout, time.time()])
+
+        self._evict()
+
+        return True
+
+    def _evict(self):
+        self._evict_script(keys=[self._sizes_key, self._recency_key, self._bytes_key, self._expiry_key, self._stats_key], args=[self.max_bytes, time.time(), self.key_prefix])
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout=timeout)
+
+    def delete(self, key):
+        deleted_count = self._client.delete(self._data_key(key))
+        self._forget(key)
+
+        return deleted_count > 0
+
+    def has(self, key):
+        return self._client.exists(self._data_key(key)) > 0
+
+    def clear(self):
+        all_keys = [self._data_key(key.decode()) for key in self._client.hkeys(self._sizes_key)]
+        all_keys += [self._recency_key, self._sizes_key, self._bytes_key, self._expiry_key]
+        self._client.delete(*all_keys)
+
+        return True
+
+    def get_stats(self):
+        raw_stats = self._client.hgetall(self._stats_key)
+
+        stats = {}
+        stats["hits"] = int(raw_stats.get(b"hits", 0))
+        stats["misses"] = int(raw_stats.get(b"misses", 0))
+        stats["evictions"] = int(raw_stats.get(b"evictions", 0))
+        stats["entries"] = self._client.zcard(self._recency_key)
+        stats["bytes"] = int(self._client.get(self._bytes_key) or 0)
+        stats["max_bytes"] = self.max_bytes
+
+        return stats
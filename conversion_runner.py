@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import signal
+import tempfile
+import subprocess
+
+# Per step limits, celery kills the whole task at 480s so the steps have to finish well before that
+DEFAULT_TIMEOUT = 300
+DEFAULT_MEMORY_LIMIT = int(os.environ.get("LCMS_CONVERSION_MEMORY_LIMIT", 6 * 1024 * 1024 * 1024)) # resident bytes, summed over the process tree
+DEFAULT_CPU_LIMIT = int(os.environ.get("LCMS_CONVERSION_CPU_LIMIT", 3600)) # cpu seconds per process, all its threads count
+POLL_INTERVAL = 0.5
+KILL_GRACE = 5 # seconds between terminate and kill
+STDERR_TAIL = 4000 # characters of stderr kept in errors
+
+METRICS_FILENAME = os.path.join("logs", "conversion_metrics.jsonl")
+
+class ConversionStepFailed(Exception):
+    pass
+
+def _limit_cpu(cpu_limit):
+    # Runs in the child before exec, memory is watched from outside since mono reserves far more address space than it uses
+    def _set_limits():
+        import resource
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit))
+
+    return _set_limits
+
+def _process_tree(pid):
+    import psutil
+
+    try:
+        parent = psutil.Process(pid)
+        return [parent] + parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+def _tree_rss(pid):
+    import psutil
+
+    rss = 0
+    for process in _process_tree(pid):
+        try:
+            rss += process.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+def _kill_tree(p):
+    """
+    Terminates the process group, then kills whatever is left of the tree, including children that started their own group
+    """
+    import psutil
+
+    # Our own child is reaped through Popen, so its exit code isn't lost to psutil
+    children = _process_tree(p.pid)[1:]
+
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+    try:
+        p.wait(timeout=KILL_GRACE)
+    except subprocess.TimeoutExpired:
+        pass
+
+    gone, alive = psutil.wait_procs(children, timeout=1)
+    for process in alive:
+        try:
+            process.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+    p.wait()
+
+def _record_metric(metric):
+    print("CONVERSION STEP", json.dumps(metric), file=sys.stderr, flush=True)
+
+    try:
+        with open(METRICS_FILENAME, "a") as o:
+            o.write(json.dumps(metric) + "\n")
+    except:
+        pass
+
+def run_step(step_name, cmd, timeout=DEFAULT_TIMEOUT, memory_limit=DEFAULT_MEMORY_LIMIT, cpu_limit=DEFAULT_CPU_LIMIT, check=True):
+    """
+    Runs one external conversion step in its own process group, killing the whole tree when it goes past its deadline or memory
+
+    Args:
+        step_name ([type]): name for the metrics and errors, e.g. msconvert
+        cmd ([type]): shell command
+        timeout ([type], optional): seconds. Defaults to DEFAULT_TIMEOUT.
+        memory_limit ([type], optional): resident bytes of the whole tree. Defaults to DEFAULT_MEMORY_LIMIT.
+        cpu_limit ([type], optional): cpu seconds per process. Defaults to DEFAULT_CPU_LIMIT.
+        check (bool, optional): raise ConversionStepFailed on a nonzero exit. Defaults to True.
+
+    Returns:
+        [type]: exit code
+    """
+    start_time = time.time()
+    peak_rss = 0
+    outcome = "ok"
+
+    with tempfile.TemporaryFile() as stderr_file:
+        p = subprocess.Popen(cmd, shell=True, stderr=stderr_file, start_new_session=True, preexec_fn=_limit_cpu(cpu_limit))
+
+        while p.poll() is None:
+            if time.time() - start_time > timeout:
+                outcome = "timeout"
+                _kill_tree(p)
+                break
+
+            try:
+                peak_rss = max(peak_rss, _tree_rss(p.pid))
+            except:
+                pass
+
+            if memory_limit is not None and peak_rss > memory_limit:
+                outcome = "memory"
+                _kill_tree(p)
+                break
+
+            try:
+                p.wait(timeout=POLL_INTERVAL)
+            except subprocess.TimeoutExpired:
+                pass
+
+        return_code = p.returncode
+        if outcome == "ok" and return_code != 0:
+            outcome = "failed"
+
+        stderr_file.seek(0)
+        stderr_text = stderr_file.read().decode(errors="replace")[-STDERR_TAIL:]
+
+    metric = {}
+    metric["step"] = step_name
+    metric["duration"] = time.time() - start_time
+    metric["outcome"] = outcome
+    metric["return_code"] = return_code
+    metric["peak_rss"] = peak_rss
+    _record_metric(metric)
+
+    if outcome != "ok":
+        print("CONVERSION STEP STDERR", step_name, stderr_text, file=sys.stderr, flush=True)
+
+        if check:
+            raise ConversionStepFailed("{} {} after {:.1f}s (exit {}): {}".format(step_name, outcome, metric["duration"], return_code, stderr_text[-500:]))
+
+    return return_code
@@ -1,6 +1,7 @@
 import pandas as pd
 import requests
 import uuid
+import hashlib
 import werkzeug
 import os
 import sys
@@ -11,12 +12,26 @@ from download_msv import _resolve_msv_usi
 from download_workbench import _resolve_metabolomicsworkbench_usi
 import download_zenodo
 import download_glycopost
+import download_manager
+import spectrum_index
+import peak_store
+import conversion_runner
+import single_flight
+import resolution_cache
 
 try:
     import utils_conversion
 except:
     pass
 
+# Per step deadlines of the external converters, a raw file runs both within the conversion task time limit
+RAW_PARSER_TIMEOUT = 240
+MSCONVERT_TIMEOUT = 200
+
+# Overridable so the resolvers can be pointed at a stub server
+GNPS_URL = os.environ.get("LCMS_GNPS_URL", "https://gnps.ucsd.edu")
+PROTEOMECENTRAL_URL = os.environ.get("LCMS_PROTEOMECENTRAL_URL", "http://proteomecentral.proteomexchange.org")
+
 def _get_usi_display_filename(usi):
     usi_splits = usi.split(":")
 
@@ -76,6 +91,7 @@ def _usi_to_local_filename(usi):
     return converted_local_filename
 
 
+@resolution_cache.cached("gnps")
 def _resolve_gnps_usi(usi):
     usi_splits = usi.split(':')
 
@@ -93,7 +109,7 @@ def _resolve_gnps_usi(usi):
         print("Library Entry")
         # Lets find the provenance file
         accession = usi_splits[4]
-        url = "https://gnps.ucsd.edu/ProteoSAFe/SpectrumCommentServlet?SpectrumID={}".format(accession)
+        url = "{}/ProteoSAFe/SpectrumCommentServlet?SpectrumID={}".format(GNPS_URL, accession)
         r = requests.get(url)
         spectrum_dict = r.json()
         task = spectrum_dict["spectruminfo"]["task"]
@@ -151,6 +167,7 @@ def _resolve_glycopost_usi(usi):
     return remote_link
 
 
+@resolution_cache.cached("pxd")
 def _resolve_pxd_usi(usi):
     usi_splits = usi.split(':')
 
@@ -158,7 +175,7 @@ def _resolve_pxd_usi(usi):
     dataset_accession = usi_splits[1]
     filename = usi_splits[2]
 
-    lookup_url = f"http://proteomecentral.proteomexchange.org/cgi/GetDataset?ID={dataset_accession}&outputMode=json&test=no"
+    lookup_url = f"{PROTEOMECENTRAL_URL}/cgi/GetDataset?ID={dataset_accession}&outputMode=json&test=no"
     lookup_request = requests.get(lookup_url)
     resolution_json = lookup_request.json()
 
@@ -275,6 +292,15 @@ def _usi_to_ccms_path(usi):
     if "PXD" in usi_splits[1]:
         return None
 
+def _build_spectrum_index(converted_local_filename):
+    """
+    Builds the sidecar spectrum index, if this fails everything still works by parsing the mzML
+    """
+    try:
+        spectrum_index.build_spectrum_index(converted_local_filename)
+    except:
+        print("SPECTRUM INDEX FAILED", converted_local_filename, file=sys.stderr, flush=True)
+
 def _resolve_exists_local(usi, temp_folder="temp"):
     usi_splits = usi.split(":")
 
@@ -287,11 +313,25 @@ def _resolve_exists_local(usi, temp_folder="temp"):
     return False
 
 
+def _get_flight_key(usi, temp_folder="temp"):
+    return "convert:" + os.path.join(temp_folder, _usi_to_local_filename(usi))
+
+def get_resolve_progress(usi, temp_folder="temp"):
+    """
+    How far along the download and conversion of the usi is, None if nobody is working on it
+    """
+    return single_flight.get_progress(_get_flight_key(usi, temp_folder=temp_folder))
+
+def report_resolve_progress(usi, message, temp_folder="temp"):
+    single_flight.report_progress(_get_flight_key(usi, temp_folder=temp_folder), message)
+
 # Returns remote_link and local filepath
 def _resolve_usi(usi, temp_folder="temp", cleanup=True):
     """
     This code attempts to resolve the USI and make sure the files are converted to open formats
 
+    Concurrent calls for the same file share a single download and conversion
+
     Args:
         usi ([type]): [description]
         temp_folder (str, optional): [description]. Defaults to "temp".
@@ -302,11 +342,23 @@ def _resolve_usi(usi, temp_folder="temp", cleanup=True):
         string: local path of the converted filename
     """
 
+    converted_local_filename = os.path.join(temp_folder, _usi_to_local_filename(usi))
+
+    # Only call if does not exists
+    if os.path.exists(converted_local_filename):
+        return "", converted_local_filename
+
+    remote_link, converted_local_filename = single_flight.run(_get_flight_key(usi, temp_folder=temp_folder), _download_convert_usi, usi, temp_folder=temp_folder, cleanup=cleanup)
+
+    return remote_link, converted_local_filename
+
+def _download_convert_usi(usi, temp_folder="temp", cleanup=True):
     usi_splits = usi.split(":")
 
     converted_local_filename = os.path.join(temp_folder, _usi_to_local_filename(usi))
+    flight_key = _get_flight_key(usi, temp_folder=temp_folder)
 
-    # Only call if does not exists
+    # Somebody else finished it while we were waiting
     if os.path.exists(converted_local_filename):
         return "", converted_local_filename
 
@@ -318,13 +370,14 @@ def _resolve_usi(usi, temp_folder="temp", cleanup=True):
             temp_filename = os.path.join(temp_folder, str(uuid.uuid4()) + ".mzML")
             # Lets do a conversion
             if file_extension.lower() == ".cdf":
-                _convert_cdf_to_mzML(local_filename, temp_filename)
+                _convert_cdf_to_mzML(local_filename, temp_filename, peak_store_filename=converted_local_filename)
             elif file_extension.lower() == ".raw":
                 _convert_raw_to_mzML(local_filename, temp_filename)
             else:
-                _convert_mzML(local_filename, temp_filename)
+                _convert_mzML(local_filename, temp_filename, peak_store_filename=converted_local_filename)
 
             os.rename(temp_filename, converted_local_filename)
+            _build_spectrum_index(converted_local_filename)
 
             # Cleanup
             try:
@@ -341,23 +394,49 @@ def _resolve_usi(usi, temp_folder="temp", cleanup=True):
     import sys
     print("DEBUG: Remote Link", remote_link, file=sys.stderr, flush=True)
 
+    if resource_name == "ZENODO" and download_zenodo.is_mzml_member(usi):
+        # mzML out of a zip goes straight to the converted file, without a raw copy and an msconvert pass over it
+        single_flight.report_progress(flight_key, "Streaming")
+
+        temp_filename = os.path.join(temp_folder, str(uuid.uuid4()) + ".mzML")
+        try:
+            download_zenodo.stream_zenodo_member(usi, temp_filename)
+            os.rename(temp_filename, converted_local_filename)
+        except:
+            # A partial mzML is useless, nobody would pick it up again under a random name
+            try:
+                os.remove(temp_filename)
+            except:
+                pass
+            raise
+
+        single_flight.report_progress(flight_key, "Indexing")
+        _build_spectrum_index(converted_local_filename)
+        single_flight.report_progress(flight_key, "Done")
+
+        return remote_link, converted_local_filename
+
     # Getting Data Local, TODO: likely should serialize it
     local_filename = os.path.join(temp_folder, "temp_" + str(uuid.uuid4()) + "_" + werkzeug.utils.secure_filename(remote_link)[-150:])
     filename, file_extension = os.path.splitext(local_filename)
 
-    temp_filename = os.path.join(temp_folder, str(uuid.uuid4()) + file_extension)
+    # Named after the link, so an interrupted download of the same file is resumed
+    temp_filename = os.path.join(temp_folder, "partial_" + hashlib.sha1(remote_link.encode()).hexdigest() + file_extension)
     
+    single_flight.report_progress(flight_key, "Downloading")
+
     if resource_name == "GLYCOPOST":
         download_glycopost.download_glycopost(usi, remote_link, temp_filename)
 
     elif resource_name == "ZENODO":
         download_zenodo.download_zenodo(usi, remote_link, temp_filename)
-        
-    elif "https://ftp.pride.ebi.ac.uk/" in remote_link:
-        # We are getting it from PRIDE, so lets try to do it in parallel
-        wget_cmd = "lftp -e 'pget -n 15 -c \"{}\" -o {};; exit'".format(remote_link, temp_filename)
 
-        os.system(wget_cmd)
+    elif remote_link.startswith("http"):
+        # Parallel ranges where the server supports it, PRIDE included
+        def _report_download(completed_chunks, total_chunks):
+            single_flight.report_progress(flight_key, "Downloading {}/{}".format(completed_chunks, total_chunks))
+
+        download_manager.download_file(remote_link, temp_filename, referer=remote_link, progress_callback=_report_download)
     else:
         wget_cmd = "wget '{}' --referer '{}' -O {} 2> /dev/null".format(remote_link, remote_link, temp_filename)
         
@@ -365,19 +444,24 @@ def _resolve_usi(usi, temp_folder="temp", cleanup=True):
 
     os.rename(temp_filename, local_filename)
 
+    single_flight.report_progress(flight_key, "Converting")
+
     temp_filename = os.path.join(temp_folder, str(uuid.uuid4()) + ".mzML")
-    # Lets do a conversion
-    # TODO: Setting timeouts to kill child processes
+    # Lets do a conversion, the external converters are killed past their deadlines
     if file_extension.lower() == ".cdf":
-        _convert_cdf_to_mzML(local_filename, temp_filename)
+        _convert_cdf_to_mzML(local_filename, temp_filename, peak_store_filename=converted_local_filename)
     elif file_extension.lower() == ".raw":
         _convert_raw_to_mzML(local_filename, temp_filename)
     else:
-        _convert_mzML(local_filename, temp_filename)
+        _convert_mzML(local_filename, temp_filename, peak_store_filename=converted_local_filename)
 
     # Renaming the temp
     os.rename(temp_filename, converted_local_filename)
 
+    single_flight.report_progress(flight_key, "Indexing")
+    _build_spectrum_index(converted_local_filename)
+    single_flight.report_progress(flight_key, "Done")
+
     # Cleanup
     try:
         if local_filename != converted_local_filename and cleanup:
@@ -396,23 +480,28 @@ def _convert_raw_to_mzML(input_raw, output_mzML, cleanup=True):
     output_directory = "temp"
     thermo_converted_filename = os.path.join(output_directory, os.path.splitext(os.path.basename(input_raw))[0] + ".mzML")
 
-    import subprocess
     conversion_cmd = ["mono", "/src/bin/x64/Debug/ThermoRawFileParser.exe", "-i={}".format(input_raw), "-o={}".format(output_directory), "-f=1"]
-    subprocess.check_call(" ".join(conversion_cmd), shell=True)
+    conversion_runner.run_step("thermorawfileparser", " ".join(conversion_cmd), timeout=RAW_PARSER_TIMEOUT)
 
     #conversion_cmd = "export LC_ALL=C && ./bin/msconvert {} --mzML --32 --outfile {} --outdir {} --filter 'threshold count 500 most-intense'".format(thermo_converted_filename, output_mzML, os.path.dirname(output_mzML))
     conversion_cmd = "export LC_ALL=C && ./bin/msconvert {} --mzML --32 --outfile {} --outdir {} --filter 'threshold absolute 1 most-intense' --filter 'msLevel 1-4'".format(thermo_converted_filename, output_mzML, os.path.dirname(output_mzML))
-    os.system(conversion_cmd)
-
-    # Cleaning up
-    if thermo_converted_filename != output_mzML and cleanup:
-        os.remove(thermo_converted_filename)
+    try:
+        conversion_runner.run_step("msconvert", conversion_cmd, timeout=MSCONVERT_TIMEOUT)
+    finally:
+        # Cleaning up, also when msconvert didn't make it
+        if thermo_converted_filename != output_mzML and cleanup:
+            try:
+                os.remove(thermo_converted_filename)
+            except:
+                pass
 
 
 # First try msconvert, if the output fails, then we will do pyteomics to mzML and then msconvert
-def _convert_mzML(input_mzXML, output_mzML):
+def _convert_mzML(input_mzXML, output_mzML, peak_store_filename=None):
     """
     This will convert mzXML and mzML to mzML
+
+    When msconvert can't read the mzXML we write the mzML ourselves, and the peak store for peak_store_filename along with it
     """
 
     # These are old versions of the convert
@@ -423,7 +512,15 @@ def _convert_mzML(input_mzXML, output_mzML):
 
     conversion_cmd = "export LC_ALL=C && ./bin/msconvert {} --mzML --32 --outfile {} --outdir {} --filter 'threshold absolute 1 most-intense' --filter 'msLevel 1-4'".format(input_mzXML, output_mzML, os.path.dirname(output_mzML))
 
-    conversion_ret_code = os.system(conversion_cmd)
+    # Not raised, a failed msconvert is handled by the fallbacks below
+    conversion_ret_code = conversion_runner.run_step("msconvert", conversion_cmd, timeout=MSCONVERT_TIMEOUT, check=False)
+
+    # A killed msconvert leaves a truncated file behind, which must not pass as the conversion
+    if conversion_ret_code != 0:
+        try:
+            os.remove(output_mzML)
+        except:
+            pass
 
     filename, file_extension = os.path.splitext(input_mzXML)
 
@@ -455,69 +552,80 @@ def _convert_mzML(input_mzXML, output_mzML):
 
         from psims.mzml.writer import MzMLWriter
         from pyteomics import mzxml, auxiliary
+        import numpy as np
 
         temp_filename = os.path.join("temp", str(uuid.uuid4()) + ".mzML")
 
-        previous_ms1_scan = 0
         with MzMLWriter(open(temp_filename, 'wb')) as out:
             out.controlled_vocabularies()
             with out.run(id="my_analysis"):
                 with out.spectrum_list(count=1000):
-                    # Iterating through all scans in the reader
-                    try:
-                        with mzxml.read(input_mzXML) as reader:
-                            for spectrum in reader:
-                                ms_level = spectrum["msLevel"]
-
-                                if len(spectrum["intensity array"]) == 0:
-                                    continue
-
-                                if ms_level == 1:
-                                    out.write_spectrum(
+                    def _write_scans():
+                        previous_ms1_scan = 0
+                        spectrum_position = 0
+
+                        # Iterating through all scans in the reader
+                        try:
+                            with mzxml.read(input_mzXML) as reader:
+                                for spectrum in reader:
+                                    ms_level = spectrum["msLevel"]
+
+                                    if len(spectrum["intensity array"]) == 0:
+                                        continue
+
+                                    if ms_level == 1:
+                                        out.write_spectrum(
+                                                spectrum["m/z array"], spectrum["intensity array"],
+                                                id=spectrum["id"], params=[
+                                                    "MS1 Spectrum",
+                                                    {"ms level": 1},
+                                                    {"total ion current": sum(spectrum["intensity array"])}
+                                                ],
+                                                scan_start_time=spectrum["retentionTime"])
+
+                                        previous_ms1_scan = spectrum["id"]
+
+                                        # psims marks spectra as positive scans unless told otherwise, the store has to agree with the mzML
+                                        yield spectrum_position, spectrum["retentionTime"], 1, spectrum_index.POLARITY_POS, spectrum["m/z array"], spectrum["intensity array"]
+                                    else:
+                                        out.write_spectrum(
                                             spectrum["m/z array"], spectrum["intensity array"],
                                             id=spectrum["id"], params=[
-                                                "MS1 Spectrum",
-                                                {"ms level": 1},
+                                                "MSn Spectrum",
+                                                {"ms level": 2},
                                                 {"total ion current": sum(spectrum["intensity array"])}
                                             ],
-                                            scan_start_time=spectrum["retentionTime"])
-
-                                    previous_ms1_scan = spectrum["id"]
-                                else:
-                                    out.write_spectrum(
-                                        spectrum["m/z array"], spectrum["intensity array"],
-                                        id=spectrum["id"], params=[
-                                            "MSn Spectrum",
-                                            {"ms level": 2},
-                                            {"total ion current": sum(spectrum["intensity array"])}
-                                        ],
-                                        scan_start_time=spectrum["retentionTime"],
-                                        # Include precursor information
-                                        precursor_information={
-                                            "mz": spectrum["precursorMz"][0]["precursorMz"],
-                                            "intensity": spectrum["precursorMz"][0]["precursorIntensity"],
-                                            "charge": 0,
-                                            "scan_id": previous_ms1_scan,
-                                            "activation": ["beam-type collisional dissociation", {"collision energy": spectrum["collisionEnergy"]}],
-                                        })
-                    except:
-                        print("Reading Failed, skipping to end")
-                        pass
-
-                            
-        # Round trip through MsConvert
-        #conversion_cmd = "export LC_ALL=C && ./bin/msconvert {} --mzML --32 --outfile {} --outdir {} --filter 'threshold count 500 most-intense'".format(temp_filename, output_mzML, os.path.dirname(output_mzML))
-        conversion_cmd = "export LC_ALL=C && ./bin/msconvert {} --mzML --32 --outfile {} --outdir {} --filter 'threshold absolute 1 most-intense' --filter 'msLevel 1-4'".format(temp_filename, output_mzML, os.path.dirname(output_mzML))
-
-        conversion_ret_code = os.system(conversion_cmd)
-
+                                            scan_start_time=spectrum["retentionTime"],
+                                            # Include precursor information
+                                            precursor_information={
+                                                "mz": spectrum["precursorMz"][0]["precursorMz"],
+                                                "intensity": spectrum["precursorMz"][0]["precursorIntensity"],
+                                                "charge": 0,
+                                                "scan_id": previous_ms1_scan,
+                                                "activation": ["beam-type collisional dissociation", {"collision energy": spectrum["collisionEnergy"]}],
+                                            })
+
+                                        # Same as the mzML reader, the peak store only keeps MS1 peaks
+                                        yield spectrum_position, spectrum["retentionTime"], 2, spectrum_index.POLARITY_POS, np.zeros(0), np.zeros(0)
+
+                                    spectrum_position += 1
+                        except:
+                            print("Reading Failed, skipping to end")
+                            pass
+
+                    _write_scans_and_peak_store(_write_scans(), peak_store_filename)
+
+        # psims already writes indexed mzML, so no round trip through msconvert, the peak store we just wrote lines up with these spectra
         try:
-            os.remove(temp_filename)
+            os.rename(temp_filename, output_mzML)
         except:
             pass
 
 # in python doing a conversion from cdf to mzML
-def _convert_cdf_to_mzML(input_cdf, output_mzML):
+def _convert_cdf_to_mzML(input_cdf, output_mzML, peak_store_filename=None):
+    """
+    Writes the netCDF scans to mzML, and when peak_store_filename is given the peak store for it in the same pass, so it doesn't have to be parsed back out of the mzML
+    """
     from netCDF4 import Dataset
     from psims.mzml.writer import MzMLWriter
     import numpy as np
@@ -547,26 +655,32 @@ def _convert_cdf_to_mzML(input_cdf, output_mzML):
         out.controlled_vocabularies()
         with out.run(id="my_analysis"):
             with out.spectrum_list(count=len(scan_indcs)):
-                # Iterating through all scans in the reader
-                try:
-                    # reading through scans
-                    for i, scan_range in enumerate(scan_indcs):
-                        time_min_rt = time_values[i] / 60
-
-                        _mz_array = np.array(mass_values[scan_range[0]:scan_range[1]])
-                        _i_array = np.array(intensity_values[scan_range[0]:scan_range[1]])
-                        
-                        out.write_spectrum(
-                            _mz_array, _i_array,
-                            id="scan={}".format(i), params=[
-                                "MS1 Spectrum",
-                                {"ms level": 1},
-                                {"total ion current": sum(_i_array)}
-                            ],
-                            scan_start_time=time_min_rt)
-                except:
-                    print("Reading Failed, skipping to end")
-                    pass
+                def _write_scans():
+                    # Iterating through all scans in the reader
+                    try:
+                        # reading through scans
+                        for i, scan_range in enumerate(scan_indcs):
+                            time_min_rt = time_values[i] / 60
+
+                            _mz_array = mass_values[scan_range[0]:scan_range[1]]
+                            _i_array = intensity_values[scan_range[0]:scan_range[1]]
+                            
+                            out.write_spectrum(
+                                _mz_array, _i_array,
+                                id="scan={}".format(i), params=[
+                                    "MS1 Spectrum",
+                                    {"ms level": 1},
+                                    {"total ion current": sum(_i_array)}
+                                ],
+                                scan_start_time=time_min_rt)
+
+                            # psims marks spectra as positive scans unless told otherwise, the store has to agree with the mzML
+                            yield i, time_min_rt, 1, spectrum_index.POLARITY_POS, _mz_array, _i_array
+                    except:
+                        print("Reading Failed, skipping to end")
+                        pass
+
+                _write_scans_and_peak_store(_write_scans(), peak_store_filename)
 
     # # Round trip through MsConvert
     # conversion_cmd = "export LC_ALL=C && ./bin/msconvert {} --mzML --32 --outfile {} --outdir {} --filter 'threshold count 500 most-intense'".format(temp_filename, output_mzML, os.path.dirname(output_mzML))
@@ -582,3 +696,13 @@ def _convert_cdf_to_mzML(input_cdf, output_mzML):
     except:
         pass
 
+def _write_scans_and_peak_store(scan_iterator, peak_store_filename=None):
+    """
+    Drives a generator that writes mzML spectra, handing what it yields to the peak store writer when we want one
+    """
+    if peak_store_filename is None:
+        for scan in scan_iterator:
+            pass
+        return
+
+    peak_store._write_peak_store(peak_store_filename, scan_iterator)
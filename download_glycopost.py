@@ -1,6 +1,5 @@
-import os
+import download_manager
 
 def download_glycopost(usi, remote_link, output_filename):
-    wget_cmd = "wget '{}' --referer '{}' -O {} --no-check-certificate 2> /dev/null".format(remote_link, remote_link, temp_filename)
-
-    os.system(wget_cmd)
\ No newline at end of file
+    # GlycoPost certificates don't always verify
+    download_manager.download_file(remote_link, output_filename, referer=remote_link, verify=False)
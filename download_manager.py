@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import time
+import threading
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+
+# Limits are per process, every celery worker process has its own
+MAX_CONNECTIONS_PER_HOST = 8
+CHUNK_SIZE = 32 * 1024 * 1024 # Size of each ranged request
+READ_SIZE = 1024 * 1024
+MIN_PARALLEL_SIZE = 2 * CHUNK_SIZE # Smaller files are not worth splitting
+CHUNK_RETRIES = 5
+TIMEOUT = (30, 120) # Connect and read timeouts
+
+_sessions = {}
+_host_semaphores = {}
+_registry_lock = threading.Lock()
+
+def _get_host(url):
+    return urllib.parse.urlparse(url).netloc
+
+def _get_session(url):
+    """
+    One pooled session per host, so connections are reused across downloads
+    """
+    host = _get_host(url)
+    with _registry_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            retry = Retry(total=CHUNK_RETRIES, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["HEAD", "GET"])
+            adapter = HTTPAdapter(pool_connections=MAX_CONNECTIONS_PER_HOST, pool_maxsize=MAX_CONNECTIONS_PER_HOST, max_retries=retry)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+
+        return _sessions[host]
+
+def _get_host_semaphore(url):
+    host = _get_host(url)
+    with _registry_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+
+        return _host_semaphores[host]
+
+def _probe(url, headers, verify):
+    """
+    Finds the final url, the size and whether the server does ranges, size is None when the server doesn't say
+    """
+    session = _get_session(url)
+
+    # Asking for the first byte works on servers that don't answer HEAD properly
+    probe_headers = dict(headers)
+    probe_headers["Range"] = "bytes=0-0"
+    with _get_host_semaphore(url):
+        r = session.get(url, headers=probe_headers, stream=True, allow_redirects=True, verify=verify, timeout=TIMEOUT)
+        r.close()
+    r.raise_for_status()
+
+    if r.status_code == 206 and "Content-Range" in r.headers:
+        total_size = int(r.headers["Content-Range"].split("/")[-1])
+        return r.url, total_size, True
+
+    content_length = r.headers.get("Content-Length")
+    total_size = int(content_length) if content_length is not None else None
+
+    return r.url, total_size, False
+
+def _get_parts_filename(output_filename):
+    return output_filename + ".parts"
+
+def _load_completed_parts(output_filename, total_size):
+    # The parts file only counts if it is for a file of the same size
+    try:
+        with open(_get_parts_filename(output_filename)) as f:
+            parts = json.loads(f.read())
+        if parts["total_size"] == total_size and os.path.exists(output_filename):
+            return set(parts["completed"])
+    except:
+        pass
+
+    return set()
+
+def _save_completed_parts(output_filename, total_size, completed):
+    temp_parts_filename = _get_parts_filename(output_filename) + ".tmp"
+    with open(temp_parts_filename, "w") as o:
+        o.write(json.dumps({"total_size": total_size, "completed": sorted(completed)}))
+    os.replace(temp_parts_filename, _get_parts_filename(output_filename))
+
+def _fetch_range(url, headers, verify, output_filename, start, end):
+    """
+    Writes bytes start to end inclusive at their offset, retrying from where it stopped
+    """
+    session = _get_session(url)
+    position = start
+
+    for attempt in range(CHUNK_RETRIES):
+        try:
+            range_headers = dict(headers)
+            range_headers["Range"] = "bytes={}-{}".format(position, end)
+
+            with _get_host_semaphore(url):
+                with session.get(url, headers=range_headers, stream=True, verify=verify, timeout=TIMEOUT) as r:
+                    if r.status_code != 206:
+                        raise Exception("Expected partial content, got {}".format(r.status_code))
+
+                    with open(output_filename, "r+b") as o:
+                        o.seek(position)
+                        for data in r.iter_content(chunk_size=READ_SIZE):
+                            o.write(data)
+                            position += len(data)
+
+            if position == end + 1:
+                return
+        except Exception as e:
+            print("DOWNLOAD CHUNK RETRY", url, start, attempt, e, file=sys.stderr, flush=True)
+            time.sleep(2 ** attempt)
+
+    raise Exception("Download of bytes {}-{} failed for {}".format(start, end, url))
+
+def _download_parallel(url, headers, verify, output_filename, total_size, max_workers, progress_callback=None):
+    chunk_starts = list(range(0, total_size, CHUNK_SIZE))
+
+    completed = _load_completed_parts(output_filename, total_size)
+    if len(completed) == 0:
+        # Preallocating, so chunks can be written in any order
+        with open(output_filename, "wb") as o:
+            o.truncate(total_size)
+    else:
+        print("DOWNLOAD RESUMING", url, len(completed), "of", len(chunk_starts), file=sys.stderr, flush=True)
+
+    pending = [chunk_index for chunk_index in range(len(chunk_starts)) if chunk_index not in completed]
+    progress_lock = threading.Lock()
+
+    def _fetch_chunk(chunk_index):
+        start = chunk_starts[chunk_index]
+        end = min(start + CHUNK_SIZE, total_size) - 1
+        _fetch_range(url, headers, verify, output_filename, start, end)
+
+        with progress_lock:
+            completed.add(chunk_index)
+            _save_completed_parts(output_filename, total_size, completed)
+            print("DOWNLOAD PROGRESS", url, "{}/{}".format(len(completed), len(chunk_starts)), file=sys.stderr, flush=True)
+
+            if progress_callback is not None:
+                progress_callback(len(completed), len(chunk_starts))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # list() so exceptions from chunks are raised here
+        list(executor.map(_fetch_chunk, pending))
+
+def _download_stream(url, headers, verify, output_filename, total_size, supports_ranges):
+    session = _get_session(url)
+
+    # Picking up a partial file if the server lets us
+    position = 0
+    if supports_ranges and os.path.exists(output_filename):
+        position = os.path.getsize(output_filename)
+
+    if total_size is not None and position == total_size:
+        return
+
+    # Bigger than the file is now, so it isn't a piece of it
+    if total_size is not None and position > total_size:
+        print("DOWNLOAD DISCARDING PARTIAL", url, position, total_size, file=sys.stderr, flush=True)
+        position = 0
+
+    stream_headers = dict(headers)
+    if position > 0:
+        stream_headers["Range"] = "bytes={}-".format(position)
+        print("DOWNLOAD RESUMING", url, position, file=sys.stderr, flush=True)
+
+    with _get_host_semaphore(url):
+        with session.get(url, headers=stream_headers, stream=True, verify=verify, timeout=TIMEOUT) as r:
+            r.raise_for_status()
+
+            # Servers may ignore the range and send everything, or send a range that isn't ours, then we start over
+            if position > 0 and (r.status_code != 206 or not r.headers.get("Content-Range", "").startswith("bytes {}-".format(position))):
+                print("DOWNLOAD RANGE IGNORED, RESTARTING", url, r.status_code, file=sys.stderr, flush=True)
+                position = 0
+
+            with open(output_filename, "ab" if position > 0 else "wb") as o:
+                for data in r.iter_content(chunk_size=READ_SIZE):
+                    o.write(data)
+
+def _remove_partial(output_filename):
+    for filename in [output_filename, _get_parts_filename(output_filename)]:
+        try:
+            os.remove(filename)
+        except:
+            pass
+
+def _lock_download(lock_filename):
+    """
+    Takes the lock file, the one we locked has to still be the one at the path, since the holder before us removes it when done
+    """
+    import fcntl
+
+    while True:
+        lock_file = open(lock_filename, "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_filename).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+
+        lock_file.close()
+
+def _unlock_download(lock_filename, lock_file):
+    # Removing it while still holding it, so nobody else is in between
+    try:
+        os.remove(lock_filename)
+    except:
+        pass
+    lock_file.close()
+
+def download_file(url, output_filename, referer=None, verify=True, max_workers=MAX_CONNECTIONS_PER_HOST, progress_callback=None):
+    """
+    Downloads over http, in parallel byte ranges when the server supports them, resuming a previous partial download of the same output
+
+    Args:
+        url ([type]): http or https url
+        output_filename ([type]): where to write, a .parts file next to it tracks finished ranges
+        referer ([type], optional): referer header, some repositories want it. Defaults to None.
+        verify (bool, optional): check the certificate. Defaults to True.
+        max_workers ([type], optional): parallel ranges for this file. Defaults to MAX_CONNECTIONS_PER_HOST.
+        progress_callback ([type], optional): called with finished and total chunks of a parallel download. Defaults to None.
+
+    Returns:
+        [type]: output_filename
+    """
+    start_time = time.time()
+
+    headers = {}
+    if referer is not None:
+        headers["Referer"] = referer
+
+    # Partial files are named after the link, so two downloads of the same link, in any process, take turns
+    lock_filename = output_filename + ".lock"
+    lock_file = _lock_download(lock_filename)
+
+    try:
+        final_url, total_size, supports_ranges = _probe(url, headers, verify)
+
+        if supports_ranges and total_size is not None and total_size >= MIN_PARALLEL_SIZE and max_workers > 1:
+            _download_parallel(final_url, headers, verify, output_filename, total_size, max_workers, progress_callback=progress_callback)
+        else:
+            _download_stream(final_url, headers, verify, output_filename, total_size, supports_ranges)
+
+        downloaded_size = os.path.getsize(output_filename)
+        if total_size is not None and downloaded_size != total_size:
+            # Not worth resuming, it would fail the same way on every later attempt
+            _remove_partial(output_filename)
+            raise Exception("Downloaded {} bytes of {} for {}".format(downloaded_size, total_size, url))
+    finally:
+        _unlock_download(lock_filename, lock_file)
+
+    try:
+        os.remove(_get_parts_filename(output_filename))
+    except:
+        pass
+
+    print("DOWNLOADED", url, downloaded_size, time.time() - start_time, file=sys.stderr, flush=True)
+
+    return output_filename
@@ -3,7 +3,12 @@ import os
 import sys
 from urllib.parse import quote, quote_plus
 
+import resolution_cache
 
+# Overridable so the resolvers can be pointed at a stub server
+MASSIVE_URL = os.environ.get("LCMS_MASSIVE_URL", "https://massive.ucsd.edu")
+
+@resolution_cache.cached("msv")
 def _resolve_msv_usi(usi, force_massive=False):
     """
 
@@ -21,7 +26,7 @@ def _resolve_msv_usi(usi, force_massive=False):
     if len(usi.split(":")) == 3:
         msv_usi = "{}:scan:1".format(usi)
     
-    lookup_url = f'https://massive.ucsd.edu/ProteoSAFe/QuerySpectrum?id={msv_usi}'
+    lookup_url = f'{MASSIVE_URL}/ProteoSAFe/QuerySpectrum?id={msv_usi}'
     lookup_request = requests.get(lookup_url)
 
     try:
@@ -47,13 +52,13 @@ def _resolve_msv_usi(usi, force_massive=False):
 
         # Format into HTTPS
         fileparameters = quote(remote_path)
-        remote_link = f"https://massive.ucsd.edu/ProteoSAFe/DownloadResultFile?forceDownload=true&file={fileparameters}"
+        remote_link = f"{MASSIVE_URL}/ProteoSAFe/DownloadResultFile?forceDownload=true&file={fileparameters}"
     except:
         # We did not successfully look it up, this is the fallback try
         if force_massive:
             #return f"ftp://massive.ucsd.edu/{usi_splits[1]}/{usi_splits[2]}"
             fileparameter = quote(f"f.{usi_splits[1]}/{usi_splits[2]}")
-            remote_link = f"https://massive.ucsd.edu/ProteoSAFe/DownloadResultFile?forceDownload=true&file={fileparameter}"
+            remote_link = f"{MASSIVE_URL}/ProteoSAFe/DownloadResultFile?forceDownload=true&file={fileparameter}"
         else:
             raise
 
@@ -1,6 +1,12 @@
+import os
 import requests
+import download_msv
+import resolution_cache
 from download_msv import _resolve_msv_usi
 
+METABOLOMICSWORKBENCH_URL = os.environ.get("LCMS_METABOLOMICSWORKBENCH_URL", "https://www.metabolomicsworkbench.org")
+
+@resolution_cache.cached("workbench")
 def _resolve_metabolomicsworkbench_usi(usi):
     usi_splits = usi.split(':')
 
@@ -10,7 +16,7 @@ def _resolve_metabolomicsworkbench_usi(usi):
 
     try:
         # Checking if Data is in Metabolomics Workbench
-        dataset_list_url = "https://www.metabolomicsworkbench.org/data/show_archive_contents_json.php?STUDY_ID={}".format(dataset_accession)
+        dataset_list_url = "{}/data/show_archive_contents_json.php?STUDY_ID={}".format(METABOLOMICSWORKBENCH_URL, dataset_accession)
         mw_file_list = requests.get(dataset_list_url).json()
         for file_obj in mw_file_list:
             if filename in file_obj["FILENAME"]:
@@ -31,7 +37,7 @@ def _resolve_metabolomicsworkbench_usi(usi):
         pass
 
     # Checking if Data is in MSV
-    url = "https://massive.ucsd.edu/ProteoSAFe/QueryDatasets?task=N%2FA&file=&pageSize=30&offset=0&query=%257B%2522full_search_input%2522%253A%2522%2522%252C%2522table_sort_history%2522%253A%2522createdMillis_dsc%2522%252C%2522query%2522%253A%257B%257D%252C%2522title_input%2522%253A%2522{}%2522%257D&target=&_=1606254845533".format(dataset_accession)
+    url = download_msv.MASSIVE_URL + "/ProteoSAFe/QueryDatasets?task=N%2FA&file=&pageSize=30&offset=0&query=%257B%2522full_search_input%2522%253A%2522%2522%252C%2522table_sort_history%2522%253A%2522createdMillis_dsc%2522%252C%2522query%2522%253A%257B%257D%252C%2522title_input%2522%253A%2522{}%2522%257D&target=&_=1606254845533".format(dataset_accession)
     r = requests.get(url)
     data_json = r.json()
     
@@ -1,32 +1,49 @@
 import os
+import shutil
 from remotezip import RemoteZip
+import download_manager
+
+READ_SIZE = 1024 * 1024
 
 
 def download_zenodo(usi, remote_link, output_filename):
-    usi_splits = usi.split(':')
     # Example: mzspec:ZENODO-4989929:T2.zip-T2/T2_lysate_ETHCD_1D_2.raw
+    if _get_zip_member(usi) is not None:
+        stream_zenodo_member(usi, output_filename)
+    else:
+        download_manager.download_file(remote_link, output_filename, referer=remote_link, verify=False)
 
-    dataset_accession = usi_splits[1]
-    dataset_accession = dataset_accession.replace("ZENODO-", "")
+
+def _get_zip_member(usi):
+    """
+    The zip link and the member name for a .zip- usi, None if the usi is not in a zip
+    """
+    usi_splits = usi.split(':')
+    dataset_accession = usi_splits[1].replace("ZENODO-", "")
     filename = usi_splits[2]
 
-    if ".zip-" in filename:
-        # we'll just get url to the zip filename
-        zip_filename = filename.split(".zip-")[0] + ".zip"
-        remote_link = "https://zenodo.org/api/records/{}/files/{}/content".format(dataset_accession, zip_filename)
+    if not ".zip-" in filename:
+        return None
 
-        target_filename = filename.split(".zip-")[1]
+    zip_filename = filename.split(".zip-")[0] + ".zip"
+    remote_link = "https://zenodo.org/api/records/{}/files/{}/content".format(dataset_accession, zip_filename)
 
-        with RemoteZip(remote_link) as zip:
-            for zip_info in zip.infolist():
-                if zip_info.filename == target_filename:
-                    zip.extract(zip_info, output_filename)
-                    break
-    else:
-        wget_cmd = "wget '{}' --referer '{}' -O {} --no-check-certificate 2> /dev/null".format(remote_link, remote_link, output_filename)
+    return remote_link, filename.split(".zip-")[1]
+
+def is_mzml_member(usi):
+    zip_member = _get_zip_member(usi)
+    return zip_member is not None and os.path.splitext(zip_member[1])[1].lower() == ".mzml"
 
-        os.system(wget_cmd)
+def stream_zenodo_member(usi, output_filename):
+    """
+    Decompresses the member out of the remote zip while its byte ranges come in, straight into output_filename
+    """
+    remote_link, target_filename = _get_zip_member(usi)
 
+    with RemoteZip(remote_link) as zip:
+        zip_info = zip.getinfo(target_filename)
+        with zip.open(zip_info) as member, open(output_filename, "wb") as o:
+            shutil.copyfileobj(member, o, READ_SIZE)
 
 def _resolve_zenodo_usi(usi):
     usi_splits = usi.split(':')
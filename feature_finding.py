@@ -4,7 +4,7 @@ from utils import _get_scan_polarity
 import uuid
 import os
 import pathlib
-import subprocess
+import conversion_runner
 from massql import msql_engine
 
 
@@ -236,17 +236,7 @@ def _call_feature_finding_tool(cmd, timeout=90):
         timeout (int, optional): [description]. Defaults to 90.
     """
 
-    try:
-        p = subprocess.Popen([cmd], shell=True)
-        p.wait(timeout=timeout)
-        return 0
-    except subprocess.TimeoutExpired:
-        # Killing off child and all other children
-        import psutil
-        parent_pid = p.pid
-        parent = psutil.Process(parent_pid)
-        for child in parent.children(recursive=True):
-            child.kill()
-        parent.kill()
-
-    return 1
\ No newline at end of file
+    # Same deadline and process tree kill as the conversion steps
+    return_code = conversion_runner.run_step("feature_finding", cmd, timeout=timeout, check=False)
+
+    return 0 if return_code == 0 else 1
\ No newline at end of file
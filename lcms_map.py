@@ -1,13 +1,19 @@
 
 import os
+import uuid
 import pymzml
 import numpy as np
 import datashader as ds
 import json
 import pandas as pd
+import pyarrow as pa
 import xarray
 import time
+import zlib
+import base64
 import utils
+import peak_store
+import map_pyramid
 
 import plotly.express as px
 import plotly.graph_objects as go 
@@ -167,19 +173,242 @@ def _get_feather_filenames(filename):
 
     return output_ms1_filename, output_msn_filename
 
+def _get_feather_zones_filename(filename):
+    return filename + ".ms1.zones.feather"
+
+def _ms1_feather_schema(use_scans):
+    return pa.schema([
+        ("mz", pa.float64()),
+        ("rt", pa.float64()),
+        ("i", pa.float64()),
+        ("scan", pa.int64() if use_scans else pa.string()),
+        ("index", pa.int64()),
+        ("polarity", pa.int64()),
+        ("rank", pa.int32()), # Position by intensity within the scan, 0 is the most intense
+    ])
+
+def _ms1_record_batch(schema, batch_columns):
+    arrays = []
+    for field in schema:
+        values = np.concatenate(batch_columns[field.name])
+        if pa.types.is_string(field.type):
+            values = values.astype(str)
+        arrays.append(pa.array(values, type=field.type))
+
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def _ms1_batch_zone(batch_columns):
+    # Zone map entry for a batch, lets window queries skip batches without reading them
+    polarity = np.concatenate(batch_columns["polarity"])
+
+    zone = {}
+    zone["rt_min"] = float(np.min([rt[0] for rt in batch_columns["rt"]]))
+    zone["rt_max"] = float(np.max([rt[0] for rt in batch_columns["rt"]]))
+    zone["mz_min"] = float(np.min([mz.min() for mz in batch_columns["mz"]]))
+    zone["mz_max"] = float(np.max([mz.max() for mz in batch_columns["mz"]]))
+    zone["rows"] = int(len(polarity))
+    zone["has_positive"] = bool(np.any(polarity == POLARITY_POS))
+    zone["has_negative"] = bool(np.any(polarity == POLARITY_NEG))
+
+    return zone
+
+def _write_temp_then_rename(output_filename, write_function):
+    temp_filename = os.path.join(os.path.dirname(output_filename), str(uuid.uuid4()) + ".feather")
+    write_function(temp_filename)
+    os.rename(temp_filename, output_filename)
+
 # These are caching layers for fast loading
-def _save_lcms_data_feather(filename):
+def _save_lcms_data_feather(filename, batch_peaks=100000):
+    """
+    Streams the MS1 peaks into the feather as record batches, memory is bounded by the batch size not the file size
+
+    Within each scan the peaks are sorted by decreasing intensity, so readers can take the top peaks per scan with groupby head
+
+    Args:
+        filename ([type]): converted mzML filename
+        batch_peaks (int, optional): peaks buffered before a batch is written, batches always end on a scan boundary. Defaults to 100000.
+    """
     output_ms1_filename, output_msn_filename = _get_feather_filenames(filename)
-    
-    ms1_results, number_spectra, msn_results = _gather_lcms_data(filename, 0, 1000000, 0, 10000, polarity_filter="None", top_spectrum_peaks=100000, include_polarity=True)
-    ms1_results = ms1_results.sort_values(by='i', ascending=False).reset_index()
 
-    ms1_results.to_feather(output_ms1_filename)
-    msn_results.to_feather(output_msn_filename)
+    run = pymzml.run.Reader(filename, MS_precisions=utils.MS_precisions)
+
+    # Checking the first spectrum to see if we should use scans or nativeIDs
+    use_scans = True
+    for spec in run:
+        if "scan" not in spec.id_dict:
+            use_scans = False
+        break
+    run = pymzml.run.Reader(filename, MS_precisions=utils.MS_precisions)
+
+    schema = _ms1_feather_schema(use_scans)
+    column_names = [field.name for field in schema]
+
+    all_msn_mz = []
+    all_msn_rt = []
+    all_msn_polarity = []
+    all_msn_scan = []
+    all_msn_level = []
+
+    temp_ms1_filename = os.path.join(os.path.dirname(output_ms1_filename), str(uuid.uuid4()) + ".feather")
+    writer = pa.ipc.new_file(temp_ms1_filename, schema, options=pa.ipc.IpcWriteOptions(compression="lz4"))
+
+    batch_columns = {column: [] for column in column_names}
+    buffered_peaks = 0
+    number_spectra = 0
+    all_zones = []
+
+    for spec in run:
+        rt = spec.scan_time_in_minutes()
+
+        scan_polarity = _get_scan_polarity(spec)
+        polarity = POLARITY_POS if scan_polarity == "Positive" else POLARITY_NEG
+
+        if spec.ms_level == 1:
+            number_spectra += 1
+
+            try:
+                peaks = spec.peaks("raw")
+
+                # Filtering out zero rows
+                peaks = peaks[~np.any(peaks < 1.0, axis=1)]
+
+                # Sorting by decreasing intensity
+                peaks = peaks[np.argsort(-peaks[:, 1], kind="stable")]
+
+                spectrum_identifier = _get_spectrum_identifier(spec, use_scans=use_scans)
+            except:
+                continue
+
+            peak_count = len(peaks)
+            if peak_count == 0:
+                continue
+
+            batch_columns["mz"].append(peaks[:, 0])
+            batch_columns["rt"].append(np.full(peak_count, rt, dtype=np.float64))
+            batch_columns["i"].append(peaks[:, 1])
+            batch_columns["scan"].append(np.full(peak_count, spectrum_identifier, dtype=object if not use_scans else np.int64))
+            batch_columns["index"].append(np.full(peak_count, number_spectra, dtype=np.int64))
+            batch_columns["polarity"].append(np.full(peak_count, polarity, dtype=np.int64))
+            batch_columns["rank"].append(np.arange(peak_count, dtype=np.int32))
+            buffered_peaks += peak_count
+
+            if buffered_peaks >= batch_peaks:
+                writer.write_batch(_ms1_record_batch(schema, batch_columns))
+                all_zones.append(_ms1_batch_zone(batch_columns))
+                batch_columns = {column: [] for column in column_names}
+                buffered_peaks = 0
+
+        elif spec.ms_level > 1:
+            try:
+                msn_mz = spec.selected_precursors[0]["mz"]
+
+                all_msn_mz.append(msn_mz)
+                all_msn_rt.append(rt)
+                all_msn_level.append(spec.ms_level)
+                all_msn_scan.append(_get_spectrum_identifier(spec, use_scans=use_scans))
+                all_msn_polarity.append(polarity)
+            except:
+                pass
+
+    if buffered_peaks > 0:
+        writer.write_batch(_ms1_record_batch(schema, batch_columns))
+        all_zones.append(_ms1_batch_zone(batch_columns))
+    writer.close()
+
+    zones_df = pd.DataFrame(all_zones, columns=["rt_min", "rt_max", "mz_min", "mz_max", "rows", "has_positive", "has_negative"])
+    _write_temp_then_rename(_get_feather_zones_filename(filename), zones_df.to_feather)
+
+    msn_results = pd.DataFrame()
+    msn_results["precursor_mz"] = all_msn_mz
+    msn_results["rt"] = all_msn_rt
+    msn_results["scan"] = all_msn_scan
+    msn_results["level"] = all_msn_level
+    msn_results["polarity"] = all_msn_polarity
+
+    # The ms1 feather goes last, its existence marks the conversion as done
+    _write_temp_then_rename(output_msn_filename, msn_results.to_feather)
+    os.rename(temp_ms1_filename, output_ms1_filename)
+
+def _read_msn_feather(msn_filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None"):
+    msn_results = pd.read_feather(msn_filename)
+    msn_results = msn_results[(msn_results["rt"] > min_rt) & (msn_results["rt"] < max_rt) & (msn_results["precursor_mz"] > min_mz) & (msn_results["precursor_mz"] < max_mz)]
+    if polarity_filter == "Positive":
+        msn_results = msn_results[msn_results["polarity"] == POLARITY_POS]
+    elif polarity_filter == "Negative":
+        msn_results = msn_results[msn_results["polarity"] == POLARITY_NEG] 
+
+    return msn_results
+
+def _top_rows_per_scan(ms1_results, top_spectrum_peaks):
+    # Rows of a scan are contiguous and by decreasing intensity, so the rank is just the distance from the first row of the scan
+    scan_values = ms1_results["scan"].values
+    row_positions = np.arange(len(scan_values))
+
+    scan_start = np.ones(len(scan_values), dtype=bool)
+    scan_start[1:] = scan_values[1:] != scan_values[:-1]
+    first_row = np.maximum.accumulate(np.where(scan_start, row_positions, 0))
+
+    return ms1_results[(row_positions - first_row) < top_spectrum_peaks]
+
+def _read_ms1_feather_window(ms1_filename, zones_filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", top_spectrum_peaks=100):
+    """
+    Reads the top peaks per scan in the window from the scan ordered ms1 feather, only the batches the zone map says overlap are read
+
+    Returns:
+        [type]: data frame of the peaks
+    """
+    zones_df = pd.read_feather(zones_filename)
+
+    zone_mask = (zones_df["rt_max"] > min_rt) & (zones_df["rt_min"] < max_rt) & (zones_df["mz_max"] > min_mz) & (zones_df["mz_min"] < max_mz)
+    if polarity_filter == "Positive":
+        zone_mask &= zones_df["has_positive"]
+    elif polarity_filter == "Negative":
+        zone_mask &= zones_df["has_negative"]
+
+    with pa.memory_map(ms1_filename, "r") as source:
+        reader = pa.ipc.open_file(source)
+        batches = [reader.get_batch(int(batch_index)) for batch_index in np.nonzero(zone_mask.values)[0]]
+        ms1_results = pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+
+    # Without an mz restriction the precomputed rank is enough, we drop the rest before any other filtering
+    whole_mz_range = len(zones_df) == 0 or (min_mz <= zones_df["mz_min"].min() and max_mz >= zones_df["mz_max"].max())
+    if whole_mz_range:
+        ms1_results = ms1_results[ms1_results["rank"] < top_spectrum_peaks]
+
+    ms1_results = ms1_results[(ms1_results["rt"] > min_rt) & (ms1_results["rt"] < max_rt) & (ms1_results["mz"] > min_mz) & (ms1_results["mz"] < max_mz)]
+    if polarity_filter == "Positive":
+        ms1_results = ms1_results[ms1_results["polarity"] == POLARITY_POS]
+    elif polarity_filter == "Negative":
+        ms1_results = ms1_results[ms1_results["polarity"] == POLARITY_NEG]
+
+    if not whole_mz_range:
+        ms1_results = _top_rows_per_scan(ms1_results, top_spectrum_peaks)
+
+    return ms1_results.reset_index(drop=True)
 
 def _gather_lcms_data_cached(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None"):
     ms1_filename, msn_filename = _get_feather_filenames(filename)
 
+    # Scan ordered feather with a zone map, only the batches in the window are read and the top peaks per scan are precomputed
+    zones_filename = _get_feather_zones_filename(filename)
+    if os.path.exists(ms1_filename) and os.path.exists(zones_filename):
+        print("FEATHER ZONES PRESENT")
+        ms1_results = _read_ms1_feather_window(ms1_filename, zones_filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
+        msn_results = _read_msn_feather(msn_filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
+        number_spectra = len(set(ms1_results["scan"]))
+
+        return ms1_results, number_spectra, msn_results
+
+    # Conversions from before the zone map, the memory mapped peak store only touches the scans in the window
+    top_peaks = peak_store.gather_top_peaks(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
+    if top_peaks is not None and os.path.exists(msn_filename):
+        print("PEAK STORE PRESENT")
+        ms1_results = pd.DataFrame(top_peaks)
+        msn_results = _read_msn_feather(msn_filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
+        number_spectra = len(np.unique(top_peaks["scan"]))
+
+        return ms1_results, number_spectra, msn_results
+
     delta_rt = max_rt - min_rt
 
     # We don't see the feather files, so lets just do the classic thing
@@ -198,26 +427,13 @@ def _gather_lcms_data_cached(filename, min_rt, max_rt, min_mz, max_mz, polarity_
         ms1_results = ms1_results[ms1_results["polarity"] == POLARITY_NEG] 
     ms1_results = ms1_results.groupby('scan').head(100).reset_index(drop=True) # Getting the top 100 peaks per scan
 
-    msn_results = pd.read_feather(msn_filename)
-    msn_results = msn_results[(msn_results["rt"] > min_rt) & (msn_results["rt"] < max_rt) & (msn_results["precursor_mz"] > min_mz) & (msn_results["precursor_mz"] < max_mz)]
-    if polarity_filter == "Positive":
-        msn_results = msn_results[msn_results["polarity"] == POLARITY_POS]
-    elif polarity_filter == "Negative":
-        msn_results = msn_results[msn_results["polarity"] == POLARITY_NEG] 
+    msn_results = _read_msn_feather(msn_filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
 
     number_spectra = len(set(ms1_results["scan"]))
 
     return ms1_results, number_spectra, msn_results
 
-def _aggregate_lcms_map(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", map_plot_quantization_level="Medium"):
-    import time
-    start_time = time.time()
-    ms1_results, number_spectra, msn_results = _gather_lcms_data_cached(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
-    end_time = time.time()
-    print("READ FILE", end_time - start_time)
-
-    start_time = time.time()
-
+def _map_dimensions(number_spectra, min_mz, max_mz, map_plot_quantization_level="Medium"):
     min_size = min(number_spectra, int(max_mz - min_mz))
     width = max(min(min_size*4, 500), 20)
     height = max(min(int(min_size*1.75), 500), 20)
@@ -233,6 +449,130 @@ def _aggregate_lcms_map(filename, min_rt, max_rt, min_mz, max_mz, polarity_filte
         width = int(width * 2)
         height = int(height * 2)
 
+    return width, height
+
+def _encode_array(values, compress=False):
+    values = np.ascontiguousarray(values)
+    raw_bytes = values.tobytes()
+    if compress:
+        raw_bytes = zlib.compress(raw_bytes, 1)
+
+    encoded = {}
+    encoded["dtype"] = values.dtype.str
+    encoded["shape"] = list(values.shape)
+    encoded["compressed"] = compress
+    encoded["data"] = base64.b64encode(raw_bytes).decode("ascii")
+
+    return encoded
+
+def _decode_array(encoded):
+    raw_bytes = base64.b64decode(encoded["data"])
+    if encoded["compressed"]:
+        raw_bytes = zlib.decompress(raw_bytes)
+
+    return np.frombuffer(raw_bytes, dtype=np.dtype(encoded["dtype"])).reshape(encoded["shape"])
+
+def _encode_agg(agg, compress=True):
+    """
+    Packs the aggregation grid as raw float32 bytes plus the coordinates, so it goes through the celery json backend cheaply
+
+    Args:
+        agg ([type]): 2D xarray with mz and rt dims
+        compress (bool, optional): zlib the grid bytes. Defaults to True.
+
+    Returns:
+        [type]: json serializable dict, turned back into xarray with _decode_agg
+    """
+    payload = {}
+    payload["dims"] = list(agg.dims)
+    payload["values"] = _encode_array(np.asarray(agg.values, dtype=np.float32), compress=compress)
+    payload["coords"] = {dim: _encode_array(np.asarray(agg.coords[dim].values, dtype=np.float64)) for dim in agg.dims}
+
+    return payload
+
+def _decode_agg(payload):
+    values = _decode_array(payload["values"])
+    coords = [(dim, _decode_array(payload["coords"][dim])) for dim in payload["dims"]]
+
+    return xarray.DataArray(values, coords=coords)
+
+def _encode_columns(df):
+    """
+    Packs a data frame column by column, numeric columns as raw bytes and everything else as lists
+    """
+    payload = {}
+    payload["columns"] = list(df.columns)
+    payload["arrays"] = {}
+    payload["lists"] = {}
+
+    for column in df.columns:
+        if np.issubdtype(df[column].dtype, np.number):
+            payload["arrays"][column] = _encode_array(df[column].values)
+        else:
+            payload["lists"][column] = df[column].tolist()
+
+    return payload
+
+def _decode_columns(payload):
+    df = pd.DataFrame()
+    for column in payload["columns"]:
+        if column in payload["arrays"]:
+            df[column] = _decode_array(payload["arrays"][column])
+        else:
+            df[column] = payload["lists"][column]
+
+    return df
+
+def _log_agg_payload(agg):
+    zero_mask = agg.values == 0
+    agg.values = np.log10(agg.values, where=np.logical_not(zero_mask))
+    return _encode_agg(agg)
+
+def _aggregate_lcms_map_pyramid(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", map_plot_quantization_level="Medium"):
+    """
+    Renders the map from the precomputed pyramid without reading peaks, None when the pyramid can't serve this view
+    """
+    ms1_filename, msn_filename = _get_feather_filenames(filename)
+    if not os.path.exists(msn_filename):
+        return None
+
+    loaded_peak_store = peak_store.load_peak_store(filename)
+    if loaded_peak_store is None or map_pyramid.load_pyramid(filename) is None:
+        return None
+
+    scans, mz, intensity = loaded_peak_store
+    number_spectra = len(peak_store.rt_window_scan_positions(scans, min_rt, max_rt, ms_level=1, polarity_filter=polarity_filter))
+    width, height = _map_dimensions(number_spectra, min_mz, max_mz, map_plot_quantization_level=map_plot_quantization_level)
+
+    pyramid_window = map_pyramid.aggregate_window(filename, min_rt, max_rt, min_mz, max_mz, width, height, polarity_filter=polarity_filter)
+    if pyramid_window is None:
+        return None
+
+    values, rt_coords, mz_coords = pyramid_window
+    agg = xarray.DataArray(values, coords=[("mz", mz_coords), ("rt", rt_coords)])
+
+    msn_results = _read_msn_feather(msn_filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
+
+    return _log_agg_payload(agg), msn_results
+
+def _aggregate_lcms_map(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", map_plot_quantization_level="Medium"):
+    import time
+    start_time = time.time()
+
+    # Zoomed out views are sliced from the pyramid, so they cost the number of pixels not the number of peaks
+    pyramid_result = _aggregate_lcms_map_pyramid(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level)
+    if pyramid_result is not None:
+        print("USED PYRAMID", time.time() - start_time)
+        return pyramid_result
+
+    ms1_results, number_spectra, msn_results = _gather_lcms_data_cached(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
+    end_time = time.time()
+    print("READ FILE", end_time - start_time)
+
+    start_time = time.time()
+
+    width, height = _map_dimensions(number_spectra, min_mz, max_mz, map_plot_quantization_level=map_plot_quantization_level)
+
     print("Datashader Len", len(ms1_results))
 
     cvs = ds.Canvas(plot_width=width, plot_height=height)
@@ -241,9 +581,7 @@ def _aggregate_lcms_map(filename, min_rt, max_rt, min_mz, max_mz, polarity_filte
     print("Datashader Agg", time.time() - start_time)
     start_time = time.time()
 
-    zero_mask = agg.values == 0
-    agg.values = np.log10(agg.values, where=np.logical_not(zero_mask))
-    agg_dict = agg.to_dict()
+    agg_dict = _log_agg_payload(agg)
 
     print("Datashader Post Processing", time.time() - start_time)
 
@@ -255,7 +593,7 @@ def _aggregate_lcms_map(filename, min_rt, max_rt, min_mz, max_mz, polarity_filte
 def _create_map_fig(agg_dict, msn_results, map_selection=None, show_ms2_markers=True, polarity_filter="None", highlight_box=None, color_scale="Hot_r", template="plotly_white", ms2marker_color="blue", ms2marker_size=5):
     min_rt, max_rt, min_mz, max_mz = utils._determine_rendering_bounds(map_selection)
     
-    agg = xarray.DataArray.from_dict(agg_dict)
+    agg = _decode_agg(agg_dict)
 
     # Creating the figures
     fig = px.imshow(agg, origin='lower', labels={'color':'Log10(abundance)'}, color_continuous_scale=color_scale, height=600, template=template)
@@ -0,0 +1,284 @@
+import os
+import json
+import uuid
+import numpy as np
+from functools import lru_cache
+
+import peak_store
+from spectrum_index import POLARITY_POS, POLARITY_NEG
+
+# Finest level of the pyramid, every next level halves both axes
+MAX_RT_BINS = 2048
+MAX_MZ_BINS = 4096
+MIN_LEVEL_BINS = 32
+PYRAMID_DTYPE = np.float32
+
+def _get_pyramid_filename(filename):
+    return filename + ".pyramid.json"
+
+def _get_level_filename(filename, level):
+    return filename + ".pyramid.{}.npy".format(level)
+
+def _downsample_grid(grid):
+    # Summing 2x2 blocks, padding odd sizes with zeros
+    polarity_count, rt_bins, mz_bins = grid.shape
+    padded = np.zeros((polarity_count, rt_bins + rt_bins % 2, mz_bins + mz_bins % 2), dtype=grid.dtype)
+    padded[:, :rt_bins, :mz_bins] = grid
+
+    return padded.reshape(polarity_count, padded.shape[1] // 2, 2, padded.shape[2] // 2, 2).sum(axis=(2, 4))
+
+def _top_peaks_mask(peak_scans, peak_intensity, top_spectrum_peaks):
+    # Ranking the peaks by decreasing intensity within their scan, peak_scans has to be non decreasing
+    order = np.lexsort((-peak_intensity, peak_scans))
+    sorted_scans = peak_scans[order]
+
+    row_positions = np.arange(len(order))
+    scan_start = np.ones(len(order), dtype=bool)
+    scan_start[1:] = sorted_scans[1:] != sorted_scans[:-1]
+    first_row = np.maximum.accumulate(np.where(scan_start, row_positions, 0))
+
+    mask = np.zeros(len(order), dtype=bool)
+    mask[order] = (row_positions - first_row) < top_spectrum_peaks
+
+    return mask
+
+def _save_array(output_filename, array):
+    temp_filename = os.path.join(os.path.dirname(output_filename), str(uuid.uuid4()) + ".npy")
+    np.save(temp_filename, array)
+    os.rename(temp_filename, output_filename)
+
+def build_pyramid(filename, chunk_peaks=10000000, top_spectrum_peaks=100):
+    """
+    Precomputes summed intensity grids of rt by mz per polarity from the peak store, at several resolutions
+
+    Args:
+        filename ([type]): converted mzML filename, the peak store has to be built already
+        chunk_peaks (int, optional): peaks binned at once. Defaults to 10000000.
+        top_spectrum_peaks (int, optional): most intense peaks per scan that are binned, same as the datashader path of lcms_map. Defaults to 100.
+
+    Returns:
+        [type]: pyramid metadata filename
+    """
+    loaded_peak_store = peak_store.load_peak_store(filename)
+    if loaded_peak_store is None:
+        raise Exception("Peak store not available")
+
+    scans, mz, intensity = loaded_peak_store
+
+    ms1_scans = scans[(scans["ms_level"] == 1) & (scans["end"] > scans["start"])]
+    if len(ms1_scans) == 0:
+        raise Exception("No MS1 peaks for the pyramid")
+
+    min_rt = float(np.min(ms1_scans["rt"]))
+    max_rt = float(np.max(ms1_scans["rt"]))
+    min_mz = float(np.min(mz))
+    max_mz = float(np.max(mz))
+
+    # No point in having more rt bins than scans
+    rt_bins = int(min(MAX_RT_BINS, len(ms1_scans)))
+    mz_bins = MAX_MZ_BINS
+    rt_step = max(max_rt - min_rt, 1e-6) / rt_bins
+    mz_step = max(max_mz - min_mz, 1e-6) / mz_bins
+
+    polarities = sorted(set(ms1_scans["polarity"].tolist()))
+    polarity_lookup = np.zeros(256, dtype=np.int64)
+    for polarity_index, polarity in enumerate(polarities):
+        polarity_lookup[polarity] = polarity_index
+
+    scan_rt_bins = np.clip(((scans["rt"] - min_rt) / rt_step).astype(np.int64), 0, rt_bins - 1)
+    scan_polarity_index = polarity_lookup[scans["polarity"].astype(np.uint8)]
+    scan_counts = scans["end"] - scans["start"]
+
+    grid = np.zeros((len(polarities), rt_bins, mz_bins), dtype=PYRAMID_DTYPE)
+
+    # The peaks of consecutive scans are contiguous, so we bin them a chunk at a time
+    scan_ends = scans["end"]
+    chunk_start = 0
+    while chunk_start < len(scans):
+        chunk_end = int(np.searchsorted(scan_ends, scans["start"][chunk_start] + chunk_peaks, side="right"))
+        chunk_end = max(chunk_end, chunk_start + 1)
+
+        counts = scan_counts[chunk_start:chunk_end]
+        peaks_start = int(scans["start"][chunk_start])
+        peaks_end = int(scans["end"][chunk_end - 1])
+
+        if peaks_end > peaks_start:
+            peak_rt_bins = np.repeat(scan_rt_bins[chunk_start:chunk_end], counts)
+            peak_polarity_index = np.repeat(scan_polarity_index[chunk_start:chunk_end], counts)
+            peak_mz_bins = np.clip(((mz[peaks_start:peaks_end] - min_mz) / mz_step).astype(np.int64), 0, mz_bins - 1)
+            peak_intensity = intensity[peaks_start:peaks_end]
+
+            # Only the top peaks of each scan, so the zoomed out map looks like the zoomed in one
+            if counts.max() > top_spectrum_peaks:
+                peak_scans = np.repeat(np.arange(chunk_end - chunk_start), counts)
+                top_mask = _top_peaks_mask(peak_scans, peak_intensity, top_spectrum_peaks)
+                peak_rt_bins = peak_rt_bins[top_mask]
+                peak_polarity_index = peak_polarity_index[top_mask]
+                peak_mz_bins = peak_mz_bins[top_mask]
+                peak_intensity = peak_intensity[top_mask]
+
+            rt_lower = int(peak_rt_bins.min())
+            rt_upper = int(peak_rt_bins.max()) + 1
+
+            for polarity_index in range(len(polarities)):
+                polarity_mask = peak_polarity_index == polarity_index
+                if not np.any(polarity_mask):
+                    continue
+
+                flat_bins = (peak_rt_bins[polarity_mask] - rt_lower) * mz_bins + peak_mz_bins[polarity_mask]
+                binned = np.bincount(flat_bins, weights=peak_intensity[polarity_mask], minlength=(rt_upper - rt_lower) * mz_bins)
+                grid[polarity_index, rt_lower:rt_upper] += binned.reshape(rt_upper - rt_lower, mz_bins).astype(PYRAMID_DTYPE)
+
+        chunk_start = chunk_end
+
+    # Writing each level, then the metadata which marks the pyramid as complete
+    levels = []
+    level = 0
+    while True:
+        _save_array(_get_level_filename(filename, level), grid)
+        levels.append([int(grid.shape[1]), int(grid.shape[2])])
+
+        if grid.shape[1] < 2 * MIN_LEVEL_BINS or grid.shape[2] < 2 * MIN_LEVEL_BINS:
+            break
+
+        grid = _downsample_grid(grid)
+        level += 1
+
+    metadata = {}
+    metadata["min_rt"] = min_rt
+    metadata["max_rt"] = max_rt
+    metadata["min_mz"] = min_mz
+    metadata["max_mz"] = max_mz
+    metadata["rt_step"] = rt_step
+    metadata["mz_step"] = mz_step
+    metadata["polarities"] = [int(polarity) for polarity in polarities]
+    metadata["top_spectrum_peaks"] = top_spectrum_peaks
+    metadata["levels"] = levels
+
+    pyramid_filename = _get_pyramid_filename(filename)
+    temp_pyramid_filename = os.path.join(os.path.dirname(pyramid_filename), str(uuid.uuid4()) + ".pyramid.json")
+    with open(temp_pyramid_filename, "w") as o:
+        o.write(json.dumps(metadata))
+    os.rename(temp_pyramid_filename, pyramid_filename)
+
+    return pyramid_filename
+
+@lru_cache(maxsize=64)
+def _load_pyramid_cached(pyramid_filename, modified_time):
+    with open(pyramid_filename) as f:
+        return json.loads(f.read())
+
+@lru_cache(maxsize=256)
+def _load_level_cached(level_filename, modified_time):
+    return np.load(level_filename, mmap_mode="r")
+
+def load_pyramid(filename):
+    """
+    Loads the pyramid metadata, None if it hasn't been built
+    """
+    pyramid_filename = _get_pyramid_filename(filename)
+
+    try:
+        return _load_pyramid_cached(pyramid_filename, os.path.getmtime(pyramid_filename))
+    except:
+        return None
+
+def _block_edges(bin_count, pixel_count):
+    # Splitting bin_count bins into pixel_count blocks, every block has at least one bin
+    return np.linspace(0, bin_count, pixel_count + 1).astype(np.int64)
+
+def aggregate_window(filename, min_rt, max_rt, min_mz, max_mz, width, height, polarity_filter="None"):
+    """
+    Sums the intensities in the window into a height by width image, from the coarsest level that still has a bin per pixel
+
+    Returns:
+        [type]: (values with mz rows and rt columns, rt coordinates, mz coordinates), None if there is no pyramid or we are zoomed in past the finest level
+    """
+    metadata = load_pyramid(filename)
+    if metadata is None:
+        return None
+
+    # Clipping to what is in the file
+    min_rt = max(min_rt, metadata["min_rt"])
+    max_rt = min(max_rt, metadata["max_rt"])
+    min_mz = max(min_mz, metadata["min_mz"])
+    max_mz = min(max_mz, metadata["max_mz"])
+    if max_rt <= min_rt or max_mz <= min_mz:
+        return None
+
+    chosen_level = None
+    for level in reversed(range(len(metadata["levels"]))):
+        rt_step = metadata["rt_step"] * 2 ** level
+        mz_step = metadata["mz_step"] * 2 ** level
+        if (max_rt - min_rt) / rt_step >= width and (max_mz - min_mz) / mz_step >= height:
+            chosen_level = level
+            break
+
+    # Zoomed in further than the finest level, the raw peaks have to be read
+    if chosen_level is None:
+        return None
+
+    level_rt_bins, level_mz_bins = metadata["levels"][chosen_level]
+    rt_lower = int(np.floor((min_rt - metadata["min_rt"]) / rt_step))
+    rt_upper = min(int(np.ceil((max_rt - metadata["min_rt"]) / rt_step)), level_rt_bins)
+    mz_lower = int(np.floor((min_mz - metadata["min_mz"]) / mz_step))
+    mz_upper = min(int(np.ceil((max_mz - metadata["min_mz"]) / mz_step)), level_mz_bins)
+
+    if rt_upper - rt_lower < width or mz_upper - mz_lower < height:
+        return None
+
+    if polarity_filter == "Positive":
+        polarity_indices = [index for index, polarity in enumerate(metadata["polarities"]) if polarity == POLARITY_POS]
+    elif polarity_filter == "Negative":
+        polarity_indices = [index for index, polarity in enumerate(metadata["polarities"]) if polarity == POLARITY_NEG]
+    else:
+        polarity_indices = list(range(len(metadata["polarities"])))
+
+    level_filename = _get_level_filename(filename, chosen_level)
+    grid = _load_level_cached(level_filename, os.path.getmtime(level_filename))
+
+    window = np.zeros((rt_upper - rt_lower, mz_upper - mz_lower), dtype=np.float64)
+    for polarity_index in polarity_indices:
+        window += grid[polarity_index, rt_lower:rt_upper, mz_lower:mz_upper]
+
+    # Summing the remaining bins down to the requested pixels
+    rt_edges = _block_edges(rt_upper - rt_lower, width)
+    mz_edges = _block_edges(mz_upper - mz_lower, height)
+    window = np.add.reduceat(window, rt_edges[:-1], axis=0)
+    window = np.add.reduceat(window, mz_edges[:-1], axis=1)
+
+    rt_coords = metadata["min_rt"] + (rt_lower + (rt_edges[:-1] + rt_edges[1:]) / 2) * rt_step
+    mz_coords = metadata["min_mz"] + (mz_lower + (mz_edges[:-1] + mz_edges[1:]) / 2) * mz_step
+
+    return window.T, rt_coords, mz_coords
+
+def render_preview_png(filename, output_filename, width=800, height=500):
+    """
+    Draws the whole run as a log scaled heatmap png from the pyramid, rt on x and mz going up on y
+    """
+    from PIL import Image
+
+    metadata = load_pyramid(filename)
+    if metadata is None:
+        raise Exception("Pyramid not available")
+
+    # Small files can have fewer bins than the requested size
+    width = min(width, metadata["levels"][0][0])
+    height = min(height, metadata["levels"][0][1])
+
+    pyramid_window = aggregate_window(filename, metadata["min_rt"], metadata["max_rt"], metadata["min_mz"], metadata["max_mz"], width, height)
+    if pyramid_window is None:
+        raise Exception("Pyramid can not render the preview")
+
+    values, rt_coords, mz_coords = pyramid_window
+
+    log_values = np.log10(values, out=np.zeros_like(values), where=values > 0)
+    if log_values.max() > 0:
+        log_values = log_values / log_values.max()
+
+    # Reversed hot color scale, so empty is white
+    scaled = 1 - log_values
+    rgb = np.stack([np.clip(3 * scaled, 0, 1), np.clip(3 * scaled - 1, 0, 1), np.clip(3 * scaled - 2, 0, 1)], axis=-1)
+    rgb = (np.flipud(rgb) * 255).astype(np.uint8)
+
+    Image.fromarray(rgb).save(output_filename)
@@ -1,4 +1,5 @@
 import requests
+import numpy as np
 import pymzml
 import json
 from utils import MS_precisions
@@ -8,8 +9,61 @@ import yaml
 from bs4 import BeautifulSoup
 from tqdm import tqdm
 from utils import _spectrum_generator
+import spectrum_index
+
+# Plotly formats the hover in the browser, so nothing has to be built per peak
+MS_HOVER_TEMPLATE = "m/z: %{x:.2f}<br>Intensity: %{y:.2f}<extra></extra>"
 
 def _get_ms_peak_labels(mzs, ints, partitions=8):
+    """
+    Labels the most intense peak of every m/z partition, the rest get an empty label
+
+    Args:
+        mzs ([type]): [description]
+        ints ([type]): [description]
+        partitions (int, optional): [description]. Defaults to 8.
+
+    Returns:
+        [type]: list of labels, one per peak
+    """
+    mzs = np.asarray(mzs, dtype=float)
+    ints = np.asarray(ints, dtype=float)
+
+    if len(mzs) == 0:
+        return []
+
+    max_mz = mzs.max()
+    min_mz = mzs.min()
+    mz_radius = (max_mz - min_mz) / partitions
+
+    # Partitions include both of their edges, like the slow version, so edge peaks compete in both
+    order = np.argsort(mzs, kind="stable")
+    sorted_mzs = mzs[order]
+    segment_edges = np.array([min_mz + mz_radius * i for i in range(partitions + 1)])
+    segment_starts = np.searchsorted(sorted_mzs, segment_edges[:-1], side="left")
+    segment_ends = np.searchsorted(sorted_mzs, segment_edges[1:], side="right")
+
+    labeled_peaks = []
+    for segment_start, segment_end in zip(segment_starts, segment_ends):
+        if segment_end <= segment_start:
+            continue
+
+        # Ties go to the peak that comes first in the list
+        segment_indices = order[segment_start:segment_end]
+        segment_ints = ints[segment_indices]
+        labeled_peaks.append(mzs[segment_indices[segment_ints == segment_ints.max()].min()])
+
+    mzs_text = [""] * len(mzs)
+    for i in np.flatnonzero(np.isin(mzs, labeled_peaks)):
+        mzs_text[i] = "{:.2f}".format(mzs[i])
+
+    return mzs_text
+
+# The plot uses MS_HOVER_TEMPLATE instead, numpy string formatting turned out slower than this
+def _get_ms_hover(mzs, ints):
+    return ["m/z: %.2f<br>Intensity: %.2f" % peak for peak in zip(mzs, ints)]
+
+def _get_ms_peak_labels_slow(mzs, ints, partitions=8):
     max_mz = max(mzs)
     min_mz = min(mzs)
     mz_radius = (max_mz - min_mz) / partitions
@@ -38,70 +92,105 @@ def _get_ms_peak_labels(mzs, ints, partitions=8):
     
     return mzs_text
 
-def _get_ms_hover(mzs, ints):
+def _get_ms_hover_slow(mzs, ints):
     hover_text = []
     for i, mz in enumerate(mzs):
         hover_text.append("m/z: {:.2f}<br>Intensity: {:.2f}".format(mz, ints[i]))
     
     return hover_text
 
-def _get_spectrum_metadata(spectrum, bs_spectrum_obj):
+def _get_cvparams(element):
+    """
+    Name to value of every cvParam under the spectrum element, in one walk. The first one of a name wins, like find did
+
+    Args:
+        element ([type]): ElementTree element of the spectrum
+
+    Returns:
+        [type]: dict
+    """
+    cv_params = {}
+    for child in element.iter():
+        # Tags carry the mzML namespace
+        if isinstance(child.tag, str) and child.tag.endswith("cvParam"):
+            name = child.get("name")
+            if name not in cv_params:
+                cv_params[name] = child.get("value")
+
+    return cv_params
+
+def _get_spectrum_metadata(spectrum, cv_params):
     spectrum_metadata = {}
 
     # Collision Energy
-    try:
-        # find tag with the name "collision energy"
-        collision_energy_value = bs_spectrum_obj.find("cvParam", {"name": "collision energy"}).get("value")
-
-        # trying to get the spectrum energy
-        spectrum_metadata["collision_energy"] = collision_energy_value
-    except:
-        pass
+    if "collision energy" in cv_params:
+        spectrum_metadata["collision_energy"] = cv_params["collision energy"]
 
     # precursors
-    try:
-        try:
-            precursor_mz = bs_spectrum_obj.find("cvParam", {"name": "isolation window target m/z"}).get("value")
-        except:
-            precursor_mz = bs_spectrum_obj.find("cvParam", {"name": "selected ion m/z"}).get("value")
-            
-        spectrum_metadata["precursor_mz"] = precursor_mz
-    except:
-        pass
+    if "isolation window target m/z" in cv_params:
+        spectrum_metadata["precursor_mz"] = cv_params["isolation window target m/z"]
+    elif "selected ion m/z" in cv_params:
+        spectrum_metadata["precursor_mz"] = cv_params["selected ion m/z"]
 
     # electron beam energy
-    try:
-        electron_beam_energy = bs_spectrum_obj.find("cvParam", {"name": "electron beam energy"}).get("value")
-        spectrum_metadata["electron_beam_energy"] = electron_beam_energy
-    except:
-        pass
+    if "electron beam energy" in cv_params:
+        spectrum_metadata["electron_beam_energy"] = cv_params["electron beam energy"]
         
     # adding in polarity
-    try:
-        positive_tag = bs_spectrum_obj.find("cvParam", {"name": "positive scan"})
-        if positive_tag:
-            spectrum_metadata["polarity"] = "Positive"
-        else:
-            spectrum_metadata["polarity"] = "Negative"
-    except:
-        pass
+    if "positive scan" in cv_params:
+        spectrum_metadata["polarity"] = "Positive"
+    else:
+        spectrum_metadata["polarity"] = "Negative"
 
     # Adding collision of MS2
-    try:
-        if bs_spectrum_obj.find("cvParam", {"name": "beam-type collision-induced dissociation"}):
-            spectrum_metadata["collision_method"] = "HCD"
+    if "beam-type collision-induced dissociation" in cv_params:
+        spectrum_metadata["collision_method"] = "HCD"
 
-        if bs_spectrum_obj.find("cvParam", {"name": "collision-induced dissociation"}):
-            spectrum_metadata["collision_method"] = "CID"
+    if "collision-induced dissociation" in cv_params:
+        spectrum_metadata["collision_method"] = "CID"
 
-        if bs_spectrum_obj.find("cvParam", {"name": "electron activated dissociation"}):
-            spectrum_metadata["collision_method"] = "EAD"
-    except:
-        pass
+    if "electron activated dissociation" in cv_params:
+        spectrum_metadata["collision_method"] = "EAD"
 
     return spectrum_metadata
 
-def _get_ms2_peaks(usi, local_filename, scan_number):
+def _get_spectrum(local_filename, scan_number):
+    # Seeking directly with the sidecar index, otherwise having pymzml find it
+    spectrum = spectrum_index.get_spectrum(local_filename, scan_number)
+
+    if spectrum is None:
+        try:
+            run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions)
+            spectrum = run[int(scan_number)]
+        except:
+            spectrum = run[str(scan_number)]
+
+    return spectrum
+
+def _get_spectrum_details_string(spectrum):
+    xml_string = ET.tostring(spectrum.element, encoding='utf8', method='xml')
+    bs_spectrum_obj = BeautifulSoup(xml_string.decode("ascii", "ignore"), "xml")
+    return bs_spectrum_obj.prettify()
+
+def _get_usi_spectrum_json(usi):
+    usi_json_url = "https://metabolomics-usi.ucsd.edu/json/?usi={}".format(usi)
+        
+    r = requests.get(usi_json_url)
+    return r.json()
+
+def _get_ms2_peaks(usi, local_filename, scan_number, include_details=True):
+    """
+    Peaks and metadata of a spectrum, from the file if we can, otherwise from the USI api
+
+    Args:
+        usi ([type]): [description]
+        local_filename ([type]): [description]
+        scan_number ([type]): [description]
+        include_details (bool, optional): pretty print the spectrum xml, which is slow, _get_spectrum_details does it on its own. Defaults to True.
+
+    Returns:
+        [type]: peaks, precursor_mz, spectrum_details_string, spectrum_metadata
+    """
     # Let's first try to get the spectrum from disk
     precursor_mz = 0
     peaks = []
@@ -109,35 +198,40 @@ def _get_ms2_peaks(usi, local_filename, scan_number):
     spectrum_details_string = ""
 
     try:
-        try:
-            run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions)
-            spectrum = run[int(scan_number)]
-        except:
-            spectrum = run[str(scan_number)]
+        spectrum = _get_spectrum(local_filename, scan_number)
         
         peaks = spectrum.peaks("raw")
 
-        xml_string = ET.tostring(spectrum.element, encoding='utf8', method='xml')
-        bs_spectrum_obj = BeautifulSoup(xml_string.decode("ascii", "ignore"), "xml")
-        spectrum_details_string = bs_spectrum_obj.prettify()
+        spectrum_metadata = _get_spectrum_metadata(spectrum, _get_cvparams(spectrum.element))
 
-        spectrum_metadata = _get_spectrum_metadata(spectrum, bs_spectrum_obj)
+        if include_details:
+            spectrum_details_string = _get_spectrum_details_string(spectrum)
 
         if len(spectrum.selected_precursors) > 0:
             precursor_mz = spectrum.selected_precursors[0]["mz"]
     except:
         # We'll have to get the MS2 peaks from USI
-        usi_json_url = "https://metabolomics-usi.ucsd.edu/json/?usi={}".format(usi)
-        
-        r = requests.get(usi_json_url)
-        spectrum_json = r.json()
+        spectrum_json = _get_usi_spectrum_json(usi)
         peaks = spectrum_json["peaks"]
         precursor_mz = spectrum_json["precursor_mz"]
         spectrum_details_string = json.dumps(spectrum_json)
 
     return peaks, precursor_mz, spectrum_details_string, spectrum_metadata
 
+def _get_spectrum_details(usi, local_filename, scan_number):
+    try:
+        return _get_spectrum_details_string(_get_spectrum(local_filename, scan_number))
+    except:
+        return json.dumps(_get_usi_spectrum_json(usi))
+
 def determine_scan_by_rt(usi, local_filename, rt, ms_level=1):
+    # Using the sidecar index when available, no spectra need to be parsed
+    index_df = spectrum_index.load_spectrum_index(local_filename)
+    if index_df is not None:
+        closest_scan = spectrum_index.find_closest_scan(index_df, rt, ms_level=ms_level)
+        if closest_scan is not None:
+            return closest_scan
+
     # Understand parameters
     min_rt_delta = 1000
     closest_scan = 0
@@ -0,0 +1,307 @@
+import os
+import uuid
+import numpy as np
+import pymzml
+from functools import lru_cache
+
+from utils import MS_precisions
+from utils import _get_scan_polarity
+from spectrum_index import POLARITY_UNKNOWN, POLARITY_POS, POLARITY_NEG
+
+# On disk layout, CSR style
+# mz and intensity are flat arrays of all MS1 peaks, sorted by mz within each scan
+# scans has one row per spectrum, start/end are the peak range of that scan in the flat arrays
+MZ_DTYPE = np.float32
+INTENSITY_DTYPE = np.float32
+SCAN_DTYPE = np.dtype([
+    ("start", np.int64),
+    ("end", np.int64),
+    ("rt", np.float64),
+    ("ms_level", np.int8),
+    ("polarity", np.int8),
+    ("spectrum_position", np.int64), # row in the spectrum index
+])
+
+# Per scan summary, computed from the unfiltered peaks while writing the store
+SUMMARY_DTYPE = np.dtype([
+    ("rt", np.float64),
+    ("ms_level", np.int8),
+    ("polarity", np.int8),
+    ("tic", np.float64),
+    ("bpi", np.float64),
+    ("base_peak_mz", np.float64),
+])
+
+def _get_summary_filename(filename):
+    return filename + ".summary.npy"
+
+def _get_peak_store_filenames(filename):
+    output_mz_filename = filename + ".peaks.mz.bin"
+    output_i_filename = filename + ".peaks.i.bin"
+    output_scans_filename = filename + ".peaks.scans.bin"
+
+    return output_mz_filename, output_i_filename, output_scans_filename
+
+def _polarity_code(spec):
+    scan_polarity = _get_scan_polarity(spec)
+    if scan_polarity == "Positive":
+        return POLARITY_POS
+    elif scan_polarity == "Negative":
+        return POLARITY_NEG
+
+    return POLARITY_UNKNOWN
+
+def _iterate_mzml_scans(filename):
+    """
+    Yields (spectrum_position, rt, ms_level, polarity, mz, intensity) for every spectrum in the mzML, peaks only for MS1
+    """
+    run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
+
+    for spectrum_position, spec in enumerate(run):
+        rt = spec.scan_time_in_minutes()
+        polarity = _polarity_code(spec)
+
+        if spec.ms_level == 1:
+            try:
+                peaks = spec.peaks("raw")
+                mz = peaks[:, 0]
+                intensity = peaks[:, 1]
+            except:
+                mz = np.zeros(0)
+                intensity = np.zeros(0)
+        else:
+            mz = np.zeros(0)
+            intensity = np.zeros(0)
+
+        yield spectrum_position, rt, spec.ms_level, polarity, mz, intensity
+
+def _write_peak_store(filename, scan_iterator):
+    """
+    Writes the peak store by appending scan by scan, so memory does not grow with the file size
+
+    Args:
+        filename ([type]): converted mzML filename
+        scan_iterator ([type]): yields (spectrum_position, rt, ms_level, polarity, mz, intensity)
+    """
+    output_mz_filename, output_i_filename, output_scans_filename = _get_peak_store_filenames(filename)
+
+    temp_suffix = "." + str(uuid.uuid4())
+    temp_mz_filename = output_mz_filename + temp_suffix
+    temp_i_filename = output_i_filename + temp_suffix
+    temp_scans_filename = output_scans_filename + temp_suffix
+
+    buffer_size = 4 * 1024 * 1024
+    peak_count = 0
+    all_summary = []
+
+    with open(temp_mz_filename, "wb", buffering=buffer_size) as mz_file, \
+        open(temp_i_filename, "wb", buffering=buffer_size) as i_file, \
+        open(temp_scans_filename, "wb", buffering=buffer_size) as scans_file:
+
+        for spectrum_position, rt, ms_level, polarity, mz, intensity in scan_iterator:
+            all_summary.append(_summary_record(rt, ms_level, polarity, mz, intensity))
+
+            mz = np.asarray(mz, dtype=MZ_DTYPE)
+            intensity = np.asarray(intensity, dtype=INTENSITY_DTYPE)
+
+            # Filtering out zero rows, same as the feather cache
+            keep_mask = (mz >= 1.0) & (intensity >= 1.0)
+            mz = mz[keep_mask]
+            intensity = intensity[keep_mask]
+
+            # Sorting by mz so range queries within a scan are a binary search
+            order = np.argsort(mz, kind="stable")
+            mz = mz[order]
+            intensity = intensity[order]
+
+            scan_record = np.zeros(1, dtype=SCAN_DTYPE)
+            scan_record["start"] = peak_count
+            scan_record["end"] = peak_count + len(mz)
+            scan_record["rt"] = rt
+            scan_record["ms_level"] = ms_level
+            scan_record["polarity"] = polarity
+            scan_record["spectrum_position"] = spectrum_position
+
+            mz.tofile(mz_file)
+            intensity.tofile(i_file)
+            scan_record.tofile(scans_file)
+
+            peak_count += len(mz)
+
+    _save_summary(filename, all_summary)
+
+    # The scans file goes last, its existence marks the store as complete
+    os.rename(temp_mz_filename, output_mz_filename)
+    os.rename(temp_i_filename, output_i_filename)
+    os.rename(temp_scans_filename, output_scans_filename)
+
+def _summary_record(rt, ms_level, polarity, mz, intensity):
+    # Intensities are summed before any filtering, so the TIC matches the raw spectrum
+    tic = 0.0
+    bpi = 0.0
+    base_peak_mz = 0.0
+    if len(intensity) > 0:
+        base_peak_index = int(np.argmax(intensity))
+        tic = float(np.sum(intensity, dtype=np.float64))
+        bpi = float(intensity[base_peak_index])
+        base_peak_mz = float(mz[base_peak_index])
+
+    return (rt, ms_level, polarity, tic, bpi, base_peak_mz)
+
+def _save_summary(filename, all_summary):
+    summary = np.array(all_summary, dtype=SUMMARY_DTYPE)
+
+    summary_filename = _get_summary_filename(filename)
+    temp_summary_filename = os.path.join(os.path.dirname(summary_filename), str(uuid.uuid4()) + ".summary.npy")
+    np.save(temp_summary_filename, summary)
+    os.rename(temp_summary_filename, summary_filename)
+
+def build_peak_store(filename):
+    _write_peak_store(filename, _iterate_mzml_scans(filename))
+
+def build_scan_summary(filename):
+    """
+    Writes only the per scan summary, for files whose peak store was built before we had it
+    """
+    all_summary = []
+    for spectrum_position, rt, ms_level, polarity, mz, intensity in _iterate_mzml_scans(filename):
+        all_summary.append(_summary_record(rt, ms_level, polarity, mz, intensity))
+
+    _save_summary(filename, all_summary)
+
+@lru_cache(maxsize=64)
+def _load_scan_summary_cached(summary_filename, modified_time):
+    return np.load(summary_filename, mmap_mode="r")
+
+def load_scan_summary(filename):
+    """
+    Loads the per scan summary with rt, ms_level, polarity, tic, bpi and base_peak_mz, None if it hasn't been built
+    """
+    summary_filename = _get_summary_filename(filename)
+
+    try:
+        return _load_scan_summary_cached(summary_filename, os.path.getmtime(summary_filename))
+    except:
+        return None
+
+def _open_memmap(filename, dtype):
+    # Empty files can't be memory mapped
+    if os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(filename, dtype=dtype, mode="r")
+
+@lru_cache(maxsize=64)
+def _load_peak_store_cached(mz_filename, i_filename, scans_filename, modified_time):
+    scans = _open_memmap(scans_filename, SCAN_DTYPE)
+    mz = _open_memmap(mz_filename, MZ_DTYPE)
+    intensity = _open_memmap(i_filename, INTENSITY_DTYPE)
+
+    return scans, mz, intensity
+
+def load_peak_store(filename):
+    """
+    Opens the peak store memory mapped, returns (scans, mz, intensity) or None if it hasn't been built
+    """
+    mz_filename, i_filename, scans_filename = _get_peak_store_filenames(filename)
+
+    try:
+        return _load_peak_store_cached(mz_filename, i_filename, scans_filename, os.path.getmtime(scans_filename))
+    except:
+        return None
+
+def rt_window_scan_positions(scans, min_rt, max_rt, ms_level=1, polarity_filter="None"):
+    """
+    Returns the positions of scans within the rt window, at the ms level and polarity
+    """
+    rt_values = scans["rt"]
+
+    if len(rt_values) > 0 and np.all(rt_values[1:] >= rt_values[:-1]):
+        start = np.searchsorted(rt_values, min_rt, side="left")
+        end = np.searchsorted(rt_values, max_rt, side="right")
+        positions = np.arange(start, end)
+    else:
+        positions = np.nonzero((rt_values >= min_rt) & (rt_values <= max_rt))[0]
+
+    window_scans = scans[positions]
+    keep_mask = window_scans["ms_level"] == ms_level
+
+    if polarity_filter == "Positive":
+        keep_mask &= window_scans["polarity"] == POLARITY_POS
+    elif polarity_filter == "Negative":
+        keep_mask &= window_scans["polarity"] == POLARITY_NEG
+
+    return positions[keep_mask]
+
+def scan_mz_range(mz, scan, min_mz, max_mz):
+    """
+    Returns the start and end of the peaks in the scan that are within the mz range, mz is sorted within each scan
+    """
+    scan_start = int(scan["start"])
+    scan_end = int(scan["end"])
+    scan_mz = mz[scan_start:scan_end]
+
+    start = scan_start + np.searchsorted(scan_mz, min_mz, side="left")
+    end = scan_start + np.searchsorted(scan_mz, max_mz, side="right")
+
+    return start, end
+
+def gather_top_peaks(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", top_spectrum_peaks=100):
+    """
+    Gets the most intense peaks per MS1 scan within the window straight from the memory mapped arrays
+
+    Returns:
+        [type]: dict of numpy arrays with mz, rt, i, scan, polarity, None if the peak store is not available
+    """
+    peak_store = load_peak_store(filename)
+    if peak_store is None:
+        return None
+
+    scans, mz, intensity = peak_store
+
+    positions = rt_window_scan_positions(scans, min_rt, max_rt, ms_level=1, polarity_filter=polarity_filter)
+
+    all_mz = []
+    all_i = []
+    all_rt = []
+    all_scan = []
+    all_polarity = []
+
+    for position in positions:
+        scan = scans[position]
+        start, end = scan_mz_range(mz, scan, min_mz, max_mz)
+
+        if end <= start:
+            continue
+
+        scan_mz = mz[start:end]
+        scan_i = intensity[start:end]
+
+        # Keeping the top peaks by intensity
+        if len(scan_i) > top_spectrum_peaks:
+            top_indices = np.argpartition(scan_i, -top_spectrum_peaks)[-top_spectrum_peaks:]
+            scan_mz = scan_mz[top_indices]
+            scan_i = scan_i[top_indices]
+
+        all_mz.append(np.asarray(scan_mz))
+        all_i.append(np.asarray(scan_i))
+        all_rt.append(np.full(len(scan_mz), scan["rt"]))
+        all_scan.append(np.full(len(scan_mz), scan["spectrum_position"]))
+        all_polarity.append(np.full(len(scan_mz), scan["polarity"], dtype=np.int8))
+
+    if len(all_mz) == 0:
+        return {
+            "mz": np.zeros(0, dtype=MZ_DTYPE),
+            "rt": np.zeros(0),
+            "i": np.zeros(0, dtype=INTENSITY_DTYPE),
+            "scan": np.zeros(0, dtype=np.int64),
+            "polarity": np.zeros(0, dtype=np.int8),
+        }
+
+    return {
+        "mz": np.concatenate(all_mz),
+        "rt": np.concatenate(all_rt),
+        "i": np.concatenate(all_i),
+        "scan": np.concatenate(all_scan),
+        "polarity": np.concatenate(all_polarity),
+    }
@@ -0,0 +1,182 @@
+import json
+import time
+import hashlib
+
+from celery.signals import before_task_publish, task_prerun
+
+import single_flight
+
+# Every queue has a background lane served by its own smaller worker pool, so interactive work never waits behind it
+BACKGROUND_SUFFIX = "_background"
+INTERACTIVE_QUEUES = ["compute", "conversion", "featurefinding", "sync"]
+BACKGROUND_QUEUES = ["compute_background", "conversion_background", "featurefinding_background"]
+
+WAIT_SAMPLES = 500 # Recent waits kept per lane
+
+def background_lane(queue):
+    return queue + BACKGROUND_SUFFIX
+
+def session_key(usi_list):
+    """
+    Sessions don't have ids, so the set of files being looked at stands in for one when sharing a lane
+    """
+    return hashlib.sha1("\n".join(usi_list).encode()).hexdigest()[:16]
+
+##############################
+# Wait time per lane
+##############################
+@before_task_publish.connect
+def _stamp_published_time(headers=None, **kwargs):
+    if headers is not None:
+        headers["published_time"] = time.time()
+
+@task_prerun.connect
+def _record_task_wait(task=None, **kwargs):
+    try:
+        published_time = task.request.get("published_time")
+        queue = task.request.delivery_info["routing_key"]
+        if published_time is not None:
+            _record_wait("lanes:waits:" + queue, time.time() - published_time)
+    except:
+        pass
+
+def _record_wait(key, wait):
+    client = single_flight._get_redis()
+    if client is None:
+        return
+
+    pipe = client.pipeline()
+    pipe.lpush(key, wait)
+    pipe.ltrim(key, 0, WAIT_SAMPLES - 1)
+    pipe.execute()
+
+##############################
+# Fair share within a lane
+##############################
+# Jobs wait in a list per session, and the runner tasks pop them round robin across the sessions.
+# So a session with 500 files gets the same share of the pool as one with 5, instead of being in front of it
+
+def _sessions_key(lane):
+    return "fair:{}:sessions".format(lane)
+
+def _members_key(lane):
+    return "fair:{}:members".format(lane)
+
+def _pending_key(lane):
+    return "fair:{}:pending".format(lane)
+
+def _session_jobs_key(lane, session):
+    return "fair:{}:s:{}".format(lane, session)
+
+def submit_fair(lane, session, runner_task, job_name, job_args):
+    """
+    Queues a job for the session in the lane, and a runner task that will run the next job in fair order
+
+    Args:
+        lane ([type]): background queue name
+        session ([type]): from session_key
+        runner_task ([type]): celery task taking the lane, which calls pop_fair and runs the job
+        job_name ([type]): name the runner looks the function up by
+        job_args ([type]): json serializable arguments
+
+    Returns:
+        [type]: False if the same job was already waiting
+    """
+    client = single_flight._get_redis()
+
+    job = json.dumps([job_name, job_args])
+    if not client.sadd(_pending_key(lane), job):
+        return False
+
+    pipe = client.pipeline()
+    pipe.rpush(_session_jobs_key(lane, session), json.dumps([time.time(), job]))
+    pipe.sadd(_members_key(lane), session)
+    new_session = pipe.execute()[1]
+    if new_session:
+        client.rpush(_sessions_key(lane), session)
+
+    runner_task.apply_async(args=[lane], queue=lane)
+
+    return True
+
+def pop_fair(lane):
+    """
+    Next job of the lane, taking sessions in turn
+
+    Returns:
+        [type]: (job_name, job_args), None when nothing is waiting
+    """
+    client = single_flight._get_redis()
+
+    for attempt in range(int(client.llen(_sessions_key(lane))) + 1):
+        # Rotating, the session we take from goes to the back
+        session = client.rpoplpush(_sessions_key(lane), _sessions_key(lane))
+        if session is None:
+            return None
+        session = session.decode()
+
+        entry = client.lpop(_session_jobs_key(lane, session))
+        if entry is None:
+            _drop_session(client, lane, session)
+            continue
+
+        enqueued_time, job = json.loads(entry)
+        client.srem(_pending_key(lane), job)
+        _record_wait("lanes:waits:" + lane + ":fair", time.time() - enqueued_time)
+
+        if client.llen(_session_jobs_key(lane, session)) == 0:
+            _drop_session(client, lane, session)
+
+        return json.loads(job)
+
+    return None
+
+def _drop_session(client, lane, session):
+    pipe = client.pipeline()
+    pipe.lrem(_sessions_key(lane), 0, session)
+    pipe.srem(_members_key(lane), session)
+    pipe.execute()
+
+    # A job may have been pushed while we were taking the session out
+    if client.llen(_session_jobs_key(lane, session)) > 0 and client.sadd(_members_key(lane), session):
+        client.rpush(_sessions_key(lane), session)
+
+##############################
+# Stats
+##############################
+def _wait_stats(client, key):
+    waits = sorted(float(wait) for wait in client.lrange(key, 0, -1))
+
+    stats = {}
+    stats["samples"] = len(waits)
+    if len(waits) > 0:
+        stats["mean"] = sum(waits) / len(waits)
+        stats["p95"] = waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+        stats["max"] = waits[-1]
+
+    return stats
+
+def get_lane_stats():
+    """
+    Queue depth and recent wait times of every lane, plus the jobs waiting per session in the fair share lanes
+    """
+    client = single_flight._get_redis()
+    if client is None:
+        return {}
+
+    all_stats = {}
+    for queue in INTERACTIVE_QUEUES + BACKGROUND_QUEUES:
+        lane_stats = {}
+
+        # The redis broker keeps each queue as a list under its name
+        lane_stats["depth"] = client.llen(queue)
+        lane_stats["wait"] = _wait_stats(client, "lanes:waits:" + queue)
+
+        if queue in BACKGROUND_QUEUES:
+            sessions = [session.decode() for session in client.smembers(_members_key(queue))]
+            lane_stats["fair_sessions"] = {session: client.llen(_session_jobs_key(queue, session)) for session in sessions}
+            lane_stats["fair_wait"] = _wait_stats(client, "lanes:waits:" + queue + ":fair")
+
+        all_stats[queue] = lane_stats
+
+    return all_stats
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+import functools
+
+import single_flight
+
+# Remote links don't move often, failures are retried a lot sooner
+RESOLVE_TTL = 24 * 3600
+NEGATIVE_TTL = 300
+MAX_CONCURRENT_LOOKUPS = 4 # Outbound API calls at once from this process
+
+CACHE_FILENAME = os.environ.get("LCMS_RESOLUTION_CACHE", os.path.join("temp", "resolution_cache.sqlite"))
+
+_lookup_semaphore = threading.BoundedSemaphore(MAX_CONCURRENT_LOOKUPS)
+_lookup_state = threading.local()
+
+def _cache_key(namespace, usi, kwargs):
+    key = namespace + ":" + usi
+    if len(kwargs) > 0:
+        key += ":" + json.dumps(kwargs, sort_keys=True)
+    return key
+
+def _sqlite_connect():
+    connection = sqlite3.connect(CACHE_FILENAME, timeout=30)
+    connection.execute("CREATE TABLE IF NOT EXISTS resolution (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+    return connection
+
+def _get_entry(key):
+    client = single_flight._get_redis()
+    if client is not None:
+        entry = client.get("usiresolve:" + key)
+        return json.loads(entry) if entry is not None else None
+
+    connection = _sqlite_connect()
+    try:
+        row = connection.execute("SELECT value, expires FROM resolution WHERE key = ?", (key,)).fetchone()
+    finally:
+        connection.close()
+
+    if row is None or row[1] < time.time():
+        return None
+
+    return json.loads(row[0])
+
+def _set_entry(key, entry, ttl):
+    client = single_flight._get_redis()
+    if client is not None:
+        client.set("usiresolve:" + key, json.dumps(entry), ex=ttl)
+        return
+
+    connection = _sqlite_connect()
+    try:
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO resolution (key, value, expires) VALUES (?, ?, ?)", (key, json.dumps(entry), time.time() + ttl))
+    finally:
+        connection.close()
+
+def _is_negative(result):
+    # Resolvers give back an empty link when they couldn't find the file
+    if isinstance(result, (list, tuple)) and len(result) > 0:
+        result = result[0]
+    return result is None or result == ""
+
+def _lookup(key, function, usi, kwargs):
+    # Another request may have filled it while we waited on the flight
+    entry = _get_entry(key)
+    if entry is not None:
+        return entry
+
+    # Resolvers calling other cached resolvers already hold a slot
+    nested = getattr(_lookup_state, "holding", False)
+    if not nested:
+        _lookup_semaphore.acquire()
+        _lookup_state.holding = True
+
+    try:
+        entry = {"value": function(usi, **kwargs)}
+    except Exception as e:
+        entry = {"error": "{}: {}".format(type(e).__name__, e)}
+    finally:
+        if not nested:
+            _lookup_state.holding = False
+            _lookup_semaphore.release()
+
+    ttl = NEGATIVE_TTL if "error" in entry or _is_negative(entry["value"]) else RESOLVE_TTL
+    try:
+        _set_entry(key, entry, ttl)
+    except:
+        print("RESOLUTION CACHE WRITE FAILED", key, file=sys.stderr, flush=True)
+
+    return entry
+
+def cached(namespace):
+    """
+    Caches a usi resolver by usi and keyword arguments, failures included for a shorter time
+
+    Concurrent lookups of the same usi share one call, and at most MAX_CONCURRENT_LOOKUPS calls go out at once.
+    Tuples come back as lists
+
+    Args:
+        namespace ([type]): keeps the resolvers apart in the cache
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(usi, **kwargs):
+            key = _cache_key(namespace, usi, kwargs)
+
+            try:
+                entry = _get_entry(key)
+                if entry is None:
+                    entry = single_flight.run("resolve:" + key, _lookup, key, function, usi, kwargs)
+            except Exception as e:
+                # The cache being down shouldn't stop resolution
+                print("RESOLUTION CACHE FAILED", key, e, file=sys.stderr, flush=True)
+                return function(usi, **kwargs)
+
+            if "error" in entry:
+                raise Exception("Resolution of {} failed recently, {}".format(usi, entry["error"]))
+
+            return entry["value"]
+
+        wrapper.uncached = function
+        return wrapper
+
+    return decorator
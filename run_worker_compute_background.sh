@@ -0,0 +1,4 @@
+#!/bin/bash
+
+source activate py311
+celery -A tasks worker -l info --autoscale=4,1 -Q compute_background -n background@%h --max-tasks-per-child 10 --loglevel INFO --max-memory-per-child 3000000
@@ -0,0 +1,4 @@
+#!/bin/bash
+
+source activate py311
+celery -A tasks_conversion worker --autoscale=4,1 -Q conversion_background -n background@%h --max-tasks-per-child 1 --loglevel INFO --max-memory-per-child 3000000
@@ -0,0 +1,4 @@
+#!/bin/bash
+
+source activate py311
+celery -A tasks worker -l info --autoscale=2,1 -Q featurefinding_background -n background@%h --max-tasks-per-child 10 --loglevel INFO --max-memory-per-child 3000000
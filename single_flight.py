@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import threading
+
+import task_wait
+
+# Shared through redis when it is up, so every process and worker sees the same flights
+REDIS_HOST = os.environ.get("LCMS_REDIS_HOST", "gnpslcms-redis")
+LEASE_SECONDS = 3600 # A crashed leader holds the key at most this long
+WAIT_SECONDS = task_wait.CONVERSION_TIMEOUT # Callers give up on the work after this anyway
+RESULT_SECONDS = 60 # Followers that were waiting pick up the result within this
+FAILURE_SECONDS = 30 # A failure is handed to the followers too, instead of each of them trying again
+
+_redis_client = None
+_redis_checked_time = 0
+
+_local_flights = {}
+_local_progress = {}
+_local_registry_lock = threading.Lock()
+
+def _get_redis():
+    # Checking at most once a minute, so a missing redis doesn't cost a connect per call
+    global _redis_client, _redis_checked_time
+
+    if _redis_client is not None:
+        return _redis_client
+    if time.time() - _redis_checked_time < 60:
+        return None
+
+    _redis_checked_time = time.time()
+    try:
+        import redis
+        client = redis.Redis(host=REDIS_HOST, port=6379, db=0, socket_connect_timeout=1)
+        client.ping()
+        _redis_client = client
+    except:
+        _redis_client = None
+
+    return _redis_client
+
+def _lock_key(key):
+    return "singleflight:lock:" + key
+
+def _result_key(key):
+    return "singleflight:result:" + key
+
+def _progress_key(key):
+    return "singleflight:progress:" + key
+
+def run(key, function, *args, **kwargs):
+    """
+    Runs function once for everyone asking for the same key at the same time, the others wait and get the same result
+
+    The result has to be json serializable, tuples come back as lists. If the function raises, the followers raise too
+
+    Args:
+        key ([type]): what identifies the work, e.g. the output filename
+        function ([type]): called with args and kwargs by whoever gets the lock first
+
+    Returns:
+        [type]: the result of the function
+    """
+    client = _get_redis()
+    if client is not None:
+        return _run_redis(client, key, function, *args, **kwargs)
+
+    return _run_local(key, function, *args, **kwargs)
+
+def _run_redis(client, key, function, *args, **kwargs):
+    from redis.exceptions import LockError
+
+    lock = client.lock(_lock_key(key), timeout=LEASE_SECONDS, thread_local=False)
+    if not lock.acquire(blocking=True, blocking_timeout=WAIT_SECONDS):
+        raise Exception("Timed out waiting on {}".format(key))
+
+    try:
+        # Whoever held the lock before us may have done the work already, or failed at it
+        cached_result = client.get(_result_key(key))
+        if cached_result is not None:
+            print("SINGLE FLIGHT SHARED", key, file=sys.stderr, flush=True)
+            cached_result = json.loads(cached_result)
+            if "error" in cached_result:
+                raise Exception("{} failed, {}".format(key, cached_result["error"]))
+            return cached_result["value"]
+
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            client.set(_result_key(key), json.dumps({"error": "{}: {}".format(type(e).__name__, e)}), ex=FAILURE_SECONDS)
+            raise
+
+        client.set(_result_key(key), json.dumps({"value": result}), ex=RESULT_SECONDS)
+
+        return result
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # The lease ran out while we were working
+            pass
+
+def _run_local(key, function, *args, **kwargs):
+    # Whoever starts the flight runs it, the others wait on its event and take its outcome
+    with _local_registry_lock:
+        flight = _local_flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = {"done": threading.Event()}
+            _local_flights[key] = flight
+
+    if not leader:
+        if not flight["done"].wait(timeout=WAIT_SECONDS):
+            raise Exception("Timed out waiting on {}".format(key))
+
+        print("SINGLE FLIGHT SHARED", key, file=sys.stderr, flush=True)
+        if "error" in flight:
+            raise Exception("{} failed, {}".format(key, flight["error"]))
+        return flight["result"]
+
+    try:
+        flight["result"] = function(*args, **kwargs)
+        return flight["result"]
+    except Exception as e:
+        flight["error"] = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        # Nothing is kept once the flight is over
+        with _local_registry_lock:
+            _local_flights.pop(key, None)
+            _local_progress.pop(key, None)
+        flight["done"].set()
+
+def report_progress(key, message):
+    """
+    Lets whoever is doing the work for key tell the waiters how far along it is
+    """
+    client = _get_redis()
+    if client is not None:
+        try:
+            client.set(_progress_key(key), message, ex=LEASE_SECONDS)
+            return
+        except:
+            pass
+
+    _local_progress[key] = message
+
+def get_progress(key):
+    client = _get_redis()
+    if client is not None:
+        try:
+            progress = client.get(_progress_key(key))
+            return progress.decode() if progress is not None else None
+        except:
+            pass
+
+    return _local_progress.get(key)
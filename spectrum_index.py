@@ -0,0 +1,263 @@
+import os
+import re
+import uuid
+import numpy as np
+import pandas as pd
+import pymzml
+from functools import lru_cache
+from xml.etree.ElementTree import XML
+
+from utils import MS_precisions
+from utils import _get_scan_polarity
+
+# Enum for polarity, same values as in lcms_map
+POLARITY_UNKNOWN = 0
+POLARITY_POS = 1
+POLARITY_NEG = 2
+
+# Matches the opening spectrum tag, but not spectrumList
+SPECTRUM_OPEN_PATTERN = re.compile(rb"<spectrum[\s>]")
+SPECTRUM_CLOSE_TAG = b"</spectrum>"
+
+def _get_index_filename(filename):
+    return filename + ".index.feather"
+
+def _find_spectrum_offsets(filename, chunk_size=16 * 1024 * 1024):
+    """
+    Scans the raw bytes of the mzML for the byte offset of every spectrum open tag, in file order
+    """
+    offsets = []
+    overlap = 9 # One byte shorter than the pattern, so we never find the same match twice
+
+    with open(filename, "rb") as f:
+        data_start = 0
+        data = b""
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+
+            data = data[-overlap:] + chunk
+            data_start = f.tell() - len(data)
+
+            for match in SPECTRUM_OPEN_PATTERN.finditer(data):
+                offsets.append(data_start + match.start())
+
+    return offsets
+
+def _get_float_param(spec, accession):
+    try:
+        return float(spec.get(accession, np.nan))
+    except:
+        return np.nan
+
+def build_spectrum_index(filename):
+    """
+    Creates a sidecar index next to the mzML so we can seek to spectra instead of parsing the whole file
+
+    Args:
+        filename ([type]): converted mzML filename
+
+    Returns:
+        [type]: index filename
+    """
+    offsets = _find_spectrum_offsets(filename)
+
+    all_scan = []
+    all_native_id = []
+    all_rt = []
+    all_ms_level = []
+    all_polarity = []
+    all_precursor_mz = []
+    all_tic = []
+    all_base_peak_mz = []
+    all_base_peak_i = []
+
+    run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
+    for spec in run:
+        all_scan.append(str(spec.ID))
+        all_native_id.append(spec.element.get("id"))
+        all_rt.append(spec.scan_time_in_minutes())
+        all_ms_level.append(spec.ms_level)
+
+        scan_polarity = _get_scan_polarity(spec)
+        if scan_polarity == "Positive":
+            all_polarity.append(POLARITY_POS)
+        elif scan_polarity == "Negative":
+            all_polarity.append(POLARITY_NEG)
+        else:
+            all_polarity.append(POLARITY_UNKNOWN)
+
+        precursor_mz = np.nan
+        if spec.ms_level is not None and spec.ms_level > 1:
+            try:
+                precursor_mz = spec.selected_precursors[0]["mz"]
+            except:
+                pass
+        all_precursor_mz.append(precursor_mz)
+
+        # These come from the header cvParams, so we don't have to decode the peaks
+        all_tic.append(_get_float_param(spec, "MS:1000285"))
+        all_base_peak_mz.append(_get_float_param(spec, "MS:1000504"))
+        all_base_peak_i.append(_get_float_param(spec, "MS:1000505"))
+
+    if len(offsets) != len(all_scan):
+        raise Exception("Spectrum offsets do not line up with spectra, {} vs {}".format(len(offsets), len(all_scan)))
+
+    index_df = pd.DataFrame()
+    index_df["scan"] = all_scan
+    index_df["native_id"] = all_native_id
+    index_df["offset"] = np.array(offsets, dtype=np.int64)
+    index_df["rt"] = np.array(all_rt, dtype=np.float64)
+    index_df["ms_level"] = np.array(all_ms_level, dtype=np.int8)
+    index_df["polarity"] = np.array(all_polarity, dtype=np.int8)
+    index_df["precursor_mz"] = np.array(all_precursor_mz, dtype=np.float64)
+    index_df["tic"] = np.array(all_tic, dtype=np.float64)
+    index_df["base_peak_mz"] = np.array(all_base_peak_mz, dtype=np.float64)
+    index_df["base_peak_i"] = np.array(all_base_peak_i, dtype=np.float64)
+
+    # Writing to a temp file and renaming, so readers never see a partial index
+    index_filename = _get_index_filename(filename)
+    temp_index_filename = os.path.join(os.path.dirname(index_filename), str(uuid.uuid4()) + ".index.feather")
+    index_df.to_feather(temp_index_filename)
+    os.rename(temp_index_filename, index_filename)
+
+    return index_filename
+
+@lru_cache(maxsize=64)
+def _load_spectrum_index_cached(index_filename, modified_time):
+    index_df = pd.read_feather(index_filename)
+    index_df.attrs["rt_sorted"] = bool(np.all(np.diff(index_df["rt"].values) >= 0))
+
+    # Mapping nativeIDs and scan numbers to rows, scan numbers take precedence
+    scan_positions = {}
+    for position, native_id in enumerate(index_df["native_id"].values):
+        scan_positions[native_id] = position
+    for position, scan in enumerate(index_df["scan"].values):
+        scan_positions[scan] = position
+
+    return index_df, scan_positions
+
+def load_spectrum_index(filename):
+    """
+    Loads the sidecar index for the mzML, returns None if it hasn't been built
+    """
+    index_filename = _get_index_filename(filename)
+
+    try:
+        index_df, scan_positions = _load_spectrum_index_cached(index_filename, os.path.getmtime(index_filename))
+        return index_df
+    except:
+        return None
+
+def rt_range_positions(index_df, min_rt, max_rt):
+    """
+    Returns the row positions in the index that are within the rt window, inclusive
+    """
+    rt_values = index_df["rt"].values
+
+    if index_df.attrs.get("rt_sorted", False):
+        start = np.searchsorted(rt_values, min_rt, side="left")
+        end = np.searchsorted(rt_values, max_rt, side="right")
+        return np.arange(start, end)
+
+    # Not sorted by RT, so we fall back to a linear scan of the index, still no XML parsing
+    return np.nonzero((rt_values >= min_rt) & (rt_values <= max_rt))[0]
+
+def find_scan_position(filename, scan_number):
+    """
+    Finds the row of a scan in the index, by scan number or nativeID. None if not found
+    """
+    index_filename = _get_index_filename(filename)
+
+    try:
+        index_df, scan_positions = _load_spectrum_index_cached(index_filename, os.path.getmtime(index_filename))
+    except:
+        return None
+
+    return scan_positions.get(str(scan_number), None)
+
+def _scan_identifier(scan):
+    # Matching the pymzml convention, where scan IDs are ints and nativeIDs are strings
+    try:
+        return int(scan)
+    except:
+        return scan
+
+def _read_spectrum_bytes(file_handle, offset, chunk_size=65536):
+    file_handle.seek(offset)
+
+    data = bytearray()
+    while True:
+        chunk = file_handle.read(chunk_size)
+        if not chunk:
+            break
+
+        # Searching from a little before the new chunk, in case the close tag is split
+        search_start = max(len(data) - len(SPECTRUM_CLOSE_TAG), 0)
+        data += chunk
+
+        end = data.find(SPECTRUM_CLOSE_TAG, search_start)
+        if end != -1:
+            return bytes(data[:end + len(SPECTRUM_CLOSE_TAG)])
+
+    raise Exception("Spectrum end not found at offset {}".format(offset))
+
+@lru_cache(maxsize=64)
+def _get_obo_translator(filename):
+    # pymzml reads the obo version from the mzML header, we only need to do it once per file
+    run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
+
+    return run.OT
+
+def _spectrum_from_bytes(spectrum_bytes, obo_translator):
+    spec = pymzml.spec.Spectrum(XML(spectrum_bytes), obo_version=obo_translator.version)
+    spec.measured_precision = MS_precisions.get(spec.ms_level, 20e-6)
+
+    return spec
+
+def iter_spectra_at_offsets(filename, offsets):
+    """
+    Yields pymzml spectra by seeking directly to each offset, the file is opened only once
+    """
+    obo_translator = _get_obo_translator(filename)
+
+    with open(filename, "rb") as file_handle:
+        for offset in offsets:
+            yield _spectrum_from_bytes(_read_spectrum_bytes(file_handle, int(offset)), obo_translator)
+
+def get_spectrum(filename, scan_number):
+    """
+    Gets a single spectrum by scan number or nativeID, None if the index is not available or the scan is not found
+    """
+    index_df = load_spectrum_index(filename)
+    if index_df is None:
+        return None
+
+    position = find_scan_position(filename, scan_number)
+    if position is None:
+        return None
+
+    offset = index_df["offset"].values[position]
+
+    return next(iter_spectra_at_offsets(filename, [offset]))
+
+def find_closest_scan(index_df, rt, ms_level=1):
+    """
+    Finds the closest scan in rt for the given ms level, None if there are no scans at that level
+    """
+    level_df = index_df[index_df["ms_level"] == ms_level]
+    if len(level_df) == 0:
+        return None
+
+    rt_values = level_df["rt"].values
+
+    if index_df.attrs.get("rt_sorted", False):
+        # Only the neighbors of the insertion point can be the closest
+        insert_position = np.searchsorted(rt_values, rt)
+        candidates = [position for position in [insert_position - 1, insert_position] if 0 <= position < len(rt_values)]
+        closest_position = min(candidates, key=lambda position: abs(rt_values[position] - rt))
+    else:
+        closest_position = int(np.argmin(np.abs(rt_values - rt)))
+
+    return _scan_identifier(level_df["scan"].values[closest_position])
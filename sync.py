@@ -1,28 +1,174 @@
 import json
 
-def _sychronize_save_state(session_id, parameter_dict, redis_client, synchronization_token=None):
-    session_dict = _sychronize_load_state(session_id, redis_client)
+import redis
+
+# Sessions are kept as two hashes, the json value of every field and the version it last changed at,
+# so a follower only has to fetch what moved since the version it has
+TOKEN_FIELD = "synchronization_token"
+SAVE_RETRIES = 10
+
+def _get_version_key(session_id):
+    return session_id + ":version"
+
+def _get_fields_key(session_id):
+    return session_id + ":fields"
+
+def _get_field_versions_key(session_id):
+    return session_id + ":fieldversions"
+
+def _migrate_legacy_state(session_id, redis_client):
+    # Sessions saved before the hashes were a single json blob under the session id
+    if redis_client.exists(_get_fields_key(session_id)) or redis_client.type(session_id) not in (b"string", "string"):
+        return
+
+    try:
+        session_dict = json.loads(redis_client.get(session_id))
+    except:
+        return
+
+    if len(session_dict) > 0:
+        version = redis_client.incr(_get_version_key(session_id))
+
+        pipe = redis_client.pipeline()
+        pipe.hset(_get_fields_key(session_id), mapping={field: json.dumps(value) for field, value in session_dict.items()})
+        pipe.hset(_get_field_versions_key(session_id), mapping={field: version for field in session_dict})
+        pipe.delete(session_id)
+        pipe.execute()
 
-    db_token = session_dict.get("synchronization_token", None)
+def _sychronize_save_fields(session_id, field_dict, redis_client, synchronization_token=None):
+    """
+    Writes the fields that changed, if the token matches the session's leader token, all at once
 
-    if db_token is not None:
-        if db_token != synchronization_token:
-            return
-        
-        # tokens are equal, so lets make sure to keep saving it
-        parameter_dict["synchronization_token"] = synchronization_token
+    Args:
+        session_id ([type]): [description]
+        field_dict ([type]): only the fields to write, the others are kept as they are
+        redis_client ([type]): [description]
+        synchronization_token ([type], optional): leader token, needed when the session has one. Defaults to None.
+
+    Returns:
+        [type]: new version, None when nothing was written
+    """
+    field_dict = {field: json.dumps(value) for field, value in field_dict.items() if field != TOKEN_FIELD}
+    if len(field_dict) == 0:
+        return None
+
+    fields_key = _get_fields_key(session_id)
+    field_versions_key = _get_field_versions_key(session_id)
+    version_key = _get_version_key(session_id)
 
     try:
-        redis_client.set(session_id, json.dumps(parameter_dict))
+        _migrate_legacy_state(session_id, redis_client)
+
+        with redis_client.pipeline() as pipe:
+            for attempt in range(SAVE_RETRIES):
+                try:
+                    # Anything else writing to the session in between makes the write start over
+                    pipe.watch(fields_key, version_key)
+
+                    db_token = pipe.hget(fields_key, TOKEN_FIELD)
+                    if db_token is not None and json.loads(db_token) != synchronization_token:
+                        return None
+
+                    existing_values = pipe.hmget(fields_key, list(field_dict.keys()))
+                    changed_fields = {field: value for (field, value), existing_value in zip(field_dict.items(), existing_values) if existing_value is None or existing_value.decode() != value}
+
+                    # Followers only reload when the version moves, so saving the same state again shouldn't move it
+                    if len(changed_fields) == 0:
+                        return None
+
+                    version = int(pipe.get(version_key) or 0) + 1
+
+                    pipe.multi()
+                    pipe.hset(fields_key, mapping=changed_fields)
+                    pipe.hset(field_versions_key, mapping={field: version for field in changed_fields})
+                    pipe.set(version_key, version)
+                    pipe.execute()
+
+                    return version
+                except redis.WatchError:
+                    continue
     except:
         pass
-    
+
+    return None
+
+def _sychronize_save_state(session_id, parameter_dict, redis_client, synchronization_token=None):
+    return _sychronize_save_fields(session_id, parameter_dict, redis_client, synchronization_token=synchronization_token)
+
+def _sychronize_claim_token(session_id, synchronization_token, redis_client):
+    """
+    Makes the token the session's leader token, unless it already has one
+
+    Returns:
+        [type]: True if the token is now the leader token
+    """
+    try:
+        _migrate_legacy_state(session_id, redis_client)
+
+        if not redis_client.hsetnx(_get_fields_key(session_id), TOKEN_FIELD, json.dumps(synchronization_token)):
+            return False
+
+        version = redis_client.incr(_get_version_key(session_id))
+        redis_client.hset(_get_field_versions_key(session_id), TOKEN_FIELD, version)
+        return True
+    except:
+        return False
+
+def _sychronize_load_version(session_id, redis_client):
+    """
+    Counter that goes up on every change of the session state, cheap enough to check every second
+    """
+    try:
+        return int(redis_client.get(_get_version_key(session_id)) or 0)
+    except:
+        return 0
+
 def _sychronize_load_state(session_id, redis_client):
     session_state = {}
 
     try:
-        session_state = json.loads(redis_client.get(session_id))
+        session_state = {field.decode(): json.loads(value) for field, value in redis_client.hgetall(_get_fields_key(session_id)).items()}
     except:
         pass
 
-    return session_state
\ No newline at end of file
+    if len(session_state) == 0:
+        try:
+            session_state = json.loads(redis_client.get(session_id))
+        except:
+            pass
+
+    return session_state
+
+def _sychronize_load_changed(session_id, since_version, redis_client):
+    """
+    Fields that changed after since_version, so large fields only go out when they actually change
+
+    Args:
+        session_id ([type]): [description]
+        since_version ([type]): version the caller already has, 0 for everything
+        redis_client ([type]): [description]
+
+    Returns:
+        [type]: current version, dict of the changed fields
+    """
+    try:
+        pipe = redis_client.pipeline()
+        pipe.get(_get_version_key(session_id))
+        pipe.hgetall(_get_field_versions_key(session_id))
+        version, field_versions = pipe.execute()
+        version = int(version or 0)
+    except:
+        return 0, {}
+
+    if since_version == 0 or len(field_versions) == 0:
+        return version, _sychronize_load_state(session_id, redis_client)
+
+    changed_fields = [field for field, field_version in field_versions.items() if int(field_version) > since_version]
+    if len(changed_fields) == 0:
+        return version, {}
+
+    try:
+        values = redis_client.hmget(_get_fields_key(session_id), changed_fields)
+        return version, {field.decode(): json.loads(value) for field, value in zip(changed_fields, values) if value is not None}
+    except:
+        return version, {}
@@ -0,0 +1,16 @@
+# Deadlines are a bit longer than the task time limits, to leave room for waiting in the queue
+DEFAULT_TIMEOUT = 180
+CONVERSION_TIMEOUT = 600
+
+def wait_for_result(result, timeout=DEFAULT_TIMEOUT):
+    """
+    Blocks until the task is done, the redis backend pushes the completion over pub/sub so we don't poll the status
+
+    Args:
+        result ([type]): celery AsyncResult
+        timeout ([type], optional): seconds to wait before raising celery.exceptions.TimeoutError. Defaults to DEFAULT_TIMEOUT.
+
+    Returns:
+        [type]: the task return value, task exceptions are raised here
+    """
+    return result.get(timeout=timeout, interval=0.1)
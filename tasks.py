@@ -1,4 +1,5 @@
-from celery import Celery
+from celery import Celery, chord
+from celery.exceptions import Ignore
 from celery_once import QueueOnce
 import download
 import os
@@ -10,9 +11,12 @@ import tic
 import glob
 import redis
 import json
+import pandas as pd
+import priority_lanes
+import task_wait
 from joblib import Memory
 
-from sync import _sychronize_save_state, _sychronize_load_state
+from sync import _sychronize_save_fields
 
 memory = Memory("temp/memory-cache", verbose=0)
 
@@ -33,6 +37,8 @@ celery_instance.conf.ONCE = {
 redis_client = redis.Redis(host='gnpslcms-redis', port=6379, db=0)
     
 
+BATCH_BACKGROUND_FILES = 30 # Batch XICs over more files than this run in the background lane
+
 #################################
 # Compute Data
 #################################
@@ -43,7 +49,7 @@ def task_lcms_aggregate(filename, min_rt, max_rt, min_mz, max_mz, polarity_filte
 
     _aggregate_lcms_map = lcms_map._aggregate_lcms_map
     aggregation, msn_df = _aggregate_lcms_map(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level)
-    return aggregation, msn_df.to_dict(orient="records")
+    return aggregation, lcms_map._encode_columns(msn_df)
 
 @celery_instance.task(time_limit=90, base=QueueOnce)
 def task_tic(input_filename, tic_option="TIC", polarity_filter="None"):
@@ -53,8 +59,7 @@ def task_tic(input_filename, tic_option="TIC", polarity_filter="None"):
     tic_df = tic_file(input_filename, tic_option=tic_option, polarity_filter=polarity_filter)
     return tic_df.to_dict(orient="records")
 
-@celery_instance.task(time_limit=60, base=QueueOnce)
-def task_xic(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=False):
+def _xic_records(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=False):
     # Caching
     xic_file = memory.cache(xic.xic_file)
 
@@ -72,6 +77,154 @@ def task_xic(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, x
             
     return xic_json, ms2_data
 
+@celery_instance.task(time_limit=60, base=QueueOnce)
+def task_xic(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=False):
+    return _xic_records(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=get_ms2)
+
+@celery_instance.task(time_limit=60, bind=True)
+def task_batch_xic(self, usi_filename_list, usi1_list, xic_norm, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter):
+    """
+    XIC for many files at once, each file is read once for all the targets and the files run in parallel
+
+    Args:
+        usi_filename_list ([type]): list of [usi, local_filename]
+        all_xic_values ([type]): json string of all the targets
+
+    Returns:
+        [type]: long format records and the ms2 data, from task_batch_xic_merge
+    """
+    get_ms2 = len(usi_filename_list) == 1 and len(json.loads(all_xic_values)) == 1
+    all_usi = [usi for usi, local_filename in usi_filename_list]
+
+    # Big batches go to the background lane, taking turns with the other sessions there so they don't hold up everyone's XICs
+    if len(usi_filename_list) > BATCH_BACKGROUND_FILES:
+        _submit_fair_batch(self.request.id, usi_filename_list, usi1_list, xic_norm, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+
+        # No result for now, the merge stores it under this task id once the batch finishes
+        raise Ignore()
+
+    per_file_tasks = [task_xic.s(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=get_ms2) for usi, local_filename in usi_filename_list]
+
+    # Handing off to the chord, the merged result comes back under this task id
+    raise self.replace(chord(per_file_tasks, task_batch_xic_merge.s(all_usi, usi1_list, xic_norm)))
+
+def _merge_batch_xic(all_results, all_usi, usi1_list, xic_norm):
+    df_long_list = []
+    ms2_data = {}
+    for usi_element, (xic_json, file_ms2_data) in zip(all_usi, all_results):
+        try:
+            xic_df = pd.DataFrame(xic_json)
+            df_long_list.append(xic.xic_long_format(xic_df, usi_element, usi1_list, xic_norm=xic_norm))
+            ms2_data = file_ms2_data
+        except:
+            pass
+
+    # A batch past its deadline can come back with nothing
+    if len(df_long_list) == 0:
+        return [], ms2_data
+
+    merged_df_long = pd.concat(df_long_list)
+
+    return merged_df_long.to_dict(orient="records"), ms2_data
+
+@celery_instance.task(time_limit=60)
+def task_batch_xic_merge(all_results, all_usi, usi1_list, xic_norm):
+    return _merge_batch_xic(all_results, all_usi, usi1_list, xic_norm)
+
+##############################
+# Batch XIC in the fair share lane
+##############################
+# The runners take the files in fair order, so the results can't come back through a chord.
+# Each file's result is left in redis under the batch and counted, the file that completes the count starts the merge.
+# A deadline task merges whatever is there if some files never report
+
+BATCH_RESULT_SECONDS = 3600
+BATCH_DEADLINE_SECONDS = task_wait.CONVERSION_TIMEOUT - 60 # Leaves the merge time to reach the app before it gives up
+
+def _get_batch_result_key(batch_id, file_index):
+    return "batchxic:{}:{}".format(batch_id, file_index)
+
+def _get_batch_meta_key(batch_id):
+    return "batchxic:{}:meta".format(batch_id)
+
+def _get_batch_done_key(batch_id):
+    return "batchxic:{}:done".format(batch_id)
+
+def _get_batch_finished_key(batch_id):
+    return "batchxic:{}:finished".format(batch_id)
+
+def _submit_fair_batch(batch_id, usi_filename_list, usi1_list, xic_norm, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter):
+    all_usi = [usi for usi, local_filename in usi_filename_list]
+
+    batch_meta = {"file_count": len(usi_filename_list), "all_usi": all_usi, "usi1_list": usi1_list, "xic_norm": xic_norm}
+    redis_client.set(_get_batch_meta_key(batch_id), json.dumps(batch_meta), ex=BATCH_RESULT_SECONDS)
+
+    lane = priority_lanes.background_lane("compute")
+    session = priority_lanes.session_key(all_usi)
+    for file_index, (usi, local_filename) in enumerate(usi_filename_list):
+        priority_lanes.submit_fair(lane, session, task_run_fair, "xic", [batch_id, file_index, local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter])
+
+    task_batch_xic_deadline.apply_async(args=[batch_id], countdown=BATCH_DEADLINE_SECONDS)
+
+def _finish_fair_batch(batch_id):
+    # Only once, whichever of the last file and the deadline gets here first
+    if not redis_client.set(_get_batch_finished_key(batch_id), 1, nx=True, ex=BATCH_RESULT_SECONDS):
+        return
+
+    batch_meta = json.loads(redis_client.get(_get_batch_meta_key(batch_id)))
+    result_keys = [_get_batch_result_key(batch_id, file_index) for file_index in range(batch_meta["file_count"])]
+    all_results = [json.loads(file_result) if file_result is not None else None for file_result in redis_client.mget(result_keys)]
+    redis_client.delete(*(result_keys + [_get_batch_meta_key(batch_id), _get_batch_done_key(batch_id)]))
+
+    finished_usi = [usi for usi, file_result in zip(batch_meta["all_usi"], all_results) if file_result is not None]
+    finished_results = [file_result for file_result in all_results if file_result is not None]
+    if len(finished_results) < len(all_results):
+        print("BATCH XIC PARTIAL", batch_id, len(finished_results), "of", len(all_results), flush=True)
+
+    # Same task id as the batch, so the app waiting on it gets the merged result
+    task_batch_xic_merge.apply_async(args=[finished_results, finished_usi, batch_meta["usi1_list"], batch_meta["xic_norm"]], task_id=batch_id)
+
+def _fair_xic(batch_id, file_index, local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter):
+    file_result = None
+    try:
+        file_result = _xic_records(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+    except Exception as e:
+        # Left out of the merge, the rest of the batch still comes back
+        print("BATCH XIC FAILED", local_filename, e, flush=True)
+    finally:
+        # Reporting even when we are out of time, so the batch isn't left waiting for this file
+        redis_client.set(_get_batch_result_key(batch_id, file_index), json.dumps(file_result), ex=BATCH_RESULT_SECONDS)
+        done_count = redis_client.incr(_get_batch_done_key(batch_id))
+        redis_client.expire(_get_batch_done_key(batch_id), BATCH_RESULT_SECONDS)
+
+        batch_meta = redis_client.get(_get_batch_meta_key(batch_id))
+        if batch_meta is not None and done_count >= json.loads(batch_meta)["file_count"]:
+            _finish_fair_batch(batch_id)
+
+# Background jobs that share their lane fairly between sessions, see priority_lanes
+FAIR_JOBS = {
+    "xic": _fair_xic
+}
+
+# The soft limit raises inside the job, so it still gets to report before the hard limit kills it
+@celery_instance.task(soft_time_limit=50, time_limit=60)
+def task_run_fair(lane):
+    """
+        Runs whichever job of the lane is next in fair order, not necessarily the one queued with this task
+    """
+
+    job = priority_lanes.pop_fair(lane)
+    if job is None:
+        return
+
+    job_name, job_args = job
+    FAIR_JOBS[job_name](*job_args)
+
+@celery_instance.task(time_limit=60)
+def task_batch_xic_deadline(batch_id):
+    # Files that never reported are left out, the ones that did still come back
+    _finish_fair_batch(batch_id)
+
 @celery_instance.task(time_limit=60)
 def task_chromatogram_options(local_filename):
     # Caching
@@ -109,23 +262,20 @@ def _task_massql_cache(filename):
 
 @celery_instance.task(time_limit=1)
 def task_collabsync(session_id, triggered_fields, full_params, synchronization_token=None):
-    existing_params = _sychronize_load_state(session_id, redis_client)
-
     print("TRIGGERED FIELDS", triggered_fields)
 
     # Here we only update if we see a single update field, to make sure to avoid initial loads the wipe out everything
+    changed_params = {}
     if len(triggered_fields) <= 2:
         for field in triggered_fields:
             try:
                 field_value = field.split(".")[0]
-                #print(field_value)
-                existing_params[field_value] = full_params[field_value]
+                changed_params[field_value] = full_params[field_value]
             except:
                 pass
 
-    #import json
-    #print(json.dumps(existing_params, indent=4))
-    _sychronize_save_state(session_id, existing_params, redis_client, synchronization_token=synchronization_token)
+    # Only the triggered fields are written, the token check and the write happen together
+    _sychronize_save_fields(session_id, changed_params, redis_client, synchronization_token=synchronization_token)
 
 @celery_instance.task(time_limit=60)
 def task_computeheartbeat():
@@ -174,17 +324,21 @@ celery_instance.conf.beat_schedule = {
 
 
 celery_instance.conf.task_routes = {
-    'tasks._task_cleanup': {'queue': 'compute'},
+    'tasks._task_cleanup': {'queue': 'compute_background'},
 
     'tasks.task_lcms_aggregate': {'queue': 'compute'},
 
     'tasks.task_tic': {'queue': 'compute'},
     'tasks.task_xic': {'queue': 'compute'},
+    'tasks.task_batch_xic': {'queue': 'compute'},
+    'tasks.task_batch_xic_merge': {'queue': 'compute'},
+    'tasks.task_batch_xic_deadline': {'queue': 'compute'},
+    'tasks.task_run_fair': {'queue': 'compute_background'},
 
     'tasks.task_computeheartbeat': {'queue': 'compute'},
 
     'tasks.task_featurefinding': {'queue': 'featurefinding'},
-    'tasks._task_massql_cache': {'queue': 'featurefinding'},
+    'tasks._task_massql_cache': {'queue': 'featurefinding_background'},
 
     'tasks.task_collabsync': {'queue': 'sync'},
 }
@@ -3,6 +3,10 @@ from celery_once import QueueOnce
 import download
 import os
 import lcms_map
+import spectrum_index
+import peak_store
+import map_pyramid
+import priority_lanes
 
 # Setting up celery
 celery_instance = Celery('lcms_tasks', backend='redis://gnpslcms-redis', broker='redis://gnpslcms-redis')
@@ -45,18 +49,90 @@ def _convert_file_feather(usi, temp_folder="temp"):
 
     if download._resolve_exists_local(usi, temp_folder=temp_folder):
         local_filename = os.path.join(temp_folder, download._usi_to_local_filename(usi))
-        ms1_filename, msn_filename = lcms_map._get_feather_filenames(local_filename)
+        _build_derived_files(local_filename)
 
-        if os.path.exists(ms1_filename):
-            return
+def _build_derived_files(local_filename):
+    """
+    Builds whatever is missing of the index, peak store, summary, pyramid and feathers for a converted file
+    """
+    ms1_filename, msn_filename = lcms_map._get_feather_filenames(local_filename)
+
+    # Files converted before we had the spectrum index get it here
+    if not os.path.exists(spectrum_index._get_index_filename(local_filename)):
+        download._build_spectrum_index(local_filename)
+
+    mz_filename, i_filename, scans_filename = peak_store._get_peak_store_filenames(local_filename)
+    if not os.path.exists(scans_filename):
+        peak_store.build_peak_store(local_filename)
+    elif not os.path.exists(peak_store._get_summary_filename(local_filename)):
+        peak_store.build_scan_summary(local_filename)
+
+    if not os.path.exists(map_pyramid._get_pyramid_filename(local_filename)):
+        try:
+            map_pyramid.build_pyramid(local_filename)
+        except:
+            print("PYRAMID FAILED", local_filename)
+
+    # Feathers from before the zone map get rewritten in the scan ordered layout
+    if os.path.exists(ms1_filename) and os.path.exists(lcms_map._get_feather_zones_filename(local_filename)):
+        return
+
+    # Let's do stuff here
+    lcms_map._save_lcms_data_feather(local_filename)
+
+def is_file_ready(local_filename):
+    """
+    True when everything the plots read for the file has been built
+    """
+    ms1_filename, msn_filename = lcms_map._get_feather_filenames(local_filename)
+    mz_filename, i_filename, scans_filename = peak_store._get_peak_store_filenames(local_filename)
+
+    return os.path.exists(lcms_map._get_feather_zones_filename(local_filename)) and os.path.exists(ms1_filename) and os.path.exists(scans_filename)
+
+def _prefetch_file(usi, temp_folder="temp"):
+    """
+        Downloads, converts and builds everything for a file ahead of the plots asking for it
+    """
+
+    try:
+        remote_link, local_filename = download._resolve_usi(usi, temp_folder=temp_folder)
+
+        if not is_file_ready(local_filename):
+            download.report_resolve_progress(usi, "Building", temp_folder=temp_folder)
+            _build_derived_files(local_filename)
+
+        download.report_resolve_progress(usi, "Ready", temp_folder=temp_folder)
+    except Exception as e:
+        print("PREFETCH FAILED", usi, e, flush=True)
+        download.report_resolve_progress(usi, "Failed", temp_folder=temp_folder)
+
+
+
+# Background jobs that share their lane fairly between sessions, see priority_lanes
+FAIR_JOBS = {
+    "prefetch": _prefetch_file
+}
+
+@celery_instance.task(time_limit=1800)
+def task_run_fair(lane):
+    """
+        Runs whichever job of the lane is next in fair order, not necessarily the one queued with this task
+    """
+
+    job = priority_lanes.pop_fair(lane)
+    if job is None:
+        return
 
-        # Let's do stuff here
-        lcms_map._save_lcms_data_feather(local_filename)
+    job_name, job_args = job
+    FAIR_JOBS[job_name](*job_args)
 
+def schedule_prefetch(usi, session, temp_folder="temp"):
+    return priority_lanes.submit_fair("conversion_background", session, task_run_fair, "prefetch", [usi, temp_folder])
 
 
 celery_instance.conf.task_routes = {
     'tasks_conversion.conversion_heartbeat': {'queue': 'conversion'},
     'tasks_conversion._download_convert_file': {'queue': 'conversion'},
     'tasks_conversion._convert_file_feather': {'queue': 'conversion'},
+    'tasks_conversion.task_run_fair': {'queue': 'conversion_background'},
 }
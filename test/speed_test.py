@@ -8,6 +8,8 @@ import time
 import lcms_map
 import tic
 import os
+import ms2
+import numpy as np
 
 ####################################
 # XIC Tests
@@ -73,6 +75,43 @@ def test_xic_proteomics_slow():
 
 
 
+####################################
+# MS2 Labeling Tests
+####################################
+def _proteomics_like_peaks(peak_count=5000):
+    random_state = np.random.RandomState(0)
+    mzs = np.sort(np.round(random_state.uniform(100, 2000, peak_count), 4)).tolist()
+    ints = np.round(random_state.lognormal(8, 2, peak_count), 1).tolist()
+    return mzs, ints
+
+def test_ms2_labels_fast():
+    mzs, ints = _proteomics_like_peaks()
+    ms2._get_ms_peak_labels(mzs, ints)
+    ms2._get_ms_hover(mzs, ints)
+
+def test_ms2_labels_slow():
+    mzs, ints = _proteomics_like_peaks()
+    ms2._get_ms_peak_labels_slow(mzs, ints)
+    ms2._get_ms_hover_slow(mzs, ints)
+
+def test_ms2_labels_benchmark():
+    mzs, ints = _proteomics_like_peaks()
+
+    for function_fast, function_slow in [(ms2._get_ms_peak_labels, ms2._get_ms_peak_labels_slow), (ms2._get_ms_hover, ms2._get_ms_hover_slow)]:
+        start_time = time.time()
+        for i in range(10):
+            fast_result = function_fast(mzs, ints)
+        fast_time = (time.time() - start_time) / 10
+
+        start_time = time.time()
+        for i in range(10):
+            slow_result = function_slow(mzs, ints)
+        slow_time = (time.time() - start_time) / 10
+
+        print(function_fast.__name__, "FAST", fast_time, "SLOW", slow_time, "SPEEDUP", slow_time / fast_time)
+        assert(fast_result == slow_result)
+
+
 ####################################
 # 2D Map Tests
 ####################################
@@ -22,6 +22,19 @@ def test_tic_fast():
         remote_link, local_filename = download._resolve_usi(record["usi"])
         tic._tic_file_fast(local_filename)
 
+def test_tic_summary():
+    import peak_store
+
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    peak_store.build_peak_store(local_filename)
+
+    for tic_option in ["TIC", "BPI"]:
+        summary_df = tic._tic_file_summary(local_filename, tic_option=tic_option)
+        slow_df = tic._tic_file_slow(local_filename, tic_option=tic_option)
+
+        assert(len(summary_df) == len(slow_df))
+        assert(abs(summary_df["tic"].sum() - slow_df["tic"].sum()) / slow_df["tic"].sum() < 0.001)
+
 def test_url_parsing():
     params_string = '?xicmz=271.0315%3B278.1902%3B279.0909%3B285.0205%3B311.0805%3B314.1381&xic_formula=&xic_peptide=&xic_tolerance=0.5&xic_ppm_tolerance=10&xic_tolerance_unit=Da&xic_rt_window=&xic_norm=False&xic_file_grouping=FILE&xic_integration_type=AUC&show_ms2_markers=True&ms2_identifier=None&show_lcms_2nd_map=False&map_plot_zoom=%7B%22xaxis.range%5B0%5D%22%3A+3.225196497160058%2C+%22xaxis.range%5B1%5D%22%3A+3.4834247492797554%2C+%22yaxis.range%5B0%5D%22%3A+521.8432333663449%2C+%22yaxis.range%5B1%5D%22%3A+615.6041749343235%7D&polarity_filtering=None&polarity_filtering2=None&tic_option=TIC&overlay_usi=None&overlay_mz=row+m%2Fz&overlay_rt=row+retention+time&overlay_color=&overlay_size=&feature_finding_type=Off'
 
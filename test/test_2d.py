@@ -22,4 +22,18 @@ def test_2d_mapping_many():
         print(record["usi"])
         remote_link, local_filename = download._resolve_usi(record["usi"])
         agg_dict, msn_results = lcms_map._aggregate_lcms_map(local_filename, 0, 300, 0, 2000)
-        lcms_map._create_map_fig(agg_dict, msn_results)
\ No newline at end of file
+        lcms_map._create_map_fig(agg_dict, msn_results)
+
+def test_2d_mapping_pyramid():
+    import peak_store
+    import map_pyramid
+
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    peak_store.build_peak_store(local_filename)
+    map_pyramid.build_pyramid(local_filename)
+
+    values, rt_coords, mz_coords = map_pyramid.aggregate_window(local_filename, 0, 1000000, 0, 2000, 120, 80)
+    assert(values.shape == (80, 120))
+
+    agg_dict, msn_results = lcms_map._aggregate_lcms_map(local_filename, 0, 1000000, 0, 2000)
+    lcms_map._create_map_fig(agg_dict, msn_results)
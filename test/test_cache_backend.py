@@ -0,0 +1,96 @@
+import sys
+sys.path.insert(0, "..")
+import cache_backend
+
+def test_memory_lru_eviction():
+    cache = cache_backend.MemoryLRUCache(default_timeout=0, max_bytes=3000)
+
+    for i in range(5):
+        cache.set(str(i), "x" * 900)
+
+    # Oldest ones are evicted to stay under budget
+    assert(cache.get("0") is None)
+    assert(cache.get("4") == "x" * 900)
+
+    stats = cache.get_stats()
+    assert(stats["bytes"] <= 3000)
+    assert(stats["evictions"] > 0)
+    assert(stats["hits"] == 1)
+    assert(stats["misses"] == 1)
+
+def test_memory_lru_recency():
+    cache = cache_backend.MemoryLRUCache(default_timeout=0, max_bytes=3000)
+
+    cache.set("a", "x" * 900)
+    cache.set("b", "x" * 900)
+    cache.set("c", "x" * 900)
+
+    # Touching a makes b the least recently used
+    cache.get("a")
+    cache.set("d", "x" * 900)
+
+    assert(cache.get("a") is not None)
+    assert(cache.get("b") is None)
+
+def _redis_cache(max_bytes):
+    import os
+    import uuid
+
+    cache = cache_backend.RedisLRUCache(host=os.environ.get("LCMS_REDIS_HOST", "gnpslcms-redis"), default_timeout=0, max_bytes=max_bytes, key_prefix="lrucachetest:{}:".format(uuid.uuid4()))
+
+    # Running outside of the docker network, an in process redis stands in
+    try:
+        cache._client.ping()
+    except:
+        import pytest
+        fakeredis = pytest.importorskip("fakeredis")
+        cache._set_client(fakeredis.FakeRedis())
+
+    return cache
+
+def test_redis_lru_eviction():
+    cache = _redis_cache(3000)
+
+    for i in range(5):
+        cache.set(str(i), "x" * 900)
+
+    assert(cache.get("0") is None)
+    assert(cache.get("4") == "x" * 900)
+
+    # The total matches what is actually left
+    stats = cache.get_stats()
+    assert(stats["bytes"] == sum(int(size) for size in cache._client.hvals(cache._sizes_key)))
+    assert(stats["bytes"] <= 3000)
+    assert(stats["evictions"] > 0)
+
+    cache.clear()
+
+def test_redis_lru_concurrent_forget():
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = _redis_cache(3000)
+    cache.set("a", "x" * 900)
+
+    # Everyone deleting the same key only takes its size off once
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: cache.delete("a"), range(8)))
+
+    assert(cache.get_stats()["bytes"] == 0)
+
+    cache.clear()
+
+def test_redis_lru_expired_swept():
+    import time
+
+    cache = _redis_cache(3000)
+    cache.set("a", "x" * 900, timeout=1)
+    time.sleep(1.5)
+
+    # Nobody reads a again, the next set sweeps it
+    cache.set("b", "x" * 900)
+
+    stats = cache.get_stats()
+    assert(stats["entries"] == 1)
+    assert(stats["bytes"] == len(cache._client.get(cache._data_key("b"))))
+
+    cache.clear()
@@ -0,0 +1,93 @@
+import sys
+import json
+import threading
+sys.path.insert(0, "..")
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import resolution_cache
+import single_flight
+import download_msv
+
+# Stand in for MassIVE, counting the lookups that reach it
+class StubMassIVEHandler(BaseHTTPRequestHandler):
+    request_count = 0
+
+    def do_GET(self):
+        StubMassIVEHandler.request_count += 1
+
+        if "MSV000000000" in self.path:
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        response = {"row_data": [{"file_descriptor": "f.MSV000085852/peak/QC_0.mzML"}]}
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(response).encode())
+
+    def log_message(self, format, *args):
+        pass
+
+def _start_stub_server():
+    server = HTTPServer(("127.0.0.1", 0), StubMassIVEHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def _setup_cache(tmp_path, monkeypatch, server):
+    # Always the sqlite file, a redis that happens to be reachable would keep results between runs
+    monkeypatch.setattr(single_flight, "_get_redis", lambda: None)
+    monkeypatch.setattr(resolution_cache, "CACHE_FILENAME", str(tmp_path / "resolution_cache.sqlite"))
+    monkeypatch.setattr(download_msv, "MASSIVE_URL", "http://127.0.0.1:{}".format(server.server_port))
+
+def test_resolution_cached(tmp_path, monkeypatch):
+    server = _start_stub_server()
+    _setup_cache(tmp_path, monkeypatch, server)
+    StubMassIVEHandler.request_count = 0
+
+    usi = "mzspec:MSV000085852:QC_0"
+    remote_link = download_msv._resolve_msv_usi(usi)
+    assert("QC_0.mzML" in remote_link)
+
+    # Second time comes from the cache
+    assert(download_msv._resolve_msv_usi(usi) == remote_link)
+    assert(StubMassIVEHandler.request_count == 1)
+
+    server.shutdown()
+
+def test_resolution_coalesced(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    server = _start_stub_server()
+    _setup_cache(tmp_path, monkeypatch, server)
+    StubMassIVEHandler.request_count = 0
+
+    usi = "mzspec:MSV000085852:QC_1"
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        remote_links = list(executor.map(lambda i: download_msv._resolve_msv_usi(usi), range(8)))
+
+    assert(len(set(remote_links)) == 1)
+    assert(StubMassIVEHandler.request_count == 1)
+
+    server.shutdown()
+
+def test_resolution_negative_cached(tmp_path, monkeypatch):
+    server = _start_stub_server()
+    _setup_cache(tmp_path, monkeypatch, server)
+    StubMassIVEHandler.request_count = 0
+
+    usi = "mzspec:MSV000000000:missing"
+    for i in range(2):
+        try:
+            download_msv._resolve_msv_usi(usi)
+            assert(False)
+        except Exception as e:
+            print(e)
+
+    assert(StubMassIVEHandler.request_count == 1)
+
+    # Forcing massive falls back to the dataset path instead of failing
+    remote_link = download_msv._resolve_msv_usi(usi, force_massive=True)
+    assert("MSV000000000" in remote_link)
+
+    server.shutdown()
@@ -0,0 +1,39 @@
+import sys
+sys.path.insert(0, "..")
+import os
+import pymzml
+import download
+import spectrum_index
+import ms2
+import utils
+
+def test_build_index():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    index_filename = spectrum_index.build_spectrum_index(local_filename)
+
+    assert(os.path.exists(index_filename))
+
+    index_df = spectrum_index.load_spectrum_index(local_filename)
+    assert(len(index_df) > 100)
+
+def test_index_scan_lookup():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    spectrum_index.build_spectrum_index(local_filename)
+
+    run = pymzml.run.Reader(local_filename, MS_precisions=utils.MS_precisions)
+    indexed_spectrum = spectrum_index.get_spectrum(local_filename, 2625)
+
+    assert(indexed_spectrum.ID == run[2625].ID)
+    assert(len(indexed_spectrum.peaks("raw")) == len(run[2625].peaks("raw")))
+
+def test_index_rt_window():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    spectrum_index.build_spectrum_index(local_filename)
+
+    all_rt = [spec.scan_time_in_minutes() for spec in utils._spectrum_generator(local_filename, 5, 6)]
+    assert(len(all_rt) > 0)
+    assert(min(all_rt) >= 5)
+    assert(max(all_rt) <= 6)
+
+    closest_scan = ms2.determine_scan_by_rt("mzspec:MSV000085852:QC_0", local_filename, 5.5)
+    assert(int(closest_scan) > 0)
@@ -6,6 +6,7 @@ import pandas as pd
 import xic
 import download
 import lcms_map
+import peak_store
 
 # Testing remote link calculation
 def test_resolve_remote_url():
@@ -42,6 +43,33 @@ def test_feather_download_convert():
         assert("polarity" in ms1_results)
         
 
+# Testing we can make the memory mapped peak store
+def test_peak_store_download_convert():
+    df = pd.read_csv("usi_list.tsv", sep='\t')
+    for record in df.to_dict(orient="records"):
+        print(record["usi"])
+        remote_link, local_filename = download._resolve_usi(record["usi"])
+        peak_store.build_peak_store(local_filename)
+
+        scans, mz, intensity = peak_store.load_peak_store(local_filename)
+        assert(len(mz) == len(intensity))
+        assert(scans["end"][-1] == len(mz))
+
+# Testing concurrent requests for the same file share one download
+def test_resolve_concurrent():
+    from concurrent.futures import ThreadPoolExecutor
+
+    usi = "mzspec:MSV000085852:QC_0"
+    local_filename = os.path.join("temp", download._usi_to_local_filename(usi))
+    if os.path.exists(local_filename):
+        os.remove(local_filename)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda i: download._resolve_usi(usi), range(4)))
+
+    assert(len(set(result[1] for result in results)) == 1)
+    assert(os.path.exists(local_filename))
+
 # Testing to local filenames
 def test_resolve_filename():
     df = pd.read_csv("usi_list.tsv", sep='\t')
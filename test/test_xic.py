@@ -44,3 +44,32 @@ def test_xic_wrapper():
     xic.xic_file(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=True)
     xic.xic_file(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=False)
 
+
+def test_xic_store():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+
+    all_xic_values = [["278.1902", 278.1902], ["279.1902", 279.1902]]
+    xic_tolerance = 0.5
+    xic_ppm_tolerance = 10
+    xic_tolerance_unit = "Da"
+    rt_min = 5
+    rt_max = 6
+    polarity_filter = "Positive"
+
+    store_df, store_ms2 = xic._xic_file_store(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+    slow_df, slow_ms2 = xic._xic_file_slow(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+
+    assert len(store_df) == len(slow_df)
+    assert abs(store_df["XIC 278.1902"].sum() - slow_df["XIC 278.1902"].sum()) / slow_df["XIC 278.1902"].sum() < 0.01
+
+def test_xic_long_format():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+
+    all_xic_values = [["278.1902", 278.1902], ["279.1902", 279.1902]]
+    xic_df, ms2_data = xic.xic_file(local_filename, all_xic_values, 0.5, 10, "Da", 5, 6, "None")
+
+    df_long = xic.xic_long_format(xic_df, "mzspec:MSV000085852:QC_0", ["mzspec:MSV000085852:QC_0"], xic_norm=True)
+
+    assert len(df_long) == 2 * len(xic_df)
+    assert set(df_long["GROUP"]) == set(["TOP"])
+    assert df_long["value"].max() <= 1
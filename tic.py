@@ -1,11 +1,15 @@
 from utils import _get_scan_polarity, _spectrum_generator
 import pymzml
-from utils import MS_precisions
+from utils import MS_precisions, MSACCESS_ENABLED
 import pandas as pd
 import uuid
 import os
 import glob
 import shutil
+import sys
+import time
+import peak_store
+from spectrum_index import POLARITY_POS, POLARITY_NEG
 
 def tic_file(input_filename, tic_option="TIC", polarity_filter="None"):
     """
@@ -19,13 +23,53 @@ def tic_file(input_filename, tic_option="TIC", polarity_filter="None"):
     Returns:
         [type]: [description]
     """
-    if tic_option == "TIC" and polarity_filter == "None":
+    # Precomputed at conversion, any option is just a slice
+    start_time = time.time()
+    try:
+        result = _tic_file_summary(input_filename, tic_option=tic_option, polarity_filter=polarity_filter)
+        print("TIC SUMMARY", time.time() - start_time, file=sys.stderr, flush=True)
+        return result
+    except Exception as e:
+        print("TIC SUMMARY NOT USED", e, file=sys.stderr, flush=True)
+
+    if tic_option == "TIC" and polarity_filter == "None" and MSACCESS_ENABLED:
+        start_time = time.time()
         try:
-            return _tic_file_fast(input_filename)
-        except:
-            pass
+            result = _tic_file_fast(input_filename)
+            print("TIC MSACCESS", time.time() - start_time, file=sys.stderr, flush=True)
+            return result
+        except Exception as e:
+            print("TIC MSACCESS FAILED", e, file=sys.stderr, flush=True)
 
-    return _tic_file_slow(input_filename, tic_option=tic_option, polarity_filter=polarity_filter)
+    start_time = time.time()
+    result = _tic_file_slow(input_filename, tic_option=tic_option, polarity_filter=polarity_filter)
+    print("TIC PARSED", time.time() - start_time, file=sys.stderr, flush=True)
+
+    return result
+
+def _tic_file_summary(input_filename, tic_option="TIC", polarity_filter="None"):
+    summary = peak_store.load_scan_summary(input_filename)
+    if summary is None:
+        raise Exception("Scan summary not available")
+
+    keep_mask = summary["ms_level"] == 1
+    if polarity_filter == "Positive":
+        keep_mask &= summary["polarity"] == POLARITY_POS
+    elif polarity_filter == "Negative":
+        keep_mask &= summary["polarity"] == POLARITY_NEG
+
+    ms1_summary = summary[keep_mask]
+
+    tic_df = pd.DataFrame()
+    if tic_option == "TIC":
+        tic_df["tic"] = ms1_summary["tic"]
+    elif tic_option == "BPI":
+        tic_df["tic"] = ms1_summary["bpi"]
+    else:
+        raise Exception("Unknown TIC option {}".format(tic_option))
+    tic_df["rt"] = ms1_summary["rt"]
+
+    return tic_df
 
 def _tic_file_slow(input_filename, tic_option="TIC", polarity_filter="None"):
     # Performing TIC Plot
@@ -64,8 +108,10 @@ def _tic_file_fast(input_filename, temp_folder="temp"):
 
     cmd = 'export LC_ALL=C && ./bin/msaccess {} -o {} -x "tic delimiter=tab" --filter "msLevel 1"'.format(input_filename, temp_result_folder)
 
-    os.system(cmd)
     print(cmd)
+    if os.system(cmd) != 0:
+        shutil.rmtree(temp_result_folder, ignore_errors=True)
+        raise Exception("msaccess failed")
 
     # Reading output file
     result_filename = glob.glob(os.path.join(temp_result_folder, "*"))[0]
@@ -12,6 +12,9 @@ from tqdm import tqdm
 from time import sleep
 import sys
 
+# msaccess is only a fallback to the in process backends, LCMS_MSACCESS=0 turns it off
+MSACCESS_ENABLED = os.environ.get("LCMS_MSACCESS", "1") == "1"
+
 MS_precisions = {
     1 : 5e-6,
     2 : 20e-6,
@@ -28,12 +31,22 @@ import subprocess, io
 
 
 def _calculate_file_stats(usi, local_filename):
-    run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions)
-    number_scans = run.get_spectrum_count()
-
     response_dict = {}
     response_dict["USI"] = usi
-    response_dict["Scans"] = number_scans
+
+    # Counting from the spectrum index, msaccess is only needed for the instrument fields
+    import spectrum_index
+    index_df = spectrum_index.load_spectrum_index(local_filename)
+    if index_df is not None:
+        response_dict["Scans"] = len(index_df)
+        response_dict["MS1s"] = int((index_df["ms_level"] == 1).sum())
+        response_dict["MS2s"] = int((index_df["ms_level"] == 2).sum())
+    else:
+        run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions)
+        response_dict["Scans"] = run.get_spectrum_count()
+
+    if not MSACCESS_ENABLED:
+        return response_dict
 
     try:
         cmd = ["./bin/msaccess", local_filename, "-x",  'run_summary delimiter=tab']
@@ -55,6 +68,8 @@ def _calculate_file_stats(usi, local_filename):
 
         fields = ["Vendor", "Model", "MS1s", "MS2s"]
         for field in fields:
+            if field in response_dict:
+                continue
             if field in record:
                 response_dict[field] = record[field]
             else:
@@ -113,6 +128,46 @@ def _get_param_from_url(search, url_hash, param_key, default, session_dict={}, o
         return no_change_default
     return param_value
 
+# Parses the url and takes the session once, so that every callback can look up its parameters from the result
+def _resolve_parameters(search, url_hash, session_dict={}):
+    query_dict = {}
+    try:
+        params_dict = urllib.parse.parse_qs(search[1:])
+        query_dict = {param_key: str(params_dict[param_key][0]) for param_key in params_dict}
+    except:
+        pass
+
+    hash_dict = {}
+    try:
+        hash_dict = {param_key: str(param_value) for param_key, param_value in json.loads(urllib.parse.unquote(url_hash[1:])).items()}
+    except:
+        pass
+
+    resolved_parameters = {}
+    resolved_parameters["url_search"] = search
+    resolved_parameters["session"] = session_dict
+    resolved_parameters["query"] = query_dict
+    resolved_parameters["hash"] = hash_dict
+
+    return resolved_parameters
+
+# Same order as _get_param_from_url, session then url query then url hash
+def _get_resolved_param(resolved_parameters, param_key, default, old_value=None, no_change_default=None, use_hash=False):
+    sources = ["session", "query"]
+    if use_hash:
+        sources.append("hash")
+
+    param_value = default
+    for source in sources:
+        source_dict = resolved_parameters.get(source, {})
+        if param_key in source_dict:
+            param_value = source_dict[param_key]
+            break
+
+    if param_value == old_value:
+        return no_change_default
+    return param_value
+
 def _resolve_map_plot_selection(url_search, usi, local_filename, 
                 ui_map_selection=None, 
                 map_plot_rt_min="",
@@ -160,8 +215,11 @@ def _resolve_map_plot_selection(url_search, usi, local_filename,
                 # Lets get out of here and not set anything
                 raise Exception
             
-            run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions)
-            spec = run[scan_number]
+            import spectrum_index
+            spec = spectrum_index.get_spectrum(local_filename, scan_number)
+            if spec is None:
+                run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions)
+                spec = run[scan_number]
             rt = spec.scan_time_in_minutes()
             mz = spec.selected_precursors[0]["mz"]
 
@@ -304,26 +362,38 @@ def _find_lcms_rt(run, rt_query):
 
 
 def _spectrum_generator(filename, min_rt, max_rt):
-    run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
-
     # Don't do this if the min_rt and max_rt are not reasonable values
     if min_rt <= 0 and max_rt > 1000:
+        run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
         for spec in run:
             yield spec
-    else:
-        try:
-            min_rt_index = _find_lcms_rt(run, min_rt) # These are inclusive on left
-            max_rt_index = _find_lcms_rt(run, max_rt) + 1 # Exclusive on the right
-
-            for spec_index in tqdm(range(min_rt_index, max_rt_index)):
-                spec = run[spec_index]
-                yield spec
-            print("USED INDEX")
-        except:
-            run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
-            for spec in run:
-                yield spec
-            print("USED BRUTEFORCE")
+        return
+
+    # Using the sidecar index if it has been built, so we seek directly to the spectra in the window
+    import spectrum_index
+    index_df = spectrum_index.load_spectrum_index(filename)
+    if index_df is not None:
+        positions = spectrum_index.rt_range_positions(index_df, min_rt, max_rt)
+        offsets = index_df["offset"].values[positions]
+        for spec in spectrum_index.iter_spectra_at_offsets(filename, offsets):
+            yield spec
+        print("SPECTRUM INDEX", filename, len(offsets), file=sys.stderr, flush=True)
+        return
+
+    run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
+    try:
+        min_rt_index = _find_lcms_rt(run, min_rt) # These are inclusive on left
+        max_rt_index = _find_lcms_rt(run, max_rt) + 1 # Exclusive on the right
+
+        for spec_index in tqdm(range(min_rt_index, max_rt_index)):
+            spec = run[spec_index]
+            yield spec
+        print("USED INDEX")
+    except:
+        run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
+        for spec in run:
+            yield spec
+        print("USED BRUTEFORCE")
 
 # Getting the Overlay data
 def _resolve_overlay(overlay_usi, overlay_mz, overlay_rt, overlay_filter_column, overlay_filter_value, overlay_size, overlay_color, overlay_hover, overlay_tabular_data=""):
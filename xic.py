@@ -7,9 +7,13 @@ import os
 import shutil
 import glob
 import logging
+import sys
+import time
 
 from utils import _get_scan_polarity, _spectrum_generator
-from utils import MS_precisions
+from utils import MS_precisions, MSACCESS_ENABLED
+import peak_store
+import spectrum_index
 
 def _calculate_upper_lower_tolerance(target_mz, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit):
     if xic_tolerance_unit == "Da":
@@ -18,6 +22,57 @@ def _calculate_upper_lower_tolerance(target_mz, xic_tolerance, xic_ppm_tolerance
         calculated_tolerance = target_mz / 1000000 * xic_ppm_tolerance
         return target_mz - calculated_tolerance, target_mz + calculated_tolerance
 
+def _target_windows(all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit):
+    """
+    Returns the lower and upper mz bounds of all the targets as arrays, in the order of all_xic_values
+    """
+    lower_bounds = []
+    upper_bounds = []
+    for target_mz in all_xic_values:
+        lower_tolerance, upper_tolerance = _calculate_upper_lower_tolerance(target_mz[1], xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
+        lower_bounds.append(lower_tolerance)
+        upper_bounds.append(upper_tolerance)
+
+    return np.array(lower_bounds, dtype=np.float64), np.array(upper_bounds, dtype=np.float64)
+
+def _sum_target_windows(mz, intensity, lower_bounds, upper_bounds):
+    """
+    Sums the intensity within every target window for a single scan, mz has to be sorted
+
+    Args:
+        mz ([type]): sorted mz of the scan
+        intensity ([type]): intensity of the scan
+        lower_bounds ([type]): lower bounds of the targets, inclusive
+        upper_bounds ([type]): upper bounds of the targets, inclusive
+
+    Returns:
+        [type]: summed intensity per target, in the order of the bounds
+    """
+    # Sorting the windows so the binary searches walk the scan in order
+    window_order = np.argsort(lower_bounds, kind="stable")
+    sorted_lower = lower_bounds[window_order]
+    sorted_upper = upper_bounds[window_order]
+
+    lower_indices = np.searchsorted(mz, sorted_lower, side="left")
+    upper_indices = np.searchsorted(mz, sorted_upper, side="right")
+
+    # reduceat sums between consecutive boundaries, so we interleave lower and upper and keep every other sum
+    # The trailing zero keeps boundaries at the end of the scan valid
+    padded_intensity = np.append(np.asarray(intensity, dtype=np.float64), 0.0)
+    boundaries = np.empty(2 * len(window_order), dtype=np.intp)
+    boundaries[0::2] = lower_indices
+    boundaries[1::2] = upper_indices
+
+    sorted_sums = np.add.reduceat(padded_intensity, boundaries)[0::2]
+
+    # reduceat gives back a single element for empty windows
+    sorted_sums[upper_indices <= lower_indices] = 0.0
+
+    target_sums = np.empty_like(sorted_sums)
+    target_sums[window_order] = sorted_sums
+
+    return target_sums
+
 def xic_file(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=False):
     """This is the external function that others will call to get XIC data
 
@@ -35,13 +90,29 @@ def xic_file(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, x
     Returns:
         [type]: [description]
     """
-    if get_ms2 is False:
+    # All targets in one pass over the memory mapped peak store
+    start_time = time.time()
+    try:
+        result = _xic_file_store(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=get_ms2)
+        print("XIC STORE", time.time() - start_time, file=sys.stderr, flush=True)
+        return result
+    except Exception as e:
+        print("XIC STORE NOT USED", e, file=sys.stderr, flush=True)
+
+    if get_ms2 is False and MSACCESS_ENABLED:
+        start_time = time.time()
         try:
-            return _xic_file_fast(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
-        except:
-            pass
+            result = _xic_file_fast(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+            print("XIC MSACCESS", time.time() - start_time, file=sys.stderr, flush=True)
+            return result
+        except Exception as e:
+            print("XIC MSACCESS FAILED", e, file=sys.stderr, flush=True)
 
-    return _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+    start_time = time.time()
+    result = _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+    print("XIC PARSED", time.time() - start_time, file=sys.stderr, flush=True)
+
+    return result
 
 
 def _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter):
@@ -54,6 +125,8 @@ def _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolera
     xic_trace = defaultdict(list)
     rt_trace = []
     
+    lower_bounds, upper_bounds = _target_windows(all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
+
     sum_i = 0 # Used by MS2 height
     for spec in _spectrum_generator(input_filename, rt_min, rt_max):
         if spec.scan_time_in_minutes() < rt_min:
@@ -75,18 +148,19 @@ def _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolera
                     continue
 
             try:
-                for target_mz in all_xic_values:
-                    lower_tolerance, upper_tolerance = _calculate_upper_lower_tolerance(target_mz[1], xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
-
-                    # Filtering peaks by mz
-                    peaks_full = spec.peaks("raw")
-                    peaks = peaks_full[
-                        np.where(np.logical_and(peaks_full[:, 0] >= lower_tolerance, peaks_full[:, 0] <= upper_tolerance))
-                    ]
-
-                    # summing intensity
-                    sum_i = sum([peak[1] for peak in peaks])
-                    xic_trace[target_mz[0]].append(sum_i)
+                # Decoding the peaks once and summing all targets together
+                peaks_full = spec.peaks("raw")
+                mz = peaks_full[:, 0]
+                intensity = peaks_full[:, 1]
+                if np.any(mz[1:] < mz[:-1]):
+                    order = np.argsort(mz, kind="stable")
+                    mz = mz[order]
+                    intensity = intensity[order]
+
+                target_sums = _sum_target_windows(mz, intensity, lower_bounds, upper_bounds)
+                for target_index, target_mz in enumerate(all_xic_values):
+                    xic_trace[target_mz[0]].append(target_sums[target_index])
+                sum_i = target_sums[-1]
             except:
                 pass
 
@@ -124,6 +198,67 @@ def _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolera
 
     return xic_df, ms2_data
 
+def _xic_file_store(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=False):
+    """
+        Extracts all targets at once from the memory mapped peak store, raises if the store hasn't been built
+    """
+    loaded_peak_store = peak_store.load_peak_store(input_filename)
+    if loaded_peak_store is None:
+        raise Exception("Peak store not available")
+
+    scans, mz, intensity = loaded_peak_store
+
+    lower_bounds, upper_bounds = _target_windows(all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
+    positions = peak_store.rt_window_scan_positions(scans, rt_min, rt_max, ms_level=1, polarity_filter=polarity_filter)
+
+    xic_matrix = np.zeros((len(positions), len(all_xic_values)))
+    for row, position in enumerate(positions):
+        scan_start = int(scans["start"][position])
+        scan_end = int(scans["end"][position])
+        xic_matrix[row] = _sum_target_windows(mz[scan_start:scan_end], intensity[scan_start:scan_end], lower_bounds, upper_bounds)
+
+    rt_trace = scans["rt"][positions]
+
+    # Formatting Data Frame
+    xic_df = pd.DataFrame()
+    for target_index, target_mz in enumerate(all_xic_values):
+        xic_df["XIC {}".format(target_mz[0])] = xic_matrix[:, target_index]
+    xic_df["rt"] = rt_trace
+
+    ms2_data = {}
+    if get_ms2 is True:
+        ms2_data = _xic_ms2_from_index(input_filename, all_xic_values, xic_matrix, rt_trace, lower_bounds, upper_bounds, rt_min, rt_max)
+
+    return xic_df, ms2_data
+
+def _xic_ms2_from_index(input_filename, all_xic_values, xic_matrix, rt_trace, lower_bounds, upper_bounds, rt_min, rt_max):
+    """
+        Finds the MS2 scans for a single target with the spectrum index, the height is the XIC of the MS1 right before it
+    """
+    ms2_data = {}
+    ms2_data["all_ms2_ms1_int"] = []
+    ms2_data["all_ms2_rt"] = []
+    ms2_data["all_ms2_scan"] = []
+
+    if len(all_xic_values) != 1:
+        return ms2_data
+
+    index_df = spectrum_index.load_spectrum_index(input_filename)
+    if index_df is None:
+        raise Exception("Spectrum index not available")
+
+    ms2_df = index_df[(index_df["ms_level"] == 2) & (index_df["rt"] >= rt_min) & (index_df["rt"] <= rt_max)]
+    ms2_df = ms2_df[(ms2_df["precursor_mz"] >= lower_bounds[0]) & (ms2_df["precursor_mz"] <= upper_bounds[0])]
+
+    previous_ms1 = np.searchsorted(rt_trace, ms2_df["rt"].values, side="right") - 1
+    for ms2_rt, ms2_scan, ms1_position in zip(ms2_df["rt"].values, ms2_df["scan"].values, previous_ms1):
+        ms1_int = xic_matrix[ms1_position, 0] if ms1_position >= 0 else 0.0
+        ms2_data["all_ms2_ms1_int"].append(float(ms1_int))
+        ms2_data["all_ms2_rt"].append(float(ms2_rt))
+        ms2_data["all_ms2_scan"].append(spectrum_index._scan_identifier(ms2_scan))
+
+    return ms2_data
+
 def _xic_file_fast(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, temp_folder="temp"):
     """
         xic values are tuples where the first value is the string and the second is the value
@@ -136,8 +271,10 @@ def _xic_file_fast(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolera
         temp_result_folder = os.path.join(temp_folder, str(uuid.uuid4()))
 
         cmd = 'export LC_ALL=C && ./bin/msaccess {} -o {} -x "tic mz={},{} delimiter=tab" --filter "msLevel 1" --filter "scanTime ["{},{}"]"'.format(input_filename, temp_result_folder, lower_tolerance, upper_tolerance, rt_min*60, rt_max*60)
-        os.system(cmd)
         print(cmd)
+        if os.system(cmd) != 0:
+            shutil.rmtree(temp_result_folder, ignore_errors=True)
+            raise Exception("msaccess failed")
 
         # Reading output file
         result_filename = glob.glob(os.path.join(temp_result_folder, "*"))[0]
@@ -151,6 +288,42 @@ def _xic_file_fast(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolera
 
     return xic_df, {}
 
+def xic_long_format(xic_df, usi_element, usi1_list, xic_norm=False):
+    """
+    Melts an XIC data frame into the long format used for plotting, one row per rt and target
+
+    Args:
+        xic_df ([type]): XIC data frame with the rt column and an XIC column per target
+        usi_element ([type]): the USI the XIC came from
+        usi1_list ([type]): USIs in the top group
+        xic_norm (bool, optional): normalize each target to its max. Defaults to False.
+
+    Returns:
+        [type]: long data frame with rt, variable, value, USI, GROUP
+    """
+    # Performing Normalization only if we have multiple XICs available
+    if xic_norm is True:
+        try:
+            for key in xic_df.columns:
+                if key == "rt":
+                    continue
+                xic_df[key] = xic_df[key] / max(xic_df[key])
+        except:
+            pass
+
+    # Formatting for Plotting
+    target_names = list(xic_df.columns)
+    target_names.remove("rt")
+    df_long = pd.melt(xic_df, id_vars="rt", value_vars=target_names)
+    df_long["USI"] = usi_element
+
+    if usi_element in usi1_list:
+        df_long["GROUP"] = "TOP"
+    else:
+        df_long["GROUP"] = "BOTTOM"
+
+    return df_long
+
 def chromatograms_list(local_filename):
     run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions, skip_chromatogram=False)
 